@@ -0,0 +1,664 @@
+# bench.py
+# أدوات قياس الأداء واختبار الضغط للبوت — تعمل بالكامل بدون اتصال بتيليجرام
+#
+# الاستخدام:
+#   python bench.py concurrency [--threads 16] [--ops 300]
+#   python bench.py purchases [--buyers 200] [--per-buyer 20] [--taps 2]
+#   python bench.py plans      (يتحقق أن كل استعلام في main.py يستخدم فهرساً)
+#   python bench.py webhook [--updates 2000] [--clients 32] [--latency 0.02]
+#   python bench.py load [--users 500] [--clients 16] [--latency 0.01]  (النتائج في bench_results/)
+#   python bench.py dispatch [--iterations 200000]  (كلفة توجيه زر واحد عبر CallbackRouter)
+#   python bench.py search [--products 20000] [--queries 5000]  (FTS5 مقابل LIKE، مع وبدون ذاكرة LRU)
+#
+# كل تشغيل يستخدم قاعدة بيانات مؤقتة (عبر DB_FILE) ولا يلمس store_bot.db
+
+import os
+import re
+import json
+import ast
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+import traceback
+import urllib.request
+import concurrent.futures
+from types import SimpleNamespace
+from datetime import datetime
+
+_tmpdir = tempfile.mkdtemp(prefix="storebot-bench-")
+os.environ["DB_FILE"] = os.path.join(_tmpdir, "bench.db")
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("ADMIN_ID", "1")
+
+import main  # noqa: E402
+
+
+class FakeUser:
+    def __init__(self, uid):
+        self.id = uid
+        self.username = f"user{uid}"
+        self.first_name = f"User {uid}"
+
+
+def percentiles(values, points=(50, 95, 99)):
+    if not values:
+        return {p: 0.0 for p in points}
+    ordered = sorted(values)
+    return {p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+def fmt_ms(pcts):
+    return " ".join(f"p{p}={v * 1000:.1f}ms" for p, v in pcts.items())
+
+
+def run_threads(n, target):
+    errors = []
+
+    def wrap(i):
+        try:
+            target(i)
+        except Exception:
+            errors.append(traceback.format_exc())
+        finally:
+            main.close_db()
+
+    threads = [threading.Thread(target=wrap, args=(i,)) for i in range(n)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - t0, errors
+
+
+# ---------------------------
+# concurrency: كتابة وقراءة متزامنة عبر دوال المساعدة في main.py
+# ---------------------------
+def bench_concurrency(args):
+    users = list(range(1, args.users + 1))
+    for u in users:
+        main.ensure_user(FakeUser(u))
+        # رصيد أساسي مميز لكل مستخدم حتى نكشف أي خلط بين الصفوف عند القراءة
+        main.set_balance(u, u * 1_000_000)
+
+    mismatches = []
+
+    def worker(i):
+        for k in range(args.ops):
+            u = users[(i + k) % len(users)]
+            if k % 3 == 0:
+                main.ensure_user(FakeUser(u))
+                main.change_balance(u, 1)
+            else:
+                bal = main.get_balance(u)
+                if int(bal // 1_000_000) != u:
+                    mismatches.append((u, bal))
+
+    elapsed, errors = run_threads(args.threads, worker)
+
+    expected = {u: u * 1_000_000 for u in users}
+    for i in range(args.threads):
+        for k in range(0, args.ops, 3):
+            expected[users[(i + k) % len(users)]] += 1
+    lost = {u: (expected[u], main.get_balance(u)) for u in users if main.get_balance(u) != expected[u]}
+
+    total_ops = args.threads * args.ops
+    print(f"threads={args.threads} ops={total_ops} time={elapsed:.2f}s ({total_ops / elapsed:.0f} ops/s)")
+    print(f"errors={len(errors)} crossed_reads={len(mismatches)} lost_updates={len(lost)}")
+    for e in errors[:3]:
+        print(e)
+    return 0 if not (errors or mismatches or lost) else 1
+
+
+# ---------------------------
+# purchases: عمليات شراء متزامنة مع ضغط مزدوج على الزر
+# ---------------------------
+def bench_purchases(args):
+    cid = main.add_category("bench")
+    price = 5.0
+    pid = main.add_product(cid, "bench item", price, "")
+    buyers = list(range(100_000, 100_000 + args.buyers))
+    for u in buyers:
+        main.ensure_user(FakeUser(u))
+        # رصيد يكفي per_buyer عملية فقط؛ المحاولات الإضافية يجب أن ترفض
+        main.set_balance(u, price * args.per_buyer)
+
+    results = {"ok": 0, "rejected": 0}
+    lock = threading.Lock()
+
+    def worker(i):
+        # كل مستخدم له taps خيوط تحاول الشراء بنفس الوقت (double tap)
+        u = buyers[i // args.taps]
+        ok = rejected = 0
+        for _ in range(args.per_buyer):
+            res = main.purchase(u, pid)
+            if res and res[0] is not None:
+                ok += 1
+            else:
+                rejected += 1
+        with lock:
+            results["ok"] += ok
+            results["rejected"] += rejected
+
+    elapsed, errors = run_threads(args.buyers * args.taps, worker)
+
+    bad = []
+    for u in buyers:
+        orders = main.db_one("SELECT COUNT(*) FROM orders WHERE user_id = ?", (u,))[0]
+        bal = main.get_balance(u)
+        if orders != args.per_buyer or bal != 0:
+            bad.append((u, orders, bal))
+
+    print(f"buyers={args.buyers} taps={args.taps} attempts={results['ok'] + results['rejected']} time={elapsed:.2f}s")
+    print(f"purchases={results['ok']} ({results['ok'] / elapsed:.0f} purchases/s) rejected={results['rejected']}")
+    print(f"errors={len(errors)} inconsistent_accounts={len(bad)}")
+    for e in errors[:3]:
+        print(e)
+    return 0 if not (errors or bad) else 1
+
+
+# ---------------------------
+# plans: EXPLAIN QUERY PLAN لكل استعلام في main.py
+# ---------------------------
+# استعلامات تمسح الجدول كاملاً عن قصد (تحميل كامل أو نسخ كل المستخدمين)
+FULL_SCAN_OK = (
+    "SELECT id, name FROM categories",
+    "SELECT user_id, state, data, expires_at FROM user_state",
+    "INSERT OR IGNORE INTO broadcast_targets",
+    "SELECT key, value FROM stats",   # بضعة صفوف ثابتة
+    "DELETE FROM settings WHERE key LIKE 'awaiting!_%'",
+    # التصدير يمر على الجدول كله عن قصد
+    "SELECT id, user_id, amount_syp, credits, status, created_at FROM deposits",
+    # أول صفحة بدون فلتر: مرور عكسي على rowid يتوقف عند LIMIT
+    "SELECT id, user_id, credits, amount_syp, status, created_at FROM deposits WHERE 1 = 1 ORDER BY id DESC LIMIT",
+    "SELECT id, parent_type, parent_id, text, action, payload FROM buttons ORDER BY id LIMIT",
+    # /reconcile يقارن كل مستخدم بدفتره عن قصد (بحث بالفهرس لكل مستخدم)
+    "SELECT user_id, balance_minor, ledger FROM (",
+    # الاستيراد يقارن الملف بالكتالوج كله، و /reprice بلا قسم يعدل كل الأسعار
+    "SELECT id, category_id, name, price, description FROM products",
+    "SELECT name, id FROM categories",
+    "SELECT id, name, price, MAX(0, ROUND(price * ",
+    "UPDATE products SET price = MAX(0, ROUND(price * ",
+    # مخطط الجداول لإنشاء نسخها في ملفات الأرشيف
+    "SELECT sql FROM main.sqlite_master",
+    # init_db: هل الملف جديد (بلا جداول)؟ يتوقف عند أول صف
+    "SELECT 1 FROM sqlite_master LIMIT 1",
+)
+
+def main_queries():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    # الترحيلات تنفذ مرة واحدة (تعبئة أولية) فلا تدخل في الفحص
+    migrations = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == "MIGRATIONS" for t in node.targets):
+            migrations.update(id(n) for n in ast.walk(node.value))
+    seen = []
+    for node in ast.walk(tree):
+        if id(node) in migrations:
+            continue
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            sql = " ".join(node.value.split())
+            if re.match(r"(SELECT|INSERT|UPDATE|DELETE|WITH)\b", sql) and sql not in seen:
+                seen.append(sql)
+    return seen
+
+def runtime_queries():
+    # الاستعلامات المركبة ديناميكياً (صفحات وفلاتر) تلتقط أثناء التنفيذ عبر trace callback
+    c = main.db()
+    captured = []
+    c.set_trace_callback(captured.append)
+    try:
+        main.orders_page(1)
+        main.orders_page(1, before=10)
+        main.orders_page(1, after=10)
+        for code in ("a", "b", "v", "g100"):
+            main.users_page(code)
+            main.users_page(code, after_user=1)
+        for status in ("", "pending"):
+            main.deposits_page(status)
+            main.deposits_page(status, before=10)
+        for selector in ("all", "user 1", "1-10", "1,2,3"):
+            main.confirm_deposits(*main.parse_deposit_selector(selector))
+            main.reject_deposits(*main.parse_deposit_selector(selector))
+        for cat_id in (None, 1):
+            main.reprice_products(1.0, 0.0, cat_id)
+        main.archive_old_rows()
+    finally:
+        c.set_trace_callback(None)
+    return [" ".join(q.split()) for q in captured if re.match(r"(SELECT|INSERT|UPDATE|DELETE|WITH)\b", q)]
+
+def bench_plans(args):
+    c = main.db()
+    failures = []
+    skipped = 0
+    queries = main_queries() + runtime_queries()
+    for sql in queries:
+        params = (None,) * sql.count("?")
+        try:
+            plan = [row[-1] for row in c.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        except sqlite3.OperationalError:
+            # أجزاء استعلامات تكمل وقت التشغيل (تغطيها runtime_queries)
+            skipped += 1
+            continue
+        # جداول FTS5: "INDEX 0:M" (MATCH) أو "INDEX 0:=" (rowid) بحث؛ "INDEX 0:" وحدها مسح كامل
+        scans = [p for p in plan if p.startswith("SCAN ") and " USING " not in p
+                 and not re.search(r"VIRTUAL TABLE INDEX \d+:\S", p)]
+        if scans and not sql.startswith(FULL_SCAN_OK):
+            failures.append((sql, plan))
+    for sql, plan in failures:
+        print(f"FULL SCAN: {sql}")
+        for p in plan:
+            print(f"    {p}")
+    print(f"queries={len(queries)} fragments_skipped={skipped} full_scans={len(failures)}")
+    return 0 if not failures else 1
+
+
+# ---------------------------
+# webhook: تحديثات عبر HTTP إلى WebhookServer مع خادم تيليجرام وهمي
+# ---------------------------
+def bench_webhook(args):
+    from fake_telegram import FakeTelegram
+
+    fake = FakeTelegram(latency=args.latency).start()
+    fake.install()
+    posted = {}
+    replied = {}
+
+    def on_call(method, params):
+        if method == "sendMessage":
+            chat = int(params.get("chat_id", 0))
+            replied.setdefault(chat, time.perf_counter())
+
+    fake.on_call = on_call
+    secret = "bench-secret"
+    server = main.WebhookServer(host="127.0.0.1", port=0, secret=secret, workers=args.workers).start()
+    url = f"http://127.0.0.1:{server.port}{main.WEBHOOK_PATH}"
+
+    def post(i):
+        uid = 500_000 + i
+        update = {"update_id": i + 1, "message": {
+            "message_id": i + 1, "date": int(time.time()), "text": "hello",
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": f"u{i}"}}}
+        req = urllib.request.Request(url, data=json.dumps(update).encode("utf-8"), method="POST",
+                                     headers={"Content-Type": "application/json",
+                                              "X-Telegram-Bot-Api-Secret-Token": secret})
+        t0 = time.perf_counter()
+        posted[uid] = t0
+        with urllib.request.urlopen(req) as r:
+            r.read()
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.clients) as pool:
+        ingest = list(pool.map(post, range(args.updates)))
+    deadline = time.time() + 60
+    while len(replied) < args.updates and time.time() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - t0
+    server.stop()
+    fake.stop()
+
+    e2e = [replied[u] - posted[u] for u in posted if u in replied]
+    print(f"updates={args.updates} replied={len(replied)} time={elapsed:.2f}s ({len(replied) / elapsed:.0f} updates/s)")
+    print(f"ingest  {fmt_ms(percentiles(ingest))}")
+    print(f"end2end {fmt_ms(percentiles(e2e))}")
+    return 0 if len(replied) == args.updates else 1
+
+
+# ---------------------------
+# load: جلسات مستخدمين اصطناعية عبر المعالجات مع Bot API وهمي بتأخير
+# ---------------------------
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results")
+
+
+class MockAPI:
+    # يستبدل دوال الإرسال في main.bot: ينام latency ثم يعيد رسالة شكلية
+    METHODS = ("send_message", "edit_message_text", "answer_callback_query", "reply_to", "send_document")
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+    def install(self, bot):
+        for name in self.METHODS:
+            setattr(bot, name, self._call)
+
+    def _call(self, chat_id=None, *args, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            self.next_id += 1
+            mid = self.next_id
+        return SimpleNamespace(message_id=mid, chat=SimpleNamespace(id=getattr(chat_id, "id", chat_id)))
+
+
+class SqlCounter:
+    # يعد الاستعلامات لكل خيط عبر trace callback على كل اتصال جديد
+    def __init__(self):
+        self.local = threading.local()
+        self.background = 0
+
+    def install(self):
+        connect = main._connect
+        client = self.local
+
+        def traced():
+            conn = connect()
+            conn.set_trace_callback(self._count)
+            return conn
+
+        main._connect = traced
+        # الاتصالات الموجودة تغلق حتى يعاد فتحها عبر الدالة الجديدة
+        main.writer.stop()
+        main.close_db()
+        client.active = False
+
+    def _count(self, sql):
+        if getattr(self.local, "active", False):
+            self.local.n += 1
+        else:
+            self.background += 1
+
+    def start(self):
+        self.local.active = True
+        self.local.n = 0
+
+    def stop(self):
+        self.local.active = False
+        return self.local.n
+
+
+def make_update(seq, uid, text=None, data=None):
+    user = {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+    chat = {"id": uid, "type": "private"}
+    if data is None:
+        return {"update_id": seq, "message": {"message_id": seq, "date": int(time.time()), "chat": chat,
+                                              "from": user, "text": text}}
+    return {"update_id": seq, "callback_query": {"id": str(seq), "from": user, "data": data, "chat_instance": "1",
+                                                 "message": {"message_id": seq, "date": int(time.time()),
+                                                             "chat": chat, "text": "x"}}}
+
+
+def user_session(rnd, uid, products, buy_ratio, deposit_ratio):
+    # ((نوع الخطوة، نص أو None، callback_data أو None), ...)
+    cid, pid = rnd.choice(products)
+    steps = [("start", "/start", None), ("browse", None, "menu_sections"), ("category", None, f"cat:{cid}"),
+             ("product", None, f"prod:{pid}")]
+    if rnd.random() < buy_ratio:
+        steps.append(("buy", None, f"buy:{pid}"))
+    if rnd.random() < deposit_ratio:
+        steps += [("deposit", None, "menu_deposit"), ("deposit_amount", str(rnd.choice((5000, 12500, 25000))), None)]
+    steps.append(("orders", None, "menu_orders"))
+    return steps
+
+
+def bench_load(args):
+    import random
+    from telebot import types
+
+    rnd = random.Random(args.seed)
+    api = MockAPI(args.latency)
+    api.install(main.bot)
+    main.bot.threaded = False
+    if not args.flood:
+        main.flood.rate = main.flood.burst = 1e9
+    sql = SqlCounter()
+    sql.install()
+
+    products = []
+    for c in range(args.categories):
+        cid = main.add_category(f"cat {c}")
+        for p in range(args.products):
+            products.append((cid, main.add_product(cid, f"item {c}-{p}", 1 + p % 7, "")))
+    users = list(range(200_000, 200_000 + args.users))
+    for u in users:
+        balance = rnd.choice((0, 5, 50))
+        main.db_exec("INSERT OR IGNORE INTO users (user_id, created_at, balance_minor) VALUES (?, ?, ?)",
+                     (u, "2026-01-01T00:00:00", main.to_minor(balance)))
+    sessions = {u: user_session(rnd, u, products, args.buy_ratio, args.deposit_ratio) for u in users}
+    # جلسة أدمن: بث لكل المستخدمين أثناء الحمل
+    sessions[main.ADMIN_ID] = [("admin_broadcast", None, "adm_broadcast"), ("broadcast_text", "bench broadcast", None)]
+
+    samples = {}     # kind -> [(latency, sql_count)]
+    lock = threading.Lock()
+    seq = iter(range(1, 10**9))
+    order = list(sessions)
+    rnd.shuffle(order)
+
+    def worker(i):
+        for uid in order[i::args.clients]:
+            for kind, text, data in sessions[uid]:
+                update = types.Update.de_json(json.dumps(make_update(next(seq), uid, text, data)))
+                sql.start()
+                t0 = time.perf_counter()
+                main.bot.process_new_updates([update])
+                elapsed = time.perf_counter() - t0
+                n = sql.stop()
+                with lock:
+                    samples.setdefault(kind, []).append((elapsed, n))
+                if args.think:
+                    time.sleep(rnd.random() * args.think)
+
+    elapsed, errors = run_threads(args.clients, worker)
+    main.writer.flush()
+
+    total = sum(len(v) for v in samples.values())
+    all_lat = [lat for v in samples.values() for lat, _ in v]
+    all_sql = sum(n for v in samples.values() for _, n in v)
+    pct = percentiles(all_lat)
+    result = {
+        "when": datetime.now().isoformat(timespec="seconds"),
+        "params": {k: getattr(args, k) for k in ("users", "clients", "latency", "think", "buy_ratio",
+                                                 "deposit_ratio", "categories", "products", "flood", "seed")},
+        "updates": total, "seconds": round(elapsed, 3), "throughput": round(total / elapsed, 1),
+        "p50_ms": round(pct[50] * 1000, 2), "p95_ms": round(pct[95] * 1000, 2), "p99_ms": round(pct[99] * 1000, 2),
+        "sql_per_update": round(all_sql / max(1, total), 2), "api_calls": api.calls,
+        "background_sql": sql.background, "errors": len(errors),
+        "by_kind": {kind: {"n": len(v), "p95_ms": round(percentiles([lat for lat, _ in v])[95] * 1000, 2),
+                           "sql_per_update": round(sum(n for _, n in v) / len(v), 2)}
+                    for kind, v in sorted(samples.items())},
+    }
+
+    print(f"updates={total} clients={args.clients} time={elapsed:.2f}s ({result['throughput']:.0f} updates/s) "
+          f"errors={len(errors)}")
+    print(f"latency {fmt_ms(pct)}  sql/update={result['sql_per_update']}  api_calls={api.calls} "
+          f"background_sql={sql.background}")
+    for kind, row in result["by_kind"].items():
+        print(f"  {kind:<16} n={row['n']:<6} p95={row['p95_ms']:.1f}ms sql/update={row['sql_per_update']}")
+    for e in errors[:3]:
+        print(e)
+
+    # المقارنة مع آخر تشغيل بنفس المعاملات
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    previous = None
+    for name in sorted(os.listdir(RESULTS_DIR), reverse=True):
+        if name.startswith("load-") and name.endswith(".json"):
+            with open(os.path.join(RESULTS_DIR, name), encoding="utf-8") as f:
+                old = json.load(f)
+            if old.get("params") == result["params"]:
+                previous = (name, old)
+                break
+    regressed = []
+    if previous:
+        name, old = previous
+        print(f"vs {name}:")
+        for key, worse_if_higher in (("throughput", False), ("p50_ms", True), ("p95_ms", True),
+                                     ("p99_ms", True), ("sql_per_update", True)):
+            before, after = old[key], result[key]
+            change = (after - before) / before * 100 if before else 0.0
+            worse = change > args.tolerance if worse_if_higher else change < -args.tolerance
+            if worse:
+                regressed.append(key)
+            print(f"  {key:<15} {before:>10} -> {after:<10} {change:+.1f}%{'  REGRESSION' if worse else ''}")
+    path = os.path.join(RESULTS_DIR, f"load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print(f"saved {path}")
+    return 1 if errors or (regressed and args.fail_on_regression) else 0
+
+
+# ---------------------------
+# dispatch: كلفة تحليل callback_data واختيار المعالج لكل تحديث
+# ---------------------------
+DISPATCH_SAMPLES = ["back_main", "menu_sections", "menu_orders", "cat:12", "prod:345", "buy:345",
+                    "ord:o:9876", "usr:g10:123456", "dpl:pending:", "adm_list_buttons", "unknown:x"]
+
+
+def linear_resolve(data):
+    # خط الأساس: سلسلة if/startswith كما كانت قبل الموجّه (بنفس ترتيب التسجيل)
+    for key, entry in main.router.exact.items():
+        if data == key:
+            return entry
+    for head, entry in main.router.prefix.items():
+        if data.startswith(head + ":"):
+            return entry
+    return None
+
+
+def bench_dispatch(args):
+    resolve = main.router.resolve
+    for data in DISPATCH_SAMPLES:
+        hit = resolve(data)
+        print(f"  {data:<18} -> {hit[0].__name__ + str(hit[2]) if hit else 'None'}")
+    n = args.iterations
+    for label, fn in (("router", resolve), ("linear", linear_resolve)):
+        t0 = time.perf_counter()
+        for i in range(n):
+            fn(DISPATCH_SAMPLES[i % len(DISPATCH_SAMPLES)])
+        elapsed = time.perf_counter() - t0
+        print(f"{label}: {elapsed / n * 1e9:.0f} ns/update ({n} updates, {len(main.router.exact)} exact + "
+              f"{len(main.router.prefix)} prefix routes)")
+    return 0
+
+
+# ---------------------------
+# search: زمن البحث عبر FTS5 (بارد ومع ذاكرة LRU) مقابل مسح LIKE على جدول المنتجات
+# ---------------------------
+SEARCH_BRANDS = ["شدات ببجي", "جواهر فري فاير", "بطاقة آيتونز", "جوجل بلاي", "ستيم والت", "إكس بوكس لايف",
+                 "نتفلكس", "أمازون", "كول أوف ديوتي", "روبلوكس", "فورتنايت", "يلا لودو", "بلايستيشن", "لوردس موبايل",
+                 "كلاش أوف كلانس", "ببجي لايت", "توب توب", "سوا", "زين", "موبايلي"]
+SEARCH_REGIONS = ["أمريكي", "سعودي", "إماراتي", "تركي", "أوروبي", "عالمي", "مصري", "كويتي", "قطري", "عراقي"]
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def bench_search(args):
+    import random
+    rnd = random.Random(args.seed)
+    cats = [main.add_category(brand) for brand in SEARCH_BRANDS]
+    with main.transaction() as c:
+        for i in range(args.products):
+            b = i % len(SEARCH_BRANDS)
+            amount = rnd.choice((60, 100, 325, 660, 1800, 3850, 8100)) * (1 + i // 5000)
+            name = f"{SEARCH_BRANDS[b]} {amount} {rnd.choice(SEARCH_REGIONS)}"
+            desc = f"شحن فوري {SEARCH_BRANDS[b]} — كود رقمي {i}"
+            pid = c.execute("INSERT INTO products (category_id, name, price, description, pos) VALUES (?, ?, ?, ?, 0)",
+                            (cats[b], name, 1 + i % 50, desc)).lastrowid
+            main.index_product(c, pid, name, desc)
+    main.invalidate_catalog()
+    # بادئات كما يكتبها المستخدم حرفاً حرفاً (اسم + أحياناً منطقة)، والطلب عليها متفاوت (Zipf)
+    pool = []
+    for brand in SEARCH_BRANDS:
+        for region in ("",) + tuple(SEARCH_REGIONS):
+            words = brand.split()[:1] + ([region] if region else [])
+            pool += [" ".join(w[:n] for w in words) for n in range(2, 7)]
+    pool = list(dict.fromkeys(pool))
+    rnd.shuffle(pool)
+    queries = rnd.choices(pool, weights=[1 / (rank + 1) for rank in range(len(pool))], k=args.queries)
+
+    def run(label, fn):
+        times = []
+        for q in queries:
+            t0 = time.perf_counter()
+            fn(q)
+            times.append(time.perf_counter() - t0)
+        times.sort()
+        print(f"{label:<9} p50={percentile(times, 0.5) * 1000:.2f}ms p95={percentile(times, 0.95) * 1000:.2f}ms "
+              f"p99={percentile(times, 0.99) * 1000:.2f}ms max={times[-1] * 1000:.2f}ms")
+
+    def like(q):
+        # خط الأساس: LIKE على الاسم (بلا توحيد ولا ترتيب حسب الصلة)
+        words = q.split()
+        sql = "SELECT id FROM products WHERE " + " AND ".join("name LIKE ?" for _ in words) + " LIMIT ?"
+        main.db_all(sql, [f"%{w}%" for w in words] + [main.SEARCH_MAX_RESULTS])
+
+    def cold(q):
+        main.search_cache.items.clear()
+        main.search_products(q)
+
+    run("like", like)
+    run("fts-cold", cold)
+    main.search_cache.items.clear()
+    run("fts-lru", main.search_products)
+    print(f"products={args.products} queries={len(queries)} distinct={len(set(queries))} "
+          f"search={dict(main.metrics.snapshot('storebot_search_total'))}")
+    return 0
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Store bot benchmarks")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("concurrency", help="stress the DB helpers from many threads")
+    p.add_argument("--threads", type=int, default=16)
+    p.add_argument("--ops", type=int, default=300)
+    p.add_argument("--users", type=int, default=20)
+    p.set_defaults(func=bench_concurrency)
+
+    p = sub.add_parser("purchases", help="concurrent buyers through purchase()")
+    p.add_argument("--buyers", type=int, default=200)
+    p.add_argument("--per-buyer", type=int, default=20)
+    p.add_argument("--taps", type=int, default=2)
+    p.set_defaults(func=bench_purchases)
+
+    p = sub.add_parser("plans", help="assert every query in main.py uses an index")
+    p.set_defaults(func=bench_plans)
+
+    p = sub.add_parser("webhook", help="end-to-end webhook latency against a fake Telegram API")
+    p.add_argument("--updates", type=int, default=2000)
+    p.add_argument("--clients", type=int, default=32)
+    p.add_argument("--workers", type=int, default=main.WEBHOOK_WORKERS)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.set_defaults(func=bench_webhook)
+
+    p = sub.add_parser("load", help="replay synthetic user sessions through the handlers with a mocked Bot API")
+    p.add_argument("--users", type=int, default=500)
+    p.add_argument("--clients", type=int, default=16)
+    p.add_argument("--latency", type=float, default=0.01, help="seconds per mocked API call")
+    p.add_argument("--think", type=float, default=0.0, help="max random pause between a user's updates")
+    p.add_argument("--buy-ratio", type=float, default=0.5)
+    p.add_argument("--deposit-ratio", type=float, default=0.2)
+    p.add_argument("--categories", type=int, default=8)
+    p.add_argument("--products", type=int, default=20, help="products per category")
+    p.add_argument("--flood", action="store_true", help="keep per-user flood control enabled")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--tolerance", type=float, default=20.0, help="percent change reported as a regression")
+    p.add_argument("--fail-on-regression", action="store_true")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("dispatch", help="per-update cost of CallbackRouter.resolve vs a linear chain")
+    p.add_argument("--iterations", type=int, default=200000)
+    p.set_defaults(func=bench_dispatch)
+
+    p = sub.add_parser("search", help="FTS5 product search latency vs a LIKE scan, cold and cached")
+    p.add_argument("--products", type=int, default=20000)
+    p.add_argument("--queries", type=int, default=5000)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_search)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
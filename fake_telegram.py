@@ -0,0 +1,134 @@
+# fake_telegram.py
+# خادم محلي يحاكي Bot API لتيليجرام — لقياس الأداء واختبار وضع webhook بدون إنترنت
+#
+# الاستخدام:
+#   fake = FakeTelegram(latency=0.02).start()
+#   fake.install()   # يوجه telebot.apihelper إلى الخادم المحلي
+#   ...
+#   fake.stop()
+
+import json
+import time
+import random
+import threading
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class FakeTelegram:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, rate_429=0.0, retry_after=1):
+        self.latency = latency          # تأخير مصطنع لكل طلب (ثوانٍ)
+        self.rate_429 = rate_429        # نسبة الطلبات التي ترد بـ 429
+        self.retry_after = retry_after
+        self.calls = []                 # (monotonic, method, params)
+        self.files = {}                 # file_path -> bytes (لـ getFile/download)
+        self.on_call = None             # دالة اختيارية (method, params) تستدعى لكل طلب
+        self.lock = threading.Lock()
+        self.next_message_id = 1
+        self.httpd = _Server((host, port), self._handler_class())
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="fake-telegram", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def install(self):
+        from telebot import apihelper
+        apihelper.API_URL = self.url + "/bot{0}/{1}"
+        apihelper.FILE_URL = self.url + "/file/bot{0}/{1}"
+
+    def count(self, method=None):
+        with self.lock:
+            return sum(1 for _, m, _ in self.calls if method is None or m == method)
+
+    # ---------------------------
+    # ردود الطرق
+    # ---------------------------
+    def _message(self, params):
+        with self.lock:
+            mid = self.next_message_id
+            self.next_message_id += 1
+        chat_id = params.get("chat_id", 0)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        return {"message_id": mid, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", "")}
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            return self._message(params)
+        if method == "getUpdates":
+            return []
+        if method == "getFile":
+            fid = params.get("file_id", "")
+            return {"file_id": fid, "file_unique_id": fid, "file_path": fid,
+                    "file_size": len(self.files.get(fid, b""))}
+        return True
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _params(self):
+                params = {k: v[-1] for k, v in parse_qs(urlparse(self.path).query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                ctype = self.headers.get("Content-Type", "")
+                if body and ctype.startswith("application/json"):
+                    params.update(json.loads(body))
+                elif body and ctype.startswith("application/x-www-form-urlencoded"):
+                    params.update({k: v[-1] for k, v in parse_qs(body.decode("utf-8")).items()})
+                return params
+
+            def _send(self, code, payload, raw=False):
+                data = payload if raw else json.dumps(payload).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/octet-stream" if raw else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self):
+                parts = urlparse(self.path).path.strip("/").split("/")
+                if parts and parts[0] == "file":
+                    path = "/".join(parts[2:])
+                    if path in fake.files:
+                        return self._send(200, fake.files[path], raw=True)
+                    return self._send(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+                method = parts[-1] if len(parts) >= 2 else ""
+                params = self._params()
+                if fake.latency:
+                    time.sleep(fake.latency)
+                with fake.lock:
+                    fake.calls.append((time.monotonic(), method, params))
+                if fake.on_call:
+                    fake.on_call(method, params)
+                if fake.rate_429 and method != "getUpdates" and random.random() < fake.rate_429:
+                    return self._send(429, {"ok": False, "error_code": 429,
+                                            "description": f"Too Many Requests: retry after {fake.retry_after}",
+                                            "parameters": {"retry_after": fake.retry_after}})
+                self._send(200, {"ok": True, "result": fake._result(method, params)})
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
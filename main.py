@@ -16,16 +16,40 @@
 #   ADMIN_ID=...
 #
 # ملاحظة: الكود يعتمد على polling (infinity_polling). يمكن تحويله إلى webhook لاحقًا.
+# وضع asyncio اختياري: RUN_MODE=async في .env (يحتاج aiohttp — موجود في requirements.txt)
+# وضع webhook: RUN_MODE=webhook مع WEBHOOK_URL و WEBHOOK_SECRET (خادم HTTP مدمج؛ لا يعمل بدون سر)
 
+import io
 import os
+import re
+import csv
+import gzip
+import shutil
 import sqlite3
+import tempfile
+import hmac
+import secrets
+import html
+import bisect
+import functools
 import json
+import math
 import time
+import queue
+import asyncio
+import threading
 import traceback
-from datetime import datetime
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 from dotenv import load_dotenv
 import telebot
-from telebot import types
+from telebot import types, apihelper
+from telebot.apihelper import ApiTelegramException
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
 
 # ---------------------------
 # تحميل الإعدادات من .env
@@ -42,143 +66,955 @@ ADMIN_ID = int(ADMIN_ID)
 # العملة الافتراضية
 CURRENCY = "ل.س"
 
+# polling: خيوط telebot العادية — async: حلقة asyncio (انظر AsyncRuntime) — webhook: WebhookServer
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")          # العنوان العام المسجل لدى تيليجرام
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")    # يقارن مع X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg")
+
 # ---------------------------
 # تهيئة البوت و DB
 # ---------------------------
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+# use_class_middlewares: طبقة فحص قبل المعالجات (انظر FloodMiddleware)
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", use_class_middlewares=True)
+
+# أخطاء Bot API (يضاف إليها صنف نسخة asyncio في وضع async)
+API_ERRORS = (ApiTelegramException,)
+
+def api_result(r):
+    # في وضع async ترجع دوال bot مستقبلاً (Future)؛ نستخدمها فقط عندما نحتاج النتيجة فعلاً
+    if isinstance(r, concurrent.futures.Future):
+        return r.result()
+    return r
+
+# ---------------------------
+# المقاييس (metrics) بصيغة Prometheus — كلها في الذاكرة
+# ---------------------------
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))     # 0 = بدون خادم HTTP (يبقى أمر /metrics متاحاً)
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_MAX_SERIES = 300      # حد السلاسل لكل مقياس؛ ما زاد يجمع تحت "other"
+SQL_LABEL_LEN = 120
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.meta = {}          # name -> (type, help, label names)
+        self.series = {}        # name -> {label values: رقم (عداد) أو [عدادات الحاويات..., +Inf, sum] (هيستوغرام)}
+        self.callbacks = {}     # name -> fn() تعيد رقماً أو {label values: رقم} عند القراءة
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def counter(self, name, help, labels=()):
+        self.meta[name] = ("counter", help, labels)
+        self.series[name] = {}
+
+    def histogram(self, name, help, labels=()):
+        self.meta[name] = ("histogram", help, labels)
+        self.series[name] = {}
+
+    def gauge(self, name, help, fn, labels=(), kind="gauge"):
+        # قيم تحسب وقت القراءة (أطوال الطوابير، عدادات موجودة في كائنات أخرى)
+        self.meta[name] = (kind, help, labels)
+        self.callbacks[name] = fn
+
+    def _key(self, series, labels):
+        if labels in series or len(series) < METRIC_MAX_SERIES:
+            return labels
+        return ("other",) * len(labels)
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            series = self.series[name]
+            key = self._key(series, labels)
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series[name]
+            key = self._key(series, labels)
+            h = series.get(key)
+            if h is None:
+                h = series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            h[i] += 1
+            h[-1] += seconds
+
+    def snapshot(self, name):
+        with self.lock:
+            return {k: list(v) if isinstance(v, list) else v for k, v in self.series.get(name, {}).items()}
+
+    def quantile(self, name, q, labels=None):
+        # تقدير من حدود الحاويات (الحد الأعلى للحاوية التي تبلغ النسبة)
+        counts = [0] * (len(self.buckets) + 1)
+        for key, h in self.snapshot(name).items():
+            if labels is None or key == labels:
+                for i in range(len(counts)):
+                    counts[i] += h[i]
+        total = sum(counts)
+        if not total:
+            return 0.0
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= q * total:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    @staticmethod
+    def _labels(names, values, extra=""):
+        pairs = [f'{n}="{escape_label(v)}"' for n, v in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = []
+        for name, (kind, help, labels) in list(self.meta.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self.callbacks:
+                try:
+                    value = self.callbacks[name]()
+                except Exception:
+                    continue
+                items = value.items() if isinstance(value, dict) else [((), value)]
+                for key, v in items:
+                    lines.append(f"{name}{self._labels(labels, key)} {v}")
+            elif kind == "counter":
+                for key, v in sorted(self.snapshot(name).items()):
+                    lines.append(f"{name}{self._labels(labels, key)} {v}")
+            else:
+                for key, h in sorted(self.snapshot(name).items()):
+                    cumulative = 0
+                    for bound, n in zip(self.buckets + (float("inf"),), h):
+                        cumulative += n
+                        le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                        lines.append(f"{name}_bucket{self._labels(labels, key, le)} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(labels, key)} {h[-1]:.6f}")
+                    lines.append(f"{name}_count{self._labels(labels, key)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("storebot_update_seconds", "Update handling time by handler", ("handler",))
+metrics.histogram("storebot_callback_seconds", "Callback route handling time", ("route",))
+metrics.histogram("storebot_sql_seconds", "SQLite statement execution time", ("query",))
+metrics.counter("storebot_sql_errors_total", "SQLite statements that raised", ("query",))
+metrics.histogram("storebot_api_seconds", "Telegram Bot API request time", ("method",))
+metrics.counter("storebot_api_errors_total", "Telegram Bot API failures by error code", ("method", "code"))
+metrics.counter("storebot_errors_total", "Exceptions caught and logged", ("where",))
+metrics.gauge("storebot_uptime_seconds", "Seconds since start", lambda: round(time.time() - metrics.started, 1))
+metrics.gauge("storebot_threads", "Live Python threads", threading.active_count)
+
+def report_error(where):
+    # بديل traceback.print_exc() يعد الأخطاء حسب مكانها
+    metrics.inc("storebot_errors_total", (where,))
+    traceback.print_exc()
+
+@functools.lru_cache(maxsize=1024)
+def sql_label(sql):
+    return " ".join(sql.split())[:SQL_LABEL_LEN]
+
+class TimedConnection(sqlite3.Connection):
+    # كل execute/executemany يمر من هنا (Connection.execute ينشئ المؤشر وينفذ)
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        except sqlite3.Error:
+            metrics.inc("storebot_sql_errors_total", (sql_label(sql),))
+            raise
+        finally:
+            metrics.observe("storebot_sql_seconds", (sql_label(sql),), time.perf_counter() - t0)
+
+    def executemany(self, sql, seq):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        except sqlite3.Error:
+            metrics.inc("storebot_sql_errors_total", (sql_label(sql),))
+            raise
+        finally:
+            metrics.observe("storebot_sql_seconds", (sql_label(sql),), time.perf_counter() - t0)
+
+def _api_failure(method_name, e):
+    code = getattr(e, "error_code", None)
+    metrics.inc("storebot_api_errors_total", (method_name, str(code) if code else type(e).__name__))
+
+def timed_request(make_request):
+    # يلف apihelper._make_request: كل طلبات Bot API المتزامنة تمر منها
+    def call(token, method_name, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except Exception as e:
+            _api_failure(method_name, e)
+            raise
+        finally:
+            metrics.observe("storebot_api_seconds", (method_name,), time.perf_counter() - t0)
+    return call
+
+def timed_async_request(process_request):
+    # نفس الشيء لـ asyncio_helper._process_request في وضع async
+    async def call(token, url, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await process_request(token, url, *args, **kwargs)
+        except Exception as e:
+            _api_failure(url, e)
+            raise
+        finally:
+            metrics.observe("storebot_api_seconds", (url,), time.perf_counter() - t0)
+    return call
+
+apihelper._make_request = timed_request(apihelper._make_request)
+
+class MetricsMiddleware(BaseMiddleware):
+    # أول طبقة: تقيس زمن التحديث كاملاً (بقية الطبقات + المعالج)
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query", "inline_query"]
+
+    def pre_process(self, update, data):
+        data["metrics_t0"] = time.perf_counter()
+        data["metrics_handler"] = update_label(update)
+
+    def post_process(self, update, data, exception):
+        metrics.observe("storebot_update_seconds", (data["metrics_handler"],), time.perf_counter() - data["metrics_t0"])
+        if exception is not None:
+            metrics.inc("storebot_errors_total", (data["metrics_handler"],))
+
+def update_label(update):
+    if isinstance(update, types.CallbackQuery):
+        return "callback_query"
+    if isinstance(update, types.InlineQuery):
+        return "inline_query"
+    text = getattr(update, "text", None) or ""
+    if text.startswith("/"):
+        return text.split()[0].split("@")[0].lower()[:32]
+    st = states.get(update.from_user.id)
+    if st:
+        return f"state:{st[0]}"
+    return getattr(update, "content_type", None) or "text"
+
+bot.setup_middleware(MetricsMiddleware())
+
+def metrics_summary():
+    def ms(v):
+        return "∞" if v == float("inf") else f"{v * 1000:.0f}ms"
+    updates = metrics.snapshot("storebot_update_seconds")
+    lines = [f"📈 المقاييس — منذ {int(time.time() - metrics.started) // 60} دقيقة",
+             f"التحديثات: {sum(sum(h[:-1]) for h in updates.values())} — "
+             f"p50≈{ms(metrics.quantile('storebot_update_seconds', 0.5))} p95≈{ms(metrics.quantile('storebot_update_seconds', 0.95))}"]
+    routes = metrics.snapshot("storebot_callback_seconds")
+    slow = sorted(((h[-1] / max(1, sum(h[:-1])), key[0], sum(h[:-1])) for key, h in routes.items()), reverse=True)[:5]
+    if slow:
+        lines.append("أبطأ الأزرار (متوسط): " + "، ".join(f"{r} {avg * 1000:.1f}ms×{n}" for avg, r, n in slow))
+    sql = metrics.snapshot("storebot_sql_seconds")
+    heavy = sorted(((h[-1], key[0], sum(h[:-1])) for key, h in sql.items()), reverse=True)[:3]
+    lines.append(f"SQL: {sum(sum(h[:-1]) for h in sql.values())} استعلام، أخطاء {sum(metrics.snapshot('storebot_sql_errors_total').values())}")
+    for total, q, n in heavy:
+        lines.append(f"  {total * 1000:.0f}ms إجمالي ×{n}: {html.escape(q[:70])}")
+    api = metrics.snapshot("storebot_api_seconds")
+    errors = metrics.snapshot("storebot_api_errors_total")
+    by_code = {}
+    for (_, code), n in errors.items():
+        by_code[code] = by_code.get(code, 0) + n
+    lines.append(f"Bot API: {sum(sum(h[:-1]) for h in api.values())} طلب، p95≈{ms(metrics.quantile('storebot_api_seconds', 0.95))}، "
+                 f"أخطاء: {', '.join(f'{k}={v}' for k, v in sorted(by_code.items())) or 0} (429: {by_code.get('429', 0)})")
+    queues = {name: metrics.callbacks[name]() for name in ("storebot_writer_queue", "storebot_notifier_queue",
+                                                           "storebot_webhook_queue", "storebot_async_inflight")
+              if name in metrics.callbacks}
+    lines.append("الطوابير: " + "، ".join(f"{k.replace('storebot_', '')}={v}" for k, v in queues.items()))
+    f = flood.stats()
+    lines.append(f"الإغراق: مرفوض {f['dropped'] + f['muted_drops']}، كتم {f['mutes']} — الحظر: مرفوض {ban_gate.rejected}")
+    report = metrics.snapshot("storebot_errors_total")
+    if report:
+        lines.append("أخطاء: " + "، ".join(f"{k[0]}={v}" for k, v in sorted(report.items())))
+    return "\n".join(lines)
+
+_metrics_server = None
+
+class _MetricsHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = _MetricsHTTPServer((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"Metrics on http://{host}:{httpd.server_address[1]}/metrics")
+    return httpd
+
+DB_FILE = os.getenv("DB_FILE", "store_bot.db")
+DB_BUSY_TIMEOUT = 5000       # ms انتظار القفل قبل SQLITE_BUSY
+DB_STATEMENT_CACHE = 256     # عدد الاستعلامات المحضرة المحفوظة لكل اتصال
+
+# ---------------------------
+# طبقة الوصول لقاعدة البيانات (اتصال لكل خيط)
+# ---------------------------
+# telebot يشغل المعالجات على عدة خيوط؛ كل خيط يحصل على اتصاله الخاص
+# (WAL يسمح بالقراءة المتوازية مع الكتابة) والمعاملات محددة النطاق عبر transaction().
+_db_local = threading.local()
+# SQLite يقبل كاتباً واحداً؛ خيوط العملية تنتظر دورها على هذا القفل بدل تكرار
+# BEGIN IMMEDIATE حتى busy_timeout (تحت ضغط مئات الخيوط قد يتجاوز بعضها المهلة)
+_write_lock = threading.Lock()
+
+# توحيد النص العربي للبحث: حذف التشكيل والتطويل، وطي أشكال الألف والياء والتاء المربوطة
+# والأرقام الهندية؛ يطبق على النص المفهرس وعلى الاستعلام معاً (انظر قسم البحث)
+_AR_FOLD = str.maketrans({
+    **{chr(cp): None for cp in range(0x064B, 0x0653)},   # الحركات والتنوين والشدة والسكون
+    "\u0670": None, "\u0640": None,                      # الألف الخنجرية والتطويل
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ئ": "ي", "ؤ": "و", "ة": "ه",
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+})
+
+def normalize_ar(text):
+    return (text or "").lower().translate(_AR_FOLD)
+
+def _connect():
+    c = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT / 1000, isolation_level=None,
+                        cached_statements=DB_STATEMENT_CACHE, factory=TimedConnection)
+    c.create_function("ar_norm", 1, normalize_ar, deterministic=True)
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT}")
+    return c
+
+def db():
+    c = getattr(_db_local, "conn", None)
+    if c is None:
+        c = _db_local.conn = _connect()
+        _db_local.depth = 0
+    return c
+
+def close_db():
+    # لخيوط الخلفية قصيرة العمر
+    c = getattr(_db_local, "conn", None)
+    if c is not None:
+        c.close()
+        _db_local.conn = None
+
+@contextmanager
+def transaction():
+    # معاملة واحدة (BEGIN IMMEDIATE ... COMMIT)؛ المعاملات المتداخلة تنضم للخارجية
+    c = db()
+    if _db_local.depth:
+        _db_local.depth += 1
+        try:
+            yield c
+        finally:
+            _db_local.depth -= 1
+        return
+    with _write_lock:
+        c.execute("BEGIN IMMEDIATE")
+        _db_local.depth = 1
+        try:
+            yield c
+            c.execute("COMMIT")
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        finally:
+            _db_local.depth = 0
+
+@contextmanager
+def read_transaction():
+    # قراءة متسقة لعدة جداول: BEGIN مؤجل يأخذ لقطة WAL دون _write_lock ولا حجز الكاتب
+    c = db()
+    if _db_local.depth:
+        yield c
+        return
+    c.execute("BEGIN")
+    try:
+        yield c
+    finally:
+        c.execute("COMMIT")
+
+def db_one(sql, params=()):
+    return db().execute(sql, params).fetchone()
 
-DB_FILE = "store_bot.db"
-conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-cur = conn.cursor()
+def db_all(sql, params=()):
+    return db().execute(sql, params).fetchall()
+
+def db_exec(sql, params=()):
+    # تنفيذ مع commit تلقائي (خارج أي معاملة)؛ يرجع المؤشر لقراءة lastrowid/rowcount
+    return db().execute(sql, params)
 
 # ---------------------------
-# إنشاء جداول قاعدة البيانات (إذا لم تكن موجودة)
+# مخطط قاعدة البيانات وترحيلاته (PRAGMA user_version)
 # ---------------------------
+# كل ترحيل يطبق مرة واحدة داخل معاملة ثم يرفع user_version؛
+# لتعديل المخطط أضف عنصراً جديداً في آخر القائمة ولا تعدل الترحيلات القديمة.
+MIGRATIONS = [
+    # 1: المخطط الأساسي
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            balance REAL DEFAULT 0,
+            vip INTEGER DEFAULT 0,
+            banned INTEGER DEFAULT 0,
+            created_at TEXT
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            pos INTEGER DEFAULT 0
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category_id INTEGER,
+            name TEXT,
+            price REAL,
+            description TEXT,
+            pos INTEGER DEFAULT 0,
+            FOREIGN KEY(category_id) REFERENCES categories(id)
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS buttons (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            parent_type TEXT, -- 'category' or 'product' or 'global'
+            parent_id INTEGER,
+            text TEXT,
+            action TEXT, -- 'open_url' or 'buy'
+            payload TEXT
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            product_id INTEGER,
+            price REAL,
+            status TEXT,
+            created_at TEXT
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS deposits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount_syp REAL,
+            credits INTEGER,
+            status TEXT, -- pending/confirmed/cancelled
+            created_at TEXT
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS admin_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            action TEXT,
+            created_at TEXT
+        )""",
+        # مهام البث: كل مهمة تحفظ تقدمها حتى يمكن استئنافها بعد إعادة التشغيل
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            chat_id INTEGER,
+            progress_msg_id INTEGER,
+            text TEXT,
+            status TEXT, -- running/done
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at TEXT,
+            finished_at TEXT
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_targets (
+            job_id INTEGER,
+            user_id INTEGER,
+            status TEXT, -- pending/sent/failed
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID""",
+        # حالات انتظار المستخدمين (نسخة احتياطية لمخزن الحالات في الذاكرة)
+        """
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            expires_at REAL
+        )""",
+    ]),
+    # 2: فهارس المسارات الساخنة
+    (2, [
+        # منتجات القسم مرتبة (تحميل الكتالوج)
+        "CREATE INDEX IF NOT EXISTS idx_products_category ON products (category_id, pos, id)",
+        # طلبات المستخدم الأحدث أولاً
+        "CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id, id)",
+        # طلبات الإيداع حسب الحالة الأحدث أولاً
+        "CREATE INDEX IF NOT EXISTS idx_deposits_status ON deposits (status, id)",
+        # قائمة المستخدمين الأحدث أولاً
+        "CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)",
+        # استئناف البث عند التشغيل
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status)",
+    ]),
+    # 3: إحصائيات محدثة تلقائياً (عدادات + تجميع يومي) عبر triggers
+    (3, [
+        """
+        CREATE TABLE IF NOT EXISTS stats (
+            key TEXT PRIMARY KEY,
+            value REAL DEFAULT 0
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY, -- YYYY-MM-DD (UTC)
+            orders INTEGER DEFAULT 0,
+            revenue REAL DEFAULT 0,
+            deposits_confirmed INTEGER DEFAULT 0,
+            deposit_credits INTEGER DEFAULT 0,
+            new_users INTEGER DEFAULT 0
+        )""",
+        # تعبئة أولية من البيانات الموجودة
+        """
+        INSERT OR REPLACE INTO stats (key, value) VALUES
+            ('users', (SELECT COUNT(*) FROM users)),
+            ('orders', (SELECT COUNT(*) FROM orders)),
+            ('revenue', (SELECT COALESCE(SUM(price), 0) FROM orders)),
+            ('balance_total', (SELECT COALESCE(SUM(balance), 0) FROM users))""",
+        """
+        INSERT INTO daily_stats (day, new_users)
+        SELECT substr(created_at, 1, 10), COUNT(*) FROM users WHERE created_at IS NOT NULL GROUP BY 1
+        ON CONFLICT(day) DO UPDATE SET new_users = excluded.new_users""",
+        """
+        INSERT INTO daily_stats (day, orders, revenue)
+        SELECT substr(created_at, 1, 10), COUNT(*), SUM(price) FROM orders WHERE created_at IS NOT NULL GROUP BY 1
+        ON CONFLICT(day) DO UPDATE SET orders = excluded.orders, revenue = excluded.revenue""",
+        """
+        INSERT INTO daily_stats (day, deposits_confirmed, deposit_credits)
+        SELECT substr(created_at, 1, 10), COUNT(*), SUM(credits) FROM deposits WHERE status = 'confirmed' AND created_at IS NOT NULL GROUP BY 1
+        ON CONFLICT(day) DO UPDATE SET deposits_confirmed = excluded.deposits_confirmed, deposit_credits = excluded.deposit_credits""",
+        # كل مسارات الكتابة (ensure_user، الشراء، set_balance، تأكيد الإيداع...) تمر عبر هذه triggers
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_insert AFTER INSERT ON users BEGIN
+            UPDATE stats SET value = value + 1 WHERE key = 'users';
+            UPDATE stats SET value = value + COALESCE(NEW.balance, 0) WHERE key = 'balance_total';
+            INSERT INTO daily_stats (day, new_users) VALUES (date('now'), 1)
+            ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1;
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_delete AFTER DELETE ON users BEGIN
+            UPDATE stats SET value = value - 1 WHERE key = 'users';
+            UPDATE stats SET value = value - COALESCE(OLD.balance, 0) WHERE key = 'balance_total';
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_balance AFTER UPDATE OF balance ON users BEGIN
+            UPDATE stats SET value = value + COALESCE(NEW.balance, 0) - COALESCE(OLD.balance, 0) WHERE key = 'balance_total';
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_orders_insert AFTER INSERT ON orders BEGIN
+            UPDATE stats SET value = value + 1 WHERE key = 'orders';
+            UPDATE stats SET value = value + COALESCE(NEW.price, 0) WHERE key = 'revenue';
+            INSERT INTO daily_stats (day, orders, revenue) VALUES (date('now'), 1, COALESCE(NEW.price, 0))
+            ON CONFLICT(day) DO UPDATE SET orders = orders + 1, revenue = revenue + excluded.revenue;
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_deposit_confirmed AFTER UPDATE OF status ON deposits
+        WHEN NEW.status = 'confirmed' AND OLD.status IS NOT 'confirmed' BEGIN
+            INSERT INTO daily_stats (day, deposits_confirmed, deposit_credits) VALUES (date('now'), 1, COALESCE(NEW.credits, 0))
+            ON CONFLICT(day) DO UPDATE SET deposits_confirmed = deposits_confirmed + 1,
+                                           deposit_credits = deposit_credits + excluded.deposit_credits;
+        END""",
+    ]),
+    # 4: فهرس جزئي لتحميل قائمة المحظورين عند التشغيل دون مرور على كل المستخدمين
+    (4, [
+        "CREATE INDEX IF NOT EXISTS idx_users_banned ON users (user_id) WHERE banned = 1",
+    ]),
+    # 5: دفتر أرصدة بوحدات صغرى صحيحة (1 كريديت = 100)؛ users.balance_minor هو الرصيد الوحيد المخزن
+    # (عمود REAL القديم يحذف). إجمالي الأرصدة في stats.balance_total_minor يحدثه apply_balance
+    # في نفس معاملة الحركة بدل trigger على كل UPDATE للمستخدم
+    (5, [
+        "DROP TRIGGER IF EXISTS trg_stats_users_insert",
+        "DROP TRIGGER IF EXISTS trg_stats_users_delete",
+        "DROP TRIGGER IF EXISTS trg_stats_users_balance",
+        "ALTER TABLE users ADD COLUMN balance_minor INTEGER NOT NULL DEFAULT 0",
+        "UPDATE users SET balance_minor = CAST(ROUND(COALESCE(balance, 0) * 100) AS INTEGER)",
+        "ALTER TABLE users DROP COLUMN balance",
+        """
+        CREATE TABLE IF NOT EXISTS balance_entries (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL, -- وحدات صغرى، موجب = إضافة
+            kind TEXT NOT NULL, -- deposit / purchase / admin / set
+            ref TEXT,
+            created_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_balance_entries_user ON balance_entries (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_balance_entries_created ON balance_entries (created_at)",
+        # ملخص القيود المدمجة: الرصيد = balance + مجموع القيود المتبقية للمستخدم
+        """
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER NOT NULL,
+            upto_id INTEGER NOT NULL,
+            updated_at TEXT
+        )""",
+        # الأرصدة الحالية تصبح رصيداً افتتاحياً
+        """
+        INSERT INTO balance_snapshots (user_id, balance, upto_id, updated_at)
+        SELECT user_id, balance_minor, 0, datetime('now') FROM users WHERE balance_minor != 0""",
+        "DELETE FROM stats WHERE key = 'balance_total'",
+        "INSERT OR REPLACE INTO stats (key, value) VALUES ('balance_total_minor', (SELECT COALESCE(SUM(balance_minor), 0) FROM users))",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_insert AFTER INSERT ON users BEGIN
+            UPDATE stats SET value = value + 1 WHERE key = 'users';
+            UPDATE stats SET value = value + NEW.balance_minor WHERE key = 'balance_total_minor';
+            INSERT INTO daily_stats (day, new_users) VALUES (date('now'), 1)
+            ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1;
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_delete AFTER DELETE ON users BEGIN
+            UPDATE stats SET value = value - 1 WHERE key = 'users';
+            UPDATE stats SET value = value - OLD.balance_minor WHERE key = 'balance_total_minor';
+        END""",
+    ]),
+    # 6: فهرس بحث FTS5 لأسماء المنتجات ووصفها (نص موحد عبر ar_norm؛ rowid = products.id)
+    # المزامنة من دوال CRUD وليس triggers: ar_norm دالة Python غير متاحة لأدوات sqlite الأخرى
+    (6, [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5 (name, description, tokenize = 'unicode61 remove_diacritics 2')",
+        "INSERT INTO products_fts (rowid, name, description) SELECT id, ar_norm(name), ar_norm(description) FROM products",
+    ]),
+    # 7: فهارس created_at لإيجاد الصفوف القديمة المراد أرشفتها دون مسح الجداول (انظر قسم الأرشفة)
+    (7, [
+        "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_deposits_created ON deposits (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_admin_log_created ON admin_log (created_at)",
+    ]),
+]
+
+def migrate():
+    current = db_one("PRAGMA user_version")[0]
+    for version, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        with transaction() as c:
+            for sql in statements:
+                c.execute(sql)
+            c.execute(f"PRAGMA user_version = {version}")
+        print(f"DB migrated to version {version}")
+
+def incremental_vacuum_enabled():
+    # الصفحات التي تحررها الأرشفة تعاد للنظام على دفعات صغيرة (PRAGMA incremental_vacuum)
+    # بدلاً من VACUUM كامل يقفل القاعدة
+    c = db()
+    c.execute("PRAGMA schema_version")   # يعيد قراءة ترويسة الملف (قد يكون /vacuum_setup غيرها من اتصال آخر)
+    return c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
 def init_db():
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        first_name TEXT,
-        balance REAL DEFAULT 0,
-        vip INTEGER DEFAULT 0,
-        banned INTEGER DEFAULT 0,
-        created_at TEXT
-    )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS settings (
-        key TEXT PRIMARY KEY,
-        value TEXT
-    )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS categories (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        pos INTEGER DEFAULT 0
-    )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS products (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        category_id INTEGER,
-        name TEXT,
-        price REAL,
-        description TEXT,
-        pos INTEGER DEFAULT 0,
-        FOREIGN KEY(category_id) REFERENCES categories(id)
-    )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS buttons (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        parent_type TEXT, -- 'category' or 'product' or 'global'
-        parent_id INTEGER,
-        text TEXT,
-        action TEXT, -- 'open_url' or 'buy'
-        payload TEXT
-    )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS orders (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        product_id INTEGER,
-        price REAL,
-        status TEXT,
-        created_at TEXT
-    )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS deposits (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        amount_syp REAL,
-        credits INTEGER,
-        status TEXT, -- pending/confirmed/cancelled
-        created_at TEXT
-    )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS admin_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        admin_id INTEGER,
-        action TEXT,
-        created_at TEXT
-    )""")
-    # إعدادات افتراضية
-    cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("welcome_msg", "أهلاً بك في المتجر الرقمي! استخدم الأزرار لتصفح.")) 
-    cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("syp_rate", "2500"))  # مثال: 1 credit = 2500 SYP
-    cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("min_deposit", "1"))
-    conn.commit()
+    c = db()
+    if not c.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+        # ملف جديد بلا جداول: يحول مرة واحدة هنا (VACUUM على قاعدة فارغة فوري)؛
+        # _connect يضبط إعدادات الاتصال فقط
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        c.execute("VACUUM")
+    if not incremental_vacuum_enabled():
+        # قاعدة قديمة: التحويل يحتاج VACUUM كاملاً يقفل القاعدة، فلا يجري تلقائياً عند التشغيل
+        print("incremental auto_vacuum غير مفعل: الأرشفة لن تعيد المساحة للنظام حتى يشغل الأدمن /vacuum_setup")
+    migrate()
+    with transaction() as c:
+        # إعدادات افتراضية
+        c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("welcome_msg", "أهلاً بك في المتجر الرقمي! استخدم الأزرار لتصفح.")) 
+        c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("syp_rate", "2500"))  # مثال: 1 credit = 2500 SYP
+        c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("min_deposit", "1"))
+        # مفاتيح الانتظار القديمة (awaiting_*) أصبحت في user_state
+        c.execute("DELETE FROM settings WHERE key LIKE 'awaiting!_%' ESCAPE '!'")
 
 init_db()
 
+# ---------------------------
+# كاتب في الخلفية (write-behind) للكتابات غير الحرجة
+# ---------------------------
+# تسجيل المستخدمين وسجل الأدمن والإعدادات وحالات الانتظار لا تحتاج commit فوري؛
+# تجمع في طابور محدود وتكتب دفعة واحدة كل بضعة ميلي ثوانٍ أو كل N صف.
+WRITE_BEHIND_MAX_QUEUE = 10000   # عند الامتلاء ينتظر المرسل (backpressure)
+WRITE_BEHIND_BATCH = 500         # أقصى عدد صفوف في commit واحد
+WRITE_BEHIND_INTERVAL = 0.005    # ثوانٍ لانتظار تجميع الدفعة
+
+class WriteBehind:
+    def __init__(self, max_queue=WRITE_BEHIND_MAX_QUEUE, batch=WRITE_BEHIND_BATCH, interval=WRITE_BEHIND_INTERVAL):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch = batch
+        self.interval = interval
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self.thread.start()
+
+    def submit(self, sql, params=()):
+        if self.thread is None:
+            self.start()
+        self.queue.put((sql, params))
+
+    def flush(self):
+        # ينتظر حتى تكتب كل العناصر الموجودة في الطابور
+        if self.thread is not None:
+            self.queue.join()
+
+    def stop(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        try:
+            stop = False
+            while not stop:
+                item = self.queue.get()
+                if item is None:
+                    self.queue.task_done()
+                    break
+                items = [item]
+                deadline = time.monotonic() + self.interval
+                while len(items) < self.batch:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        nxt = self.queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if nxt is None:
+                        self.queue.task_done()
+                        stop = True
+                        break
+                    items.append(nxt)
+                self._write(items)
+                for _ in items:
+                    self.queue.task_done()
+        finally:
+            close_db()
+
+    def _write(self, items):
+        try:
+            with transaction() as c:
+                for sql, params in items:
+                    c.execute(sql, params)
+        except Exception:
+            # صف واحد معطوب لا يجب أن يضيع الدفعة كاملة
+            report_error("write_behind")
+            for sql, params in items:
+                try:
+                    db_exec(sql, params)
+                except Exception:
+                    report_error("write_behind")
+
+writer = WriteBehind()
+metrics.gauge("storebot_writer_queue", "Statements waiting in the write-behind queue", lambda: writer.queue.qsize())
+
+# ---------------------------
+# دفتر الأرصدة (ledger): قيود لا تعدل + رصيد مخزن لكل مستخدم
+# ---------------------------
+MINOR_UNITS = 100              # 1 كريديت = 100 وحدة صغرى (أعداد صحيحة بلا انجراف float)
+LEDGER_COMPACT_DAYS = 30       # القيود الأقدم تدمج في balance_snapshots
+LEDGER_COMPACT_BATCH = 5000    # قيود لكل معاملة دمج (لا نحجز قفل الكتابة طويلاً)
+LEDGER_COMPACT_EVERY = 6 * 3600
+
+def to_minor(amount):
+    return int((Decimal(str(amount)) * MINOR_UNITS).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def from_minor(value):
+    return (value or 0) / MINOR_UNITS
+
+def apply_balance(c, user_id, amount_minor, require_funds=False):
+    # يستدعى داخل transaction(). يعدل الرصيد المخزن فقط؛ False إذا لم يوجد المستخدم أو لم يكفِ الرصيد
+    sql = "UPDATE users SET balance_minor = balance_minor + ? WHERE user_id = ?"
+    params = (amount_minor, user_id)
+    if require_funds:
+        sql += " AND balance_minor + ? >= 0"
+        params += (amount_minor,)
+    if not c.execute(sql, params).rowcount:
+        return False
+    c.execute("UPDATE stats SET value = value + ? WHERE key = 'balance_total_minor'", (amount_minor,))
+    return True
+
+def insert_entry(c, user_id, amount_minor, kind, ref=None):
+    # القيد يكتب مرة واحدة بمرجعه النهائي ولا يعدل بعدها
+    return c.execute("INSERT INTO balance_entries (user_id, amount, kind, ref, created_at) VALUES (?, ?, ?, ?, ?)",
+                     (user_id, amount_minor, kind, ref, datetime.utcnow().isoformat())).lastrowid
+
+def post_entry(c, user_id, amount_minor, kind, ref=None, require_funds=False):
+    # يستدعى داخل transaction(). يعيد id القيد، أو None إذا لم يوجد المستخدم أو لم يكفِ الرصيد
+    if not apply_balance(c, user_id, amount_minor, require_funds):
+        return None
+    return insert_entry(c, user_id, amount_minor, kind, ref)
+
+def post_entries(c, entries):
+    # نسخة الدفعات من post_entry: entries = [(user_id, amount_minor, kind, ref), ...]
+    # تحديث واحد لكل مستخدم (مجموع مبالغه) + إدراج كل القيود بـ executemany
+    now = datetime.utcnow().isoformat()
+    totals = {}
+    for user_id, amount, _, _ in entries:
+        totals[user_id] = totals.get(user_id, 0) + amount
+    c.executemany("INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)", [(u, now) for u in totals])
+    c.executemany("UPDATE users SET balance_minor = balance_minor + ? WHERE user_id = ?",
+                  [(t, u) for u, t in totals.items()])
+    c.execute("UPDATE stats SET value = value + ? WHERE key = 'balance_total_minor'", (sum(totals.values()),))
+    c.executemany("INSERT INTO balance_entries (user_id, amount, kind, ref, created_at) VALUES (?, ?, ?, ?, ?)",
+                  [(u, a, kind, ref, now) for u, a, kind, ref in entries])
+
+def compact_ledger(days=LEDGER_COMPACT_DAYS, batch=LEDGER_COMPACT_BATCH):
+    # يدمج القيود الأقدم من days في رصيد افتتاحي لكل مستخدم ثم يحذفها، على دفعات
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    upto = db_one("SELECT MAX(id) FROM balance_entries WHERE created_at < ?", (cutoff,))[0]
+    compacted = 0
+    while upto:
+        with transaction() as c:
+            first = c.execute("SELECT MIN(id) FROM balance_entries").fetchone()[0]
+            if first is None or first > upto:
+                break
+            last = min(upto, first + batch - 1)
+            c.execute("""
+                INSERT INTO balance_snapshots (user_id, balance, upto_id, updated_at)
+                SELECT user_id, SUM(amount), ?, ? FROM balance_entries WHERE id BETWEEN ? AND ? GROUP BY user_id
+                ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance,
+                                                   upto_id = excluded.upto_id, updated_at = excluded.updated_at""",
+                      (last, datetime.utcnow().isoformat(), first, last))
+            compacted += c.execute("DELETE FROM balance_entries WHERE id BETWEEN ? AND ?", (first, last)).rowcount
+    return compacted
+
+def reconcile(limit=20):
+    # الرصيد المخزن يجب أن يساوي الرصيد الافتتاحي + مجموع القيود المتبقية
+    return db_all("""
+        SELECT user_id, balance_minor, ledger FROM (
+            SELECT u.user_id, u.balance_minor,
+                   COALESCE(s.balance, 0) + COALESCE((SELECT SUM(e.amount) FROM balance_entries e WHERE e.user_id = u.user_id), 0) AS ledger
+            FROM users u LEFT JOIN balance_snapshots s ON s.user_id = u.user_id
+        ) WHERE balance_minor != ledger LIMIT ?""", (limit,))
+
+def ledger_entries(user_id, limit=15):
+    return db_all("SELECT id, amount, kind, ref, created_at FROM balance_entries WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                  (user_id, limit))
+
+# مهام دورية في الخلفية (الدمج وغيره)
+# آخر تشغيل ناجح يحفظ في settings (periodic_last:<name>)، فالجدول يحسب من آخر تشغيل لا من بدء العملية:
+# بوت يعاد تشغيله أكثر من مرة كل interval لا يفوت المهمة، والمهمة المتأخرة تعمل فوراً عند البدء
+_periodic = {}
+
+def last_periodic_run(name):
+    return float(get_setting(f"periodic_last:{name}", "0"))
+
+def run_periodic(name, interval, fn, *args, last_run=None):
+    # last_run: دالة تعيد وقت آخر تشغيل (epoch) إن كان للمهمة أثر أدق من الإعداد (مثل ملفات النسخ)
+    if name in _periodic:
+        return _periodic[name]
+
+    def loop():
+        last = max(last_periodic_run(name), last_run() if last_run else 0)
+        delay = max(0.0, last + interval - time.time())
+        while True:
+            time.sleep(delay)
+            delay = interval
+            try:
+                fn(*args)
+                set_setting(f"periodic_last:{name}", round(time.time()))
+            except Exception:
+                report_error(name)
+            finally:
+                close_db()
+
+    t = _periodic[name] = threading.Thread(target=loop, name=name, daemon=True)
+    t.start()
+    return t
+
 # ---------------------------
 # وظائف مساعدة عامة
 # ---------------------------
 def log_admin(action):
-    cur.execute("INSERT INTO admin_log (admin_id, action, created_at) VALUES (?, ?, ?)", (ADMIN_ID, action, datetime.utcnow().isoformat()))
-    conn.commit()
+    writer.submit("INSERT INTO admin_log (admin_id, action, created_at) VALUES (?, ?, ?)", (ADMIN_ID, action, datetime.utcnow().isoformat()))
 
 def ensure_user(user):
-    cur.execute("INSERT OR IGNORE INTO users (user_id, username, first_name, created_at) VALUES (?, ?, ?, ?)",
-                (user.id, getattr(user, "username", "") or "", getattr(user, "first_name", "") or "", datetime.utcnow().isoformat()))
-    conn.commit()
+    writer.submit("INSERT OR IGNORE INTO users (user_id, username, first_name, created_at) VALUES (?, ?, ?, ?)",
+                  (user.id, getattr(user, "username", "") or "", getattr(user, "first_name", "") or "", datetime.utcnow().isoformat()))
 
 def is_admin(user_id):
     return int(user_id) == int(ADMIN_ID)
 
+# الإعدادات تقرأ من الذاكرة بعد أول قراءة؛ الكتابة تحدث الذاكرة فوراً ثم القاعدة في الخلفية
+_settings_cache = {}
+
 def get_setting(key, default=None):
-    cur.execute("SELECT value FROM settings WHERE key = ?", (key,))
-    r = cur.fetchone()
-    return r[0] if r else default
+    if key not in _settings_cache:
+        r = db_one("SELECT value FROM settings WHERE key = ?", (key,))
+        _settings_cache[key] = r[0] if r else None
+    v = _settings_cache[key]
+    return v if v is not None else default
 
 def set_setting(key, value):
-    cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
-    conn.commit()
+    _settings_cache[key] = str(value)
+    writer.submit("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
+
+def write_setting(c, key, value):
+    # نسخة المعاملة من set_setting: تكتب مع بقية المعاملة، والمستدعي يحدث _settings_cache بعد COMMIT
+    c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
 
 def get_balance(user_id):
-    cur.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-    r = cur.fetchone()
-    return float(r[0]) if r else 0.0
+    r = db_one("SELECT balance_minor FROM users WHERE user_id = ?", (user_id,))
+    return from_minor(r[0]) if r else 0.0
 
 def set_balance(user_id, amount):
-    cur.execute("INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)", (user_id, datetime.utcnow().isoformat()))
-    cur.execute("UPDATE users SET balance = ? WHERE user_id = ?", (float(amount), user_id))
-    conn.commit()
-
-def change_balance(user_id, delta):
-    bal = get_balance(user_id)
-    set_balance(user_id, bal + float(delta))
+    # قيد بالفرق بين الرصيد الحالي والمطلوب
+    with transaction() as c:
+        c.execute("INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)", (user_id, datetime.utcnow().isoformat()))
+        current = c.execute("SELECT balance_minor FROM users WHERE user_id = ?", (user_id,)).fetchone()[0]
+        delta = to_minor(amount) - current
+        if delta:
+            post_entry(c, user_id, delta, "set")
+
+def change_balance(user_id, delta, kind="admin", ref=None):
+    # قيد جديد + تحديث ذري للرصيد المخزن في نفس المعاملة
+    with transaction() as c:
+        c.execute("INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)", (user_id, datetime.utcnow().isoformat()))
+        post_entry(c, user_id, to_minor(delta), kind, ref)
 
 def ban_user(user_id):
-    cur.execute("INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)", (user_id, datetime.utcnow().isoformat()))
-    cur.execute("UPDATE users SET banned = 1 WHERE user_id = ?", (user_id,))
-    conn.commit()
+    with transaction() as c:
+        c.execute("INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)", (user_id, datetime.utcnow().isoformat()))
+        c.execute("UPDATE users SET banned = 1 WHERE user_id = ?", (user_id,))
+    _banned.add(user_id)
 
 def unban_user(user_id):
-    cur.execute("UPDATE users SET banned = 0 WHERE user_id = ?", (user_id,))
-    conn.commit()
+    db_exec("UPDATE users SET banned = 0 WHERE user_id = ?", (user_id,))
+    _banned.discard(user_id)
 
 def is_banned(user_id):
-    cur.execute("SELECT banned FROM users WHERE user_id = ?", (user_id,))
-    r = cur.fetchone()
-    return bool(r and r[0] == 1)
+    return user_id in _banned
 
 def fmt_currency(amount):
     try:
@@ -189,12 +1025,16 @@ def fmt_currency(amount):
     except:
         return f"{amount} {CURRENCY}"
 
+def product_text(name, price, desc):
+    return f"🔹 <b>{name}</b>\nالسعر: {fmt_currency(price)}\n\n{desc or ''}"
+
 # ---------------------------
 # لوحات وأزرار (Inline - شفافة)
 # ---------------------------
 def user_main_keyboard():
     kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("🛒 الأقسام", callback_data="menu_sections"))
+    kb.add(types.InlineKeyboardButton("🛒 الأقسام", callback_data="menu_sections"),
+           types.InlineKeyboardButton("🔎 بحث", switch_inline_query_current_chat=""))
     kb.add(types.InlineKeyboardButton("💰 رصيدي", callback_data="menu_balance"),
            types.InlineKeyboardButton("➕ شحن/إيداع", callback_data="menu_deposit"))
     kb.add(types.InlineKeyboardButton("📦 طلباتي", callback_data="menu_orders"),
@@ -212,31 +1052,301 @@ def admin_main_keyboard():
     kb.add(types.InlineKeyboardButton("🔘 إدارة الأزرار", callback_data="adm_buttons"))
     return kb
 
-def categories_keyboard():
+# صفحات الأقسام والمنتجات: حد تيليجرام 100 زر لكل رسالة، واللوحة الكبيرة بطيئة الإرسال والعرض.
+# callback_data يحمل رقم الصفحة فقط ("cat:<cid>:<page>" / "secs:<page>") فيبقى أقل بكثير من 64 بايت
+CATALOG_PAGE_SIZE = max(1, int(os.getenv("CATALOG_PAGE_SIZE", "10")))   # أزرار لكل صفحة
+
+def page_count(n):
+    return max(1, -(-n // CATALOG_PAGE_SIZE))
+
+def _page_nav(kb, page, pages, data):
+    # data: بادئة callback_data تضاف لها رقم الصفحة
+    nav = []
+    if page > 0:
+        nav.append(types.InlineKeyboardButton("◀ السابق", callback_data=f"{data}{page - 1}"))
+    if pages > 1:
+        nav.append(types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+    if page < pages - 1:
+        nav.append(types.InlineKeyboardButton("التالي ▶", callback_data=f"{data}{page + 1}"))
+    if nav:
+        kb.row(*nav)
+
+def _categories_markup(categories, page=0):
     kb = types.InlineKeyboardMarkup()
-    cur.execute("SELECT id, name FROM categories ORDER BY pos ASC, id ASC")
-    for cid, name in cur.fetchall():
+    start = page * CATALOG_PAGE_SIZE
+    for cid, name in categories[start:start + CATALOG_PAGE_SIZE]:
         kb.add(types.InlineKeyboardButton(name, callback_data=f"cat:{cid}"))
+    _page_nav(kb, page, page_count(len(categories)), "secs:")
     kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
     return kb
 
-def products_keyboard(cat_id):
+def _products_markup(rows, cid=0, page=0, back="menu_sections"):
     kb = types.InlineKeyboardMarkup()
-    cur.execute("SELECT id, name, price FROM products WHERE category_id = ? ORDER BY pos ASC, id ASC", (cat_id,))
-    rows = cur.fetchall()
     if not rows:
         kb.add(types.InlineKeyboardButton("القسم فارغ", callback_data="no_products"))
-    for pid, name, price in rows:
+    start = page * CATALOG_PAGE_SIZE
+    for pid, name, price in rows[start:start + CATALOG_PAGE_SIZE]:
         kb.add(types.InlineKeyboardButton(f"{name} — {fmt_currency(price)}", callback_data=f"prod:{pid}"))
-    kb.add(types.InlineKeyboardButton("🔙 الأقسام", callback_data="menu_sections"))
+    _page_nav(kb, page, page_count(len(rows)), f"cat:{cid}:")
+    kb.add(types.InlineKeyboardButton("🔙 الأقسام", callback_data=back))
     return kb
 
-def product_detail_keyboard(pid):
+def product_detail_keyboard(pid, back="menu_sections"):
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("🛒 شراء الآن", callback_data=f"buy:{pid}"),
-           types.InlineKeyboardButton("🔙 العودة", callback_data="menu_sections"))
+           types.InlineKeyboardButton("🔙 العودة", callback_data=back))
     return kb
 
+# ---------------------------
+# نسخة الكتالوج في الذاكرة (snapshot) مع لوحات جاهزة
+# ---------------------------
+# التصفح يقرأ من نسخة ثابتة لا تتغير؛ أي تعديل على الأقسام/المنتجات
+# يبني نسخة جديدة برقم إصدار أعلى ويستبدل المرجع دفعة واحدة.
+class CatalogSnapshot:
+    def __init__(self, version, categories, products):
+        self.version = version
+        self.categories = tuple(categories)                    # ((cid, name), ...)
+        self.category_names = dict(self.categories)
+        self.category_index = {cid: i for i, (cid, _) in enumerate(self.categories)}
+        self.products = {}                                     # pid -> (cid, name, price, description)
+        self.by_category = {cid: [] for cid, _ in self.categories}   # cid -> [(pid, name, price), ...] بالترتيب
+        self.position = {}                                     # pid -> ترتيبه داخل قسمه
+        for pid, cid, name, price, desc in products:
+            self.products[pid] = (cid, name, float(price or 0), desc)
+            rows = self.by_category.setdefault(cid, [])
+            self.position[pid] = len(rows)
+            rows.append((pid, name, price))
+        # لوحات مسلسلة (JSON) تبنى عند أول طلب لكل صفحة وتبقى ما بقيت النسخة؛
+        # فتح صفحة من قسم فيه 5000 منتج يكلف ما يكلفه قسم فيه 5
+        self._keyboards = {}
+        # نص موحد للبحث الاحتياطي في الذاكرة عند تجاوز ميزانية FTS (انظر search_products)
+        self.search_text = {pid: normalize_ar(f"{p[1]} {p[3] or ''}").split() for pid, p in self.products.items()}
+
+    def _memo(self, key, build):
+        kb = self._keyboards.get(key)
+        if kb is None:
+            # سباق بين خيطين يبني اللوحة نفسها مرتين فقط؛ النتيجة واحدة
+            kb = self._keyboards[key] = build().to_json()
+        return kb
+
+    def categories_page(self, page):
+        page = min(max(page, 0), page_count(len(self.categories)) - 1)
+        return self._memo(("secs", page), lambda: _categories_markup(self.categories, page))
+
+    def products_page(self, cid, page):
+        rows = self.by_category.get(cid, [])
+        page = min(max(page, 0), page_count(len(rows)) - 1)
+        back = f"secs:{self.category_index.get(cid, 0) // CATALOG_PAGE_SIZE}"
+        return self._memo(("cat", cid, page), lambda: _products_markup(rows, cid, page, back))
+
+    def product_back(self, pid):
+        # زر العودة يرجع لصفحة القسم التي فيها المنتج
+        cid = self.products[pid][0]
+        return f"cat:{cid}:{self.position[pid] // CATALOG_PAGE_SIZE}"
+
+    def product_keyboard(self, pid):
+        return self._memo(("prod", pid), lambda: product_detail_keyboard(pid, self.product_back(pid)))
+
+_catalog = None
+_catalog_version = 0
+_catalog_lock = threading.Lock()
+
+def _build_catalog(version):
+    # قراءة متسقة للجدولين من لقطة واحدة (لا توقف الكتّاب)
+    with read_transaction() as c:
+        categories = c.execute("SELECT id, name FROM categories ORDER BY pos ASC, id ASC").fetchall()
+        products = c.execute("SELECT id, category_id, name, price, description FROM products ORDER BY category_id, pos ASC, id ASC").fetchall()
+    return CatalogSnapshot(version, categories, products)
+
+def catalog():
+    global _catalog
+    snap = _catalog
+    if snap is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = _build_catalog(_catalog_version)
+            snap = _catalog
+    return snap
+
+def invalidate_catalog():
+    # يستدعى بعد أي تعديل على الأقسام أو المنتجات
+    global _catalog, _catalog_version
+    with _catalog_lock:
+        _catalog_version += 1
+        _catalog = _build_catalog(_catalog_version)
+
+def categories_keyboard(page=0):
+    return catalog().categories_page(page)
+
+def products_keyboard(cat_id, page=0):
+    return catalog().products_page(cat_id, page)
+
+# ---------------------------
+# بوابة الحظر: مجموعة في الذاكرة تفحص قبل أي معالج
+# ---------------------------
+_banned = set()
+
+def load_bans():
+    # يستخدم الفهرس الجزئي idx_users_banned (الترحيل 4)
+    _banned.update(r[0] for r in db_all("SELECT user_id FROM users WHERE banned = 1"))
+
+load_bans()
+
+class BanMiddleware(BaseMiddleware):
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query", "inline_query"]
+        self.rejected = 0
+
+    def pre_process(self, update, data):
+        uid = update.from_user.id
+        if uid not in _banned or is_admin(uid):
+            return
+        self.rejected += 1
+        # تنبيه واحد عند /start فقط؛ بقية التحديثات تسقط بصمت دون أي استدعاء
+        if isinstance(update, types.Message) and (update.text or "").startswith("/start"):
+            try:
+                bot.send_message(update.chat.id, "🚫 تم حظرك من استخدام البوت.")
+            except API_ERRORS:
+                pass
+        return CancelUpdate()
+
+    def post_process(self, update, data, exception):
+        pass
+
+ban_gate = BanMiddleware()
+metrics.gauge("storebot_ban_rejected_total", "Updates dropped by the ban gate", lambda: ban_gate.rejected, kind="counter")
+metrics.gauge("storebot_banned_users", "Size of the in-memory ban set", lambda: len(_banned))
+# بعد MetricsMiddleware (تقيس زمن كل تحديث بما فيه المرفوض) وقبل حماية الإغراق:
+# المحظور لا يستهلك رموزها
+bot.setup_middleware(ban_gate)
+
+# ---------------------------
+# حماية من الإغراق (flood control) قبل المعالجات
+# ---------------------------
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "2"))     # تحديثات/ثانية لكل مستخدم
+FLOOD_BURST = 6                                       # دفعة مسموحة قبل التقييد
+FLOOD_MUTE_AFTER = 15        # عدد التحديثات المرفوضة خلال نافذة واحدة قبل الكتم المؤقت
+FLOOD_WINDOW = 10            # ثوانٍ — نافذة عد المرفوضات
+FLOOD_MUTE_SECONDS = 60      # مدة الكتم الأولى؛ تتضاعف مع كل تكرار
+FLOOD_MUTE_MAX = 3600
+FLOOD_IDLE = 600             # حذف سجلات المستخدمين الخاملين من الذاكرة بعدها
+
+class FloodControl:
+    # سجل لكل مستخدم: [tokens, updated, window_start, window_drops, muted_until, strikes, last_seen]
+    # كل شيء في الذاكرة وتحت قفل واحد؛ لا قاعدة بيانات ولا استدعاءات API هنا
+    def __init__(self, rate=FLOOD_RATE, burst=FLOOD_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.users = {}
+        self.lock = threading.Lock()
+        self.next_sweep = time.monotonic() + FLOOD_IDLE
+        self.passed = 0
+        self.dropped = 0
+        self.muted_drops = 0
+        self.mutes = 0
+
+    def check(self, user_id):
+        # يعيد "ok" أو "drop" (تجاوز الحد) أو "mute" (بداية كتم جديد) أو "muted" (ما زال مكتوماً)
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_sweep:
+                self._sweep(now)
+            s = self.users.get(user_id)
+            if s is None:
+                s = self.users[user_id] = [float(self.burst), now, now, 0, 0.0, 0, now]
+            s[6] = now
+            if now < s[4]:
+                self.muted_drops += 1
+                return "muted"
+            s[0] = min(self.burst, s[0] + (now - s[1]) * self.rate)
+            s[1] = now
+            if s[0] >= 1:
+                s[0] -= 1
+                self.passed += 1
+                return "ok"
+            self.dropped += 1
+            if now - s[2] > FLOOD_WINDOW:
+                s[2], s[3] = now, 0
+            s[3] += 1
+            if s[3] < FLOOD_MUTE_AFTER:
+                return "drop"
+            s[5] += 1
+            s[3] = 0
+            s[4] = now + min(FLOOD_MUTE_MAX, FLOOD_MUTE_SECONDS * 2 ** (s[5] - 1))
+            self.mutes += 1
+            return "mute"
+
+    def mute_remaining(self, user_id):
+        with self.lock:
+            s = self.users.get(user_id)
+            return max(0, int(s[4] - time.monotonic())) if s else 0
+
+    def _sweep(self, now):
+        self.next_sweep = now + FLOOD_IDLE
+        for uid in [u for u, s in self.users.items() if now - s[6] > FLOOD_IDLE and now >= s[4]]:
+            del self.users[uid]
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            muted = sum(1 for s in self.users.values() if now < s[4])
+            return {"passed": self.passed, "dropped": self.dropped, "muted_drops": self.muted_drops,
+                    "mutes": self.mutes, "muted_now": muted, "tracked_users": len(self.users)}
+
+flood = FloodControl()
+metrics.gauge("storebot_flood", "Flood control counters (passed, dropped, muted_drops, mutes, muted_now, tracked_users)",
+              lambda: {(k,): v for k, v in flood.stats().items()}, ("kind",))
+
+class FloodMiddleware(BaseMiddleware):
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query"]
+
+    def pre_process(self, update, data):
+        uid = update.from_user.id
+        if is_admin(uid):
+            return
+        verdict = flood.check(uid)
+        if verdict == "ok":
+            return
+        if verdict == "drop" and isinstance(update, types.CallbackQuery):
+            # رد واحد يوقف مؤشر التحميل على الزر دون أي عمل آخر
+            try:
+                bot.answer_callback_query(update.id, "⏳ طلبات كثيرة، انتظر قليلاً.")
+            except API_ERRORS:
+                pass
+        elif isinstance(update, types.CallbackQuery):
+            # المكتوم: رد فارغ يوقف مؤشر التحميل دون أي نص
+            try:
+                bot.answer_callback_query(update.id)
+            except API_ERRORS:
+                pass
+        if verdict == "mute":
+            try:
+                bot.send_message(uid, f"🚫 تم إيقافك مؤقتاً لمدة {flood.mute_remaining(uid)} ثانية بسبب كثرة الطلبات.")
+            except API_ERRORS:
+                pass
+        return CancelUpdate()
+
+    def post_process(self, update, data, exception):
+        pass
+
+bot.setup_middleware(FloodMiddleware())
+
+@bot.message_handler(commands=["metrics"])
+def cmd_metrics(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    bot.reply_to(m, metrics_summary())
+
+@bot.message_handler(commands=["flood"])
+def cmd_flood(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    s = flood.stats()
+    bot.reply_to(m, "🌊 حماية الإغراق:\n" + "\n".join(f"{k}: {v}" for k, v in s.items()))
+
 # ---------------------------
 # أوامر أساسية
 # ---------------------------
@@ -244,22 +1354,20 @@ def product_detail_keyboard(pid):
 def handle_start(msg):
     try:
         ensure_user(msg.from_user)
-        if is_banned(msg.from_user.id):
-            bot.send_message(msg.chat.id, "🚫 تم حظرك من استخدام البوت.")
-            return
         welcome = get_setting("welcome_msg") or "أهلاً بك!"
         if is_admin(msg.from_user.id):
             bot.send_message(msg.chat.id, f"مرحباً أيها الأدمن 👋\n\n{welcome}", reply_markup=admin_main_keyboard())
         else:
             bot.send_message(msg.chat.id, welcome, reply_markup=user_main_keyboard())
     except Exception:
-        traceback.print_exc()
+        report_error("start")
 
 @bot.message_handler(commands=["help"])
 def handle_help(msg):
     txt = (
         "📌 تعليمات استخدام البوت:\n"
         "• اضغط على 🛒 الأقسام لتصفح الأصناف.\n"
+        "• اضغط 🔎 بحث أو اكتب اسم البوت ثم اسم المنتج في أي محادثة للبحث.\n"
         "• استخدم زر 💰 رصيدي لعرض رصيدك.\n"
         "• لطلب شحن تواصل مع الأدمن أو استخدم زر شحن.\n"
         "• للأدمن: /admin لفتح لوحة الأدمن."
@@ -274,505 +1382,1598 @@ def handle_admin(msg):
     bot.send_message(msg.chat.id, "لوحة الأدمن:", reply_markup=admin_main_keyboard())
 
 # ---------------------------
-# تعامل مع الأزرار (CallbackQuery)
+# موجّه الأزرار (CallbackQuery): جدول مطابقة تامة + جدول بادئات
 # ---------------------------
-@bot.callback_query_handler(func=lambda c: True)
-def callback_query(c: types.CallbackQuery):
-    try:
-        data = c.data
-        uid = c.from_user.id
-
-        # عام: العودة أو القوائم
-        if data == "back_main":
-            if is_admin(uid):
-                bot.edit_message_text(get_setting("welcome_msg"), c.message.chat.id, c.message.message_id, reply_markup=admin_main_keyboard())
+def opt_int(s):
+    # حقل رقمي اختياري (فارغ = None) مثل مؤشر الصفحة الأولى في usr:a:
+    return int(s) if s else None
+
+class CallbackRouter:
+    # exact: data -> (fn, admin) ؛ prefix: "cat" -> (fn, admin, أنواع الحقول بعد البادئة)
+    # المعالج يستدعى fn(c, uid, *args) بعد تحويل الحقول لأنواعها
+    def __init__(self):
+        self.exact = {}
+        self.prefix = {}
+
+    def route(self, key, admin=False, args=()):
+        # مفتاح ينتهي بـ ":" يعني مسار بادئة (مثل "buy:" مع args=(int,))
+        def deco(fn):
+            if key.endswith(":"):
+                self.prefix[key[:-1]] = (fn, admin, tuple(args))
             else:
-                bot.edit_message_text(get_setting("welcome_msg"), c.message.chat.id, c.message.message_id, reply_markup=user_main_keyboard())
-            return
-
-        if data == "menu_sections":
-            kb = categories_keyboard()
-            bot.edit_message_text("📂 الأقسام:", c.message.chat.id, c.message.message_id, reply_markup=kb)
-            return
-
-        if data == "menu_balance":
-            bal = get_balance(uid)
-            bot.answer_callback_query(c.id, f"رصيدك: {fmt_currency(bal)}")
-            return
-
-        if data == "menu_deposit":
-            # خطوة: طلب إيداع — نسجل طلب إيداع في جدول deposits كـ pending
-            bot.send_message(uid, "💵 شحن بالليرة السورية — أرسل المبلغ بالليرة الآن (مثال: 5000). لإلغاء ارسل /cancel")
-            bot.answer_callback_query(c.id, "أرسل المبلغ بالليرة الآن.")
-            # نخزن حالة انتظار (بسيط عبر setting)
-            set_setting(f"awaiting_deposit_user_{uid}", "1")
-            return
+                self.exact[key] = (fn, admin)
+            return fn
+        return deco
+
+    def resolve(self, data):
+        # يعيد (fn, admin, args) أو None إن لم يطابق شيء أو كانت الحقول غير صالحة
+        entry = self.exact.get(data)
+        if entry is not None:
+            return entry[0], entry[1], ()
+        head, sep, rest = data.partition(":")
+        entry = self.prefix.get(head) if sep else None
+        if entry is None:
+            return None
+        fn, admin, kinds = entry
+        parts = rest.split(":", len(kinds) - 1) if kinds else []
+        if len(parts) > len(kinds):
+            return None
+        # الحقول الأخيرة الناقصة تمرر فارغة (opt_int يحولها إلى None، و int يرفضها)
+        parts += [""] * (len(kinds) - len(parts))
+        try:
+            return fn, admin, tuple(kind(p) for kind, p in zip(kinds, parts))
+        except ValueError:
+            return None
 
-        if data == "menu_orders":
-            cur.execute("SELECT id, product_id, price, status, created_at FROM orders WHERE user_id = ? ORDER BY id DESC", (uid,))
-            rows = cur.fetchall()
-            if not rows:
-                bot.send_message(uid, "ليس لديك طلبات حالياً.")
-            else:
-                text = "📦 طلباتك:\n"
-                for r in rows:
-                    text += f"#{r[0]} — المنتج:{r[1]} — {fmt_currency(r[2])} — الحالة:{r[3]}\n"
-                bot.send_message(uid, text)
-            bot.answer_callback_query(c.id)
+    def dispatch(self, c):
+        uid = c.from_user.id
+        hit = self.resolve(c.data or "")
+        if hit is None:
+            bot.answer_callback_query(c.id, "تم الضغط.")
             return
-
-        if data == "menu_help":
-            bot.answer_callback_query(c.id, "استخدم الأزرار أو اكتب /help لعرض التعليمات.")
+        fn, admin, args = hit
+        if admin and not is_admin(uid):
+            bot.answer_callback_query(c.id, "هذه الأوامر للأدمن فقط.")
             return
+        t0 = time.perf_counter()
+        try:
+            fn(c, uid, *args)
+        finally:
+            metrics.observe("storebot_callback_seconds", (fn.__name__,), time.perf_counter() - t0)
 
-        # تصفح الأقسام -> اختيار قسم
-        if data.startswith("cat:"):
-            cid = int(data.split(":", 1)[1])
-            kb = products_keyboard(cid)
-            bot.edit_message_text("🧾 منتجات القسم:", c.message.chat.id, c.message.message_id, reply_markup=kb)
-            return
+router = CallbackRouter()
+on_callback = router.route
 
-        # اختيار منتج
-        if data.startswith("prod:"):
-            pid = int(data.split(":", 1)[1])
-            p = get_product_by_id(pid=None) if False else None  # placeholder to satisfy lint
-            # fetch product
-            cur.execute("SELECT name, price, description FROM products WHERE id = ?", (pid,))
-            row = cur.fetchone()
-            if not row:
-                bot.answer_callback_query(c.id, "المنتج غير موجود.")
-                return
-            name, price, desc = row
-            text = f"🔹 <b>{name}</b>\nالسعر: {fmt_currency(price)}\n\n{desc or ''}"
-            kb = product_detail_keyboard(pid)
-            bot.edit_message_text(text, c.message.chat.id, c.message.message_id, reply_markup=kb)
-            return
+@bot.callback_query_handler(func=lambda c: True)
+def callback_query(c: types.CallbackQuery):
+    try:
+        router.dispatch(c)
+    except Exception:
+        report_error("callback_query")
+        try:
+            bot.answer_callback_query(c.id, "خطأ داخلي (راجع السجلات).")
+        except:
+            pass
 
-        # شراء منتج
-        if data.startswith("buy:"):
-            pid = int(data.split(":", 1)[1])
-            # تأكد وجود المنتج
-            cur.execute("SELECT name, price FROM products WHERE id = ?", (pid,))
-            row = cur.fetchone()
-            if not row:
-                bot.answer_callback_query(c.id, "المنتج غير موجود.")
-                return
-            name, price = row
-            bal = get_balance(uid)
-            if bal < price:
-                bot.answer_callback_query(c.id, f"رصيدك غير كافٍ. السعر: {fmt_currency(price)} — رصيدك: {fmt_currency(bal)}")
-                bot.send_message(uid, "لشحن رصيدك استخدم زر شحن أو تواصل مع الأدمن.")
-                return
-            # خصم و إنشاء طلب
-            change_balance(uid, -price)
-            cur.execute("INSERT INTO orders (user_id, product_id, price, status, created_at) VALUES (?, ?, ?, ?, ?)",
-                        (uid, pid, price, "new", datetime.utcnow().isoformat()))
-            conn.commit()
-            order_id = cur.lastrowid
-            bot.answer_callback_query(c.id, "تمت عملية الشراء بنجاح.")
-            bot.send_message(uid, f"✅ تم إنشاء طلب #{order_id} للمنتج {name}. تم خصم {fmt_currency(price)} من رصيدك.")
-            # إشعار الأدمن
-            bot.send_message(ADMIN_ID, f"📥 طلب جديد #{order_id} من @{c.from_user.username or c.from_user.id} — {name} — {fmt_currency(price)}")
-            return
+def edit_in_place(c, text, kb=None):
+    if c.message is None:
+        # زر في رسالة أرسلت عبر الوضع المضمن (inline) — لا تصل محادثتها للبوت
+        bot.edit_message_text(text, inline_message_id=c.inline_message_id, reply_markup=kb)
+        return
+    bot.edit_message_text(text, c.message.chat.id, c.message.message_id, reply_markup=kb)
+
+# طلب إدخال من الأدمن: رسالة تعليمات + حالة انتظار يقرؤها message_handler
+def ask_admin(c, uid, state, prompt, data=None, toast="أرسل البيانات الآن."):
+    bot.send_message(uid, prompt + "\nلإلغاء ارسل /cancel")
+    states.set(uid, state, data)
+    bot.answer_callback_query(c.id, toast)
+
+# عام: العودة أو القوائم
+@on_callback("back_main")
+def cb_back_main(c, uid):
+    kb = admin_main_keyboard() if is_admin(uid) else user_main_keyboard()
+    edit_in_place(c, get_setting("welcome_msg"), kb)
+
+@on_callback("menu_sections")
+@on_callback("secs:", args=(int,))
+def cb_sections(c, uid, page=0):
+    edit_in_place(c, "📂 الأقسام:", categories_keyboard(page))
+
+# زر رقم الصفحة في صفوف التنقل
+@on_callback("noop")
+def cb_noop(c, uid):
+    bot.answer_callback_query(c.id)
+
+@on_callback("menu_balance")
+def cb_balance(c, uid):
+    bot.answer_callback_query(c.id, f"رصيدك: {fmt_currency(get_balance(uid))}")
+
+@on_callback("menu_deposit")
+def cb_deposit(c, uid):
+    # خطوة: طلب إيداع — نسجل طلب إيداع في جدول deposits كـ pending
+    bot.send_message(uid, "💵 شحن بالليرة السورية — أرسل المبلغ بالليرة الآن (مثال: 5000). لإلغاء ارسل /cancel")
+    bot.answer_callback_query(c.id, "أرسل المبلغ بالليرة الآن.")
+    # نخزن حالة انتظار في مخزن الحالات
+    states.set(uid, "deposit")
+
+# سجل الطلبات: صفحة أولى ثم ord:o:<id> (الأقدم) و ord:n:<id> (الأحدث)
+@on_callback("menu_orders")
+@on_callback("ord:", args=(str, int))
+def cb_orders(c, uid, direction=None, ref=None):
+    rows, has_older, has_newer = orders_page(uid, before=ref if direction == "o" else None,
+                                             after=ref if direction == "n" else None)
+    if not rows:
+        bot.answer_callback_query(c.id, "ليس لديك طلبات حالياً.")
+        return
+    text, kb = orders_view(rows, has_older, has_newer)
+    # استدعاء واحد لكل صفحة: التعديل في مكانه يكفي كرد (مثل تصفح الأقسام)
+    edit_in_place(c, text, kb)
+
+@on_callback("menu_help")
+def cb_help(c, uid):
+    bot.answer_callback_query(c.id, "استخدم الأزرار أو اكتب /help لعرض التعليمات.")
+
+# تصفح الأقسام -> اختيار قسم
+# "cat:<cid>" من رسائل قديمة تعني الصفحة الأولى
+@on_callback("cat:", args=(int, opt_int))
+def cb_category(c, uid, cid, page):
+    edit_in_place(c, "🧾 منتجات القسم:", products_keyboard(cid, page or 0))
+
+# اختيار منتج
+@on_callback("prod:", args=(int,))
+def cb_product(c, uid, pid):
+    snap = catalog()
+    p = snap.products.get(pid)
+    if not p:
+        bot.answer_callback_query(c.id, "المنتج غير موجود.")
+        return
+    _, name, price, desc = p
+    edit_in_place(c, product_text(name, price, desc), snap.product_keyboard(pid))
+
+# شراء منتج
+@on_callback("buy:", args=(int,))
+def cb_buy(c, uid, pid):
+    # خصم الرصيد وإنشاء الطلب في معاملة واحدة
+    res = purchase(uid, pid)
+    if res is None:
+        bot.answer_callback_query(c.id, "المنتج غير موجود.")
+        return
+    order_id, name, price = res
+    if order_id is None:
+        bal = get_balance(uid)
+        bot.answer_callback_query(c.id, f"رصيدك غير كافٍ. السعر: {fmt_currency(price)} — رصيدك: {fmt_currency(bal)}")
+        bot.send_message(uid, "لشحن رصيدك استخدم زر شحن أو تواصل مع الأدمن.")
+        return
+    bot.answer_callback_query(c.id, "تمت عملية الشراء بنجاح.")
+    bot.send_message(uid, f"✅ تم إنشاء طلب #{order_id} للمنتج {name}. تم خصم {fmt_currency(price)} من رصيدك.")
+    # إشعار الأدمن (فوري أو ضمن ملخص دوري)
+    notifier.order(order_id, f"@{c.from_user.username or c.from_user.id}", name, price)
+
+# ---------- لوحات الأدمن ----------
+# صفحات /users و /list_deposits
+@on_callback("usr:", admin=True, args=(str, opt_int))
+def cb_users_page(c, uid, code, ref):
+    rows, has_more = users_page(code, ref)
+    text, kb = users_view(code, rows, has_more)
+    edit_in_place(c, text, kb)
+    bot.answer_callback_query(c.id)
+
+@on_callback("dpl:", admin=True, args=(str, opt_int))
+def cb_deposits_page(c, uid, status, ref):
+    rows, has_more = deposits_page(status, ref)
+    text, kb = deposits_view(status, rows, has_more)
+    edit_in_place(c, text, kb)
+    bot.answer_callback_query(c.id)
+
+@on_callback("adm_store", admin=True)
+def cb_adm_store(c, uid):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(types.InlineKeyboardButton("➕ إضافة قسم", callback_data="adm_add_category"),
+           types.InlineKeyboardButton("✏ تعديل قسم", callback_data="adm_edit_category"))
+    kb.add(types.InlineKeyboardButton("➕ إضافة منتج", callback_data="adm_add_product"),
+           types.InlineKeyboardButton("✏ تعديل منتج", callback_data="adm_edit_product"))
+    kb.add(types.InlineKeyboardButton("🗑 حذف قسم/منتج", callback_data="adm_delete"))
+    kb.add(types.InlineKeyboardButton("📥 استيراد ملف", callback_data="adm_import"),
+           types.InlineKeyboardButton("📤 تصدير المنتجات", callback_data="adm_export"))
+    kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
+    edit_in_place(c, "🛠️ إدارة المتجر:", kb)
 
-        # ---------- لوحات الأدمن ----------
-        if data == "adm_store" and is_admin(uid):
-            kb = types.InlineKeyboardMarkup(row_width=2)
-            kb.add(types.InlineKeyboardButton("➕ إضافة قسم", callback_data="adm_add_category"),
-                   types.InlineKeyboardButton("✏ تعديل قسم", callback_data="adm_edit_category"))
-            kb.add(types.InlineKeyboardButton("➕ إضافة منتج", callback_data="adm_add_product"),
-                   types.InlineKeyboardButton("✏ تعديل منتج", callback_data="adm_edit_product"))
-            kb.add(types.InlineKeyboardButton("🗑 حذف قسم/منتج", callback_data="adm_delete"))
-            kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
-            bot.edit_message_text("🛠️ إدارة المتجر:", c.message.chat.id, c.message.message_id, reply_markup=kb)
-            return
+def categories_list_text():
+    snap = catalog()
+    return "\n".join(f"{cid}: {name}" for cid, name in snap.categories) or "لا توجد أقسام بعد."
 
-        if data == "adm_balance" and is_admin(uid):
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("➕ إضافة رصيد للمستخدم", callback_data="adm_add_balance"),
-                   types.InlineKeyboardButton("➖ خصم رصيد من المستخدم", callback_data="adm_deduct_balance"))
-            kb.add(types.InlineKeyboardButton("🔍 عرض رصيد المستخدم", callback_data="adm_show_balance"),
-                   types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
-            bot.edit_message_text("💳 إدارة الأرصدة:", c.message.chat.id, c.message.message_id, reply_markup=kb)
-            return
+@on_callback("adm_add_category", admin=True)
+def cb_adm_add_category(c, uid):
+    ask_admin(c, uid, "new_category", "➕ أرسل اسم القسم الجديد.")
 
-        if data == "adm_welcome" and is_admin(uid):
-            bot.send_message(uid, "✏ أرسل نص رسالة الترحيب الجديدة الآن (يمكنك استخدام {user} ليظهر اسم المستخدم).")
-            set_setting(f"awaiting_welcome_{uid}", "1")
-            bot.answer_callback_query(c.id, "أرسل رسالة الترحيب الآن.")
-            return
+@on_callback("adm_edit_category", admin=True)
+def cb_adm_edit_category(c, uid):
+    ask_admin(c, uid, "edit_category", f"✏ الأقسام الحالية:\n{categories_list_text()}\n\nأرسل: category_id | الاسم الجديد")
 
-        if data == "adm_broadcast" and is_admin(uid):
-            bot.send_message(uid, "📢 أرسل الرسالة التي تريد بثها الآن. لإلغاء ارسل /cancel.")
-            set_setting(f"awaiting_broadcast_{uid}", "1")
-            bot.answer_callback_query(c.id, "أرسل نص البث الآن.")
-            return
+@on_callback("adm_add_product", admin=True)
+def cb_adm_add_product(c, uid):
+    ask_admin(c, uid, "new_product", f"➕ الأقسام:\n{categories_list_text()}\n\nأرسل: category_id | اسم المنتج | السعر | الوصف (اختياري)")
 
-        if data == "adm_bans" and is_admin(uid):
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("🚫 حظر مستخدم", callback_data="adm_ban_user"),
-                   types.InlineKeyboardButton("✅ فك الحظر", callback_data="adm_unban_user"))
-            kb.add(types.InlineKeyboardButton("👥 عرض المستخدمين", callback_data="adm_list_users"),
-                   types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
-            bot.edit_message_text("🚫 إدارة الحظر والمستخدمين:", c.message.chat.id, c.message.message_id, reply_markup=kb)
-            return
+@on_callback("adm_edit_product", admin=True)
+def cb_adm_edit_product(c, uid):
+    ask_admin(c, uid, "edit_product", "✏ أرسل: product_id | الاسم | السعر | الوصف\nاترك الحقل فارغاً للإبقاء على قيمته (مثال: 12 | | 5.5)")
 
-        if data == "adm_stats" and is_admin(uid):
-            cur.execute("SELECT COUNT(*) FROM users")
-            total_users = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM orders")
-            total_orders = cur.fetchone()[0]
-            cur.execute("SELECT SUM(balance) FROM users")
-            total_bal = cur.fetchone()[0] or 0
-            txt = f"📊 إحصائيات البوت:\n• مستخدمون: {total_users}\n• طلبات: {total_orders}\n• إجمالي أرصدة: {fmt_currency(total_bal)}"
-            bot.edit_message_text(txt, c.message.chat.id, c.message.message_id, reply_markup=admin_main_keyboard())
-            return
+@on_callback("adm_delete", admin=True)
+def cb_adm_delete(c, uid):
+    ask_admin(c, uid, "delete", "🗑 أرسل: cat <id> لحذف قسم مع منتجاته، أو prod <id> لحذف منتج.")
 
-        # إدارة الأزرار (قائمة)
-        if data == "adm_buttons" and is_admin(uid):
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("➕ إضافة زر", callback_data="adm_add_button"),
-                   types.InlineKeyboardButton("📋 عرض الأزرار", callback_data="adm_list_buttons"))
-            kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
-            bot.edit_message_text("🔘 إدارة الأزرار:", c.message.chat.id, c.message.message_id, reply_markup=kb)
-            return
+@on_callback("adm_balance", admin=True)
+def cb_adm_balance(c, uid):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("➕ إضافة رصيد للمستخدم", callback_data="adm_add_balance"),
+           types.InlineKeyboardButton("➖ خصم رصيد من المستخدم", callback_data="adm_deduct_balance"))
+    kb.add(types.InlineKeyboardButton("🔍 عرض رصيد المستخدم", callback_data="adm_show_balance"),
+           types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
+    edit_in_place(c, "💳 إدارة الأرصدة:", kb)
+
+@on_callback("adm_add_balance", admin=True)
+def cb_adm_add_balance(c, uid):
+    ask_admin(c, uid, "balance_action", "➕ أرسل: user_id | amount", data="add")
+
+@on_callback("adm_deduct_balance", admin=True)
+def cb_adm_deduct_balance(c, uid):
+    ask_admin(c, uid, "balance_action", "➖ أرسل: user_id | amount", data="deduct")
+
+@on_callback("adm_show_balance", admin=True)
+def cb_adm_show_balance(c, uid):
+    ask_admin(c, uid, "show_balance", "🔍 أرسل آيدي المستخدم.")
+
+@on_callback("adm_welcome", admin=True)
+def cb_adm_welcome(c, uid):
+    bot.send_message(uid, "✏ أرسل نص رسالة الترحيب الجديدة الآن (يمكنك استخدام {user} ليظهر اسم المستخدم).")
+    states.set(uid, "welcome")
+    bot.answer_callback_query(c.id, "أرسل رسالة الترحيب الآن.")
+
+@on_callback("adm_broadcast", admin=True)
+def cb_adm_broadcast(c, uid):
+    bot.send_message(uid, "📢 أرسل الرسالة التي تريد بثها الآن. لإلغاء ارسل /cancel.")
+    states.set(uid, "broadcast")
+    bot.answer_callback_query(c.id, "أرسل نص البث الآن.")
+
+@on_callback("adm_bans", admin=True)
+def cb_adm_bans(c, uid):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🚫 حظر مستخدم", callback_data="adm_ban_user"),
+           types.InlineKeyboardButton("✅ فك الحظر", callback_data="adm_unban_user"))
+    kb.add(types.InlineKeyboardButton("👥 عرض المستخدمين", callback_data="adm_list_users"),
+           types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
+    edit_in_place(c, "🚫 إدارة الحظر والمستخدمين:", kb)
+
+@on_callback("adm_ban_user", admin=True)
+def cb_adm_ban_user(c, uid):
+    ask_admin(c, uid, "ban", "🚫 أرسل آيدي المستخدم المراد حظره.", data="ban")
+
+@on_callback("adm_unban_user", admin=True)
+def cb_adm_unban_user(c, uid):
+    ask_admin(c, uid, "ban", "✅ أرسل آيدي المستخدم المراد فك حظره.", data="unban")
+
+@on_callback("adm_list_users", admin=True)
+def cb_adm_list_users(c, uid):
+    rows, has_more = users_page("a")
+    text, kb = users_view("a", rows, has_more)
+    edit_in_place(c, text, kb)
+    bot.answer_callback_query(c.id)
+
+@on_callback("adm_stats", admin=True)
+def cb_adm_stats(c, uid):
+    edit_in_place(c, stats_text(), admin_main_keyboard())
+
+# إدارة الأزرار (قائمة)
+@on_callback("adm_buttons", admin=True)
+def cb_adm_buttons(c, uid):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("➕ إضافة زر", callback_data="adm_add_button"),
+           types.InlineKeyboardButton("📋 عرض الأزرار", callback_data="adm_list_buttons"))
+    kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
+    edit_in_place(c, "🔘 إدارة الأزرار:", kb)
 
-        # إضافة/تعديل/حذف قسم/منتج/زر -- يتم عبر رسائل تالية (stateful) لنرسل التعليمات للأدمن
-        # ستتم قراءة هذه الحالات في message handler أدناه
-        # مثال: adm_add_category, adm_add_product, adm_edit_category, adm_edit_product, adm_add_button, adm_list_buttons, adm_add_balance, adm_deduct_balance ...
+@on_callback("adm_add_button", admin=True)
+def cb_adm_add_button(c, uid):
+    ask_admin(c, uid, "new_button", "➕ أرسل: parent_type|parent_id|text|action|payload\n(parent_type: category/product/global — action: open_url أو buy)")
 
-        # حال افتراضيه
-        bot.answer_callback_query(c.id, "تم الضغط.")
-    except Exception as e:
-        traceback.print_exc()
-        try:
-            bot.answer_callback_query(c.id, "خطأ داخلي (راجع السجلات).")
-        except:
-            pass
+@on_callback("adm_list_buttons", admin=True)
+def cb_adm_list_buttons(c, uid):
+    rows = db_all("SELECT id, parent_type, parent_id, text, action, payload FROM buttons ORDER BY id LIMIT 100")
+    lines = ["📋 الأزرار:"] + [f"#{r[0]} | {r[1]}:{r[2]} | {r[3]} | {r[4]} {r[5] or ''}" for r in rows]
+    if not rows:
+        lines.append("لا توجد أزرار.")
+    bot.send_message(uid, "\n".join(lines))
+    bot.answer_callback_query(c.id)
 
 # ---------------------------
 # دوال CRUD مساعدة (القسم والمنتج)
 # ---------------------------
 def add_category(name):
-    cur.execute("INSERT INTO categories (name, pos) VALUES (?, ?)", (name, int(time.time())))
-    conn.commit()
-    return cur.lastrowid
+    cid = db_exec("INSERT INTO categories (name, pos) VALUES (?, ?)", (name, int(time.time()))).lastrowid
+    invalidate_catalog()
+    return cid
 
 def edit_category(cid, newname):
-    cur.execute("UPDATE categories SET name = ? WHERE id = ?", (newname, cid))
-    conn.commit()
+    db_exec("UPDATE categories SET name = ? WHERE id = ?", (newname, cid))
+    invalidate_catalog()
 
 def delete_category(cid):
-    cur.execute("DELETE FROM categories WHERE id = ?", (cid,))
-    cur.execute("DELETE FROM products WHERE category_id = ?", (cid,))
-    conn.commit()
+    with transaction() as c:
+        c.execute("DELETE FROM categories WHERE id = ?", (cid,))
+        c.execute("DELETE FROM products_fts WHERE rowid IN (SELECT id FROM products WHERE category_id = ?)", (cid,))
+        c.execute("DELETE FROM products WHERE category_id = ?", (cid,))
+    invalidate_catalog()
+
+# فهرس البحث (products_fts) يحدث في نفس معاملة تعديل المنتج
+def index_products(c, rows):
+    # rows: [(pid, name, description), ...]
+    c.executemany("DELETE FROM products_fts WHERE rowid = ?", [(pid,) for pid, _, _ in rows])
+    c.executemany("INSERT INTO products_fts (rowid, name, description) VALUES (?, ?, ?)",
+                  [(pid, normalize_ar(name), normalize_ar(desc)) for pid, name, desc in rows])
+
+def index_product(c, pid, name, description):
+    index_products(c, [(pid, name, description)])
 
 def add_product(category_id, name, price, description=""):
-    cur.execute("INSERT INTO products (category_id, name, price, description, pos) VALUES (?, ?, ?, ?, ?)",
-                (category_id, name, price, description, int(time.time())))
-    conn.commit()
-    return cur.lastrowid
+    with transaction() as c:
+        pid = c.execute("INSERT INTO products (category_id, name, price, description, pos) VALUES (?, ?, ?, ?, ?)",
+                        (category_id, name, price, description, int(time.time()))).lastrowid
+        index_product(c, pid, name, description)
+    invalidate_catalog()
+    return pid
 
 def edit_product(pid, name=None, price=None, description=None):
-    if name is not None:
-        cur.execute("UPDATE products SET name = ? WHERE id = ?", (name, pid))
-    if price is not None:
-        cur.execute("UPDATE products SET price = ? WHERE id = ?", (price, pid))
-    if description is not None:
-        cur.execute("UPDATE products SET description = ? WHERE id = ?", (description, pid))
-    conn.commit()
+    with transaction() as c:
+        if name is not None:
+            c.execute("UPDATE products SET name = ? WHERE id = ?", (name, pid))
+        if price is not None:
+            c.execute("UPDATE products SET price = ? WHERE id = ?", (price, pid))
+        if description is not None:
+            c.execute("UPDATE products SET description = ? WHERE id = ?", (description, pid))
+        if name is not None or description is not None:
+            row = c.execute("SELECT name, description FROM products WHERE id = ?", (pid,)).fetchone()
+            if row:
+                index_product(c, pid, *row)
+    invalidate_catalog()
 
 def delete_product(pid):
-    cur.execute("DELETE FROM products WHERE id = ?", (pid,))
-    conn.commit()
+    with transaction() as c:
+        c.execute("DELETE FROM products WHERE id = ?", (pid,))
+        c.execute("DELETE FROM products_fts WHERE rowid = ?", (pid,))
+    invalidate_catalog()
 
 def get_product_by_id(pid):
-    cur.execute("SELECT id, category_id, name, price, description FROM products WHERE id = ?", (pid,))
-    r = cur.fetchone()
+    r = db_one("SELECT id, category_id, name, price, description FROM products WHERE id = ?", (pid,))
     if not r:
         return None
     return {"id": r[0], "category_id": r[1], "name": r[2], "price": float(r[3]), "description": r[4]}
 
 # ---------------------------
-# معالجة الرسائل النصية (حالات الأدمن/stateful flows)
+# البحث (FTS5) والوضع المضمن (inline mode)
 # ---------------------------
-@bot.message_handler(func=lambda m: True, content_types=['text'])
-def message_handler(m: types.Message):
+# الاستعلام يوحد بنفس normalize_ar المستخدمة في الفهرسة، وكل كلمة تصبح بادئة ("كلمة"*)
+# والنتائج مرتبة بـ bm25 (وزن الاسم أعلى من الوصف). مهلة تنفيذ عبر progress handler،
+# وذاكرة LRU للاستعلامات الساخنة مفتاحها نسخة الكتالوج فتسقط تلقائياً بعد أي تعديل.
+SEARCH_RESULTS = 20          # نتائج لكل صفحة inline (حد تيليجرام 50)
+SEARCH_MAX_RESULTS = 100     # أقصى عدد نتائج مرتبة لكل استعلام (5 صفحات)
+SEARCH_MAX_TERMS = 6
+SEARCH_BUDGET_MS = int(os.getenv("SEARCH_BUDGET_MS", "150"))
+SEARCH_CACHE_SIZE = 512
+SEARCH_INLINE_CACHE_TIME = 30   # ثوانٍ يحتفظ بها تيليجرام بالنتائج
+_TERM_RE = re.compile(r"\w+")
+
+metrics.counter("storebot_search_total", "Search queries by outcome (hit, miss, timeout)", ("result",))
+
+class SearchCache:
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+search_cache = SearchCache(SEARCH_CACHE_SIZE)
+metrics.gauge("storebot_search_cache_entries", "Queries held in the search LRU cache", lambda: len(search_cache.items))
+
+def search_terms(query):
+    return _TERM_RE.findall(normalize_ar(query))[:SEARCH_MAX_TERMS]
+
+def _search_memory(snap, terms):
+    # مسح خطي لنسخة الكتالوج: أبطأ من FTS لكن زمنه محدود ولا يلمس القاعدة
+    return [pid for pid, words in snap.search_text.items()
+            if all(any(w.startswith(t) for w in words) for t in terms)][:SEARCH_MAX_RESULTS]
+
+def search_products(query):
+    # يرجع معرفات المنتجات مرتبة حسب الصلة
+    terms = search_terms(query)
+    if not terms:
+        return []
+    snap = catalog()
+    key = (snap.version, " ".join(terms))
+    pids = search_cache.get(key)
+    if pids is not None:
+        metrics.inc("storebot_search_total", ("hit",))
+        return pids
+    c = db()
+    deadline = time.perf_counter() + SEARCH_BUDGET_MS / 1000
+    c.set_progress_handler(lambda: time.perf_counter() > deadline, 1000)
     try:
-        uid = m.from_user.id
-        text = (m.text or "").strip()
+        rows = c.execute("SELECT rowid FROM products_fts WHERE products_fts MATCH ? "
+                         "ORDER BY bm25(products_fts, 10.0, 1.0) LIMIT ?",
+                         (" ".join(f'"{t}"*' for t in terms), SEARCH_MAX_RESULTS)).fetchall()
+    except sqlite3.OperationalError as e:
+        if "interrupt" not in str(e):
+            raise
+        metrics.inc("storebot_search_total", ("timeout",))
+        return _search_memory(snap, terms)
+    finally:
+        c.set_progress_handler(None, 0)
+    metrics.inc("storebot_search_total", ("miss",))
+    pids = [pid for (pid,) in rows if pid in snap.products]
+    search_cache.put(key, pids)
+    return pids
+
+def inline_product_result(snap, pid):
+    cid, name, price, desc = snap.products[pid]
+    return types.InlineQueryResultArticle(
+        id=str(pid), title=name,
+        description=f"{fmt_currency(price)} — {snap.category_names.get(cid, '')}",
+        input_message_content=types.InputTextMessageContent(product_text(name, price, desc), parse_mode="HTML"),
+        reply_markup=product_detail_keyboard(pid, snap.product_back(pid)))
+
+@bot.inline_handler(func=lambda q: True)
+def inline_search(q):
+    try:
+        snap = catalog()
+        offset = int(q.offset) if (q.offset or "").isdigit() else 0
+        # استعلام فارغ: أول المنتجات بترتيب الكتالوج
+        pids = search_products(q.query) if q.query.strip() else list(snap.products)[:SEARCH_MAX_RESULTS]
+        page = pids[offset:offset + SEARCH_RESULTS]
+        next_offset = str(offset + SEARCH_RESULTS) if len(pids) > offset + SEARCH_RESULTS else ""
+        bot.answer_inline_query(q.id, [inline_product_result(snap, pid) for pid in page],
+                                cache_time=SEARCH_INLINE_CACHE_TIME, next_offset=next_offset)
+    except Exception:
+        report_error("inline_search")
 
-        # إلغاء العملية الجارية
-        if text.lower() == "/cancel":
-            # نزيل كل awaiting settings الخاصة بالأدمن هذا إن وجدت
-            for k in list_settings_keys():
-                if get_setting(k) == str(uid):
-                    set_setting(k, "")
-            bot.reply_to(m, "✅ تم الإلغاء.")
-            return
+# ---------------------------
+# الإحصائيات (عدادات وتجميع يومي تحدثها triggers — انظر الترحيل 3)
+# ---------------------------
+STATS_DAYS = 7
+
+def stats_text():
+    # استعلامان على جداول صغيرة مهما كبر حجم المتجر
+    totals = dict(db_all("SELECT key, value FROM stats"))
+    days = db_all("SELECT day, orders, revenue, deposits_confirmed, deposit_credits, new_users FROM daily_stats "
+                  "ORDER BY day DESC LIMIT ?", (STATS_DAYS * 2,))
+    week, prev = days[:STATS_DAYS], days[STATS_DAYS:]
+
+    def total(rows, i):
+        return sum(r[i] or 0 for r in rows)
+
+    def trend(now, before):
+        if not before:
+            return ""
+        return f" ({(now - before) / before * 100:+.0f}%)"
+
+    lines = [
+        "📊 إحصائيات البوت:",
+        f"• مستخدمون: {int(totals.get('users', 0))}",
+        f"• طلبات: {int(totals.get('orders', 0))} — إيرادات: {fmt_currency(totals.get('revenue', 0))}",
+        f"• إجمالي أرصدة: {fmt_currency(from_minor(totals.get('balance_total_minor', 0)))}",
+        "",
+        f"📅 آخر {STATS_DAYS} أيام:",
+        f"• طلبات: {total(week, 1)}{trend(total(week, 1), total(prev, 1))}",
+        f"• إيرادات: {fmt_currency(total(week, 2))}{trend(total(week, 2), total(prev, 2))}",
+        f"• إيداعات مؤكدة: {total(week, 3)} ({total(week, 4)} كريديت)",
+        f"• مستخدمون جدد: {total(week, 5)}{trend(total(week, 5), total(prev, 5))}",
+        "",
+    ]
+    for day, orders, revenue, deps, credits, new_users in week:
+        lines.append(f"{day}: 🛒{orders} 💰{fmt_currency(revenue)} 💵{deps} 👤{new_users}")
+    return "\n".join(lines)
 
-        # إذا كان الأدمن في وضع انتظار تعديل الترحيب
-        if get_setting(f"awaiting_welcome_{uid}") and is_admin(uid):
-            new = text
-            set_setting("welcome_msg", new)
-            set_setting(f"awaiting_welcome_{uid}", "")
-            bot.reply_to(m, "✅ تم تحديث رسالة الترحيب.")
-            log_admin("update_welcome")
-            return
+# ---------------------------
+# سجل الطلبات (صفحات keyset على (user_id, id))
+# ---------------------------
+ORDERS_PAGE_SIZE = 10
+
+def orders_page(user_id, before=None, after=None, limit=ORDERS_PAGE_SIZE):
+    # يرجع (rows, has_older, has_newer) مرتبة من الأحدث للأقدم؛ كل صفحة استعلام واحد على الفهرس
+    sql = ("SELECT o.id, COALESCE(p.name, '#' || o.product_id), o.price, o.status, o.created_at "
+           "FROM orders o LEFT JOIN products p ON p.id = o.product_id WHERE o.user_id = ? ")
+    if after is not None:
+        rows = db_all(sql + "AND o.id > ? ORDER BY o.id ASC LIMIT ?", (user_id, after, limit + 1))
+        has_newer = len(rows) > limit
+        return list(reversed(rows[:limit])), True, has_newer
+    if before is not None:
+        rows = db_all(sql + "AND o.id < ? ORDER BY o.id DESC LIMIT ?", (user_id, before, limit + 1))
+        return rows[:limit], len(rows) > limit, True
+    rows = db_all(sql + "ORDER BY o.id DESC LIMIT ?", (user_id, limit + 1))
+    return rows[:limit], len(rows) > limit, False
+
+def orders_view(rows, has_older, has_newer):
+    lines = ["📦 طلباتك:"]
+    for oid, name, price, status, created_at in rows:
+        lines.append(f"#{oid} — {name} — {fmt_currency(price)} — الحالة:{status} — {(created_at or '')[:10]}")
+    kb = types.InlineKeyboardMarkup()
+    nav = []
+    if has_newer:
+        nav.append(types.InlineKeyboardButton("◀ الأحدث", callback_data=f"ord:n:{rows[0][0]}"))
+    if has_older:
+        nav.append(types.InlineKeyboardButton("الأقدم ▶", callback_data=f"ord:o:{rows[-1][0]}"))
+    if nav:
+        kb.add(*nav)
+    kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
+    return "\n".join(lines), kb
 
-        # انتظار بث
-        if get_setting(f"awaiting_broadcast_{uid}") and is_admin(uid):
-            msg = text
-            bot.reply_to(m, "جاري إرسال البث... انتظر لحظة.")
-            # إرسال إلى جميع المستخدمين
-            cur.execute("SELECT user_id FROM users")
-            rows = cur.fetchall()
-            sent = 0
-            failed = 0
-            for (u,) in rows:
-                try:
-                    bot.send_message(u, f"📣 رسالة من الأدمن:\n\n{msg}")
-                    sent += 1
-                    time.sleep(0.07)  # تروتل بسيط
-                except Exception:
-                    failed += 1
-            bot.reply_to(m, f"✅ تم الإرسال. ناجح: {sent} — فشل: {failed}")
-            set_setting(f"awaiting_broadcast_{uid}", "")
-            log_admin("broadcast_sent")
+# ---------------------------
+# الشراء (معاملة واحدة)
+# ---------------------------
+def purchase(user_id, pid):
+    # None: المنتج غير موجود — (None, name, price): رصيد غير كافٍ — (order_id, name, price): تم الشراء
+    # الخصم المشروط يمنع السحب المزدوج عند الضغط المتكرر على زر الشراء
+    with transaction() as c:
+        row = c.execute("SELECT name, price FROM products WHERE id = ?", (pid,)).fetchone()
+        if not row:
+            return None
+        name, price = row
+        amount = -to_minor(price)
+        if not apply_balance(c, user_id, amount, require_funds=True):
+            return None, name, price
+        # الطلب أولاً ليكتب القيد بمرجعه في INSERT واحد
+        order_id = c.execute("INSERT INTO orders (user_id, product_id, price, status, created_at) VALUES (?, ?, ?, ?, ?)",
+                             (user_id, pid, price, "new", datetime.utcnow().isoformat())).lastrowid
+        insert_entry(c, user_id, amount, "purchase", f"order:{order_id}")
+    return order_id, name, price
+
+# ---------------------------
+# البث في الخلفية (Broadcast)
+# ---------------------------
+# حدود تيليجرام: ~30 رسالة/ثانية عامة، ورسالة واحدة/ثانية تقريباً لنفس المحادثة
+BROADCAST_RATE = 25          # رسالة/ثانية لكل البث
+BROADCAST_CHAT_INTERVAL = 1.0  # ثوانٍ بين رسالتين لنفس المحادثة (الإعادة بعد 429، تحديثات التقدم)
+BROADCAST_WORKERS = 4        # عدد خيوط الإرسال
+BROADCAST_PAGE = 500         # عدد المستلمين المقروءين من القاعدة في كل دفعة
+BROADCAST_MAX_ATTEMPTS = 3   # محاولات الإرسال لكل مستخدم (غير 429)
+BROADCAST_FLUSH_EVERY = 1.0  # ثوانٍ بين حفظ النتائج في القاعدة
+BROADCAST_PROGRESS_EVERY = 5.0  # ثوانٍ بين تحديثات رسالة التقدم للأدمن
+
+class TokenBucket:
+    # دلو رموز بسيط وآمن للخيوط: rate رمز/ثانية بسعة capacity
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return False
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # عند 429 نوقف كل المستهلكين حتى انتهاء retry_after
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+class ChatLimiter:
+    # حد لكل محادثة: رسالة واحدة كل interval ثانية؛ يحفظ موعد الإرسال التالي فقط
+    # ويحذف المحادثات الخاملة حتى لا يكبر القاموس بعدد مستلمي البث
+    def __init__(self, interval=BROADCAST_CHAT_INTERVAL, max_chats=10000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self.next_at = {}
+        self.lock = threading.Lock()
+
+    def _reserve(self, chat_id, now, block):
+        at = max(self.next_at.get(chat_id, 0.0), now)
+        if at > now and not block:
+            return None
+        self.next_at[chat_id] = at + self.interval
+        if len(self.next_at) > self.max_chats:
+            self.next_at = {k: v for k, v in self.next_at.items() if v > now}
+        return at - now
+
+    def try_acquire(self, chat_id):
+        with self.lock:
+            return self._reserve(chat_id, time.monotonic(), block=False) is not None
+
+    def acquire(self, chat_id):
+        with self.lock:
+            wait = self._reserve(chat_id, time.monotonic(), block=True)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, chat_id, seconds):
+        with self.lock:
+            self.next_at[chat_id] = max(self.next_at.get(chat_id, 0.0), time.monotonic() + seconds)
+
+_broadcast_bucket = TokenBucket(BROADCAST_RATE)
+_chat_limiter = ChatLimiter()
+
+def create_broadcast_job(admin_id, chat_id, text):
+    now = datetime.utcnow().isoformat()
+    with transaction() as c:
+        job_id = c.execute("INSERT INTO broadcast_jobs (admin_id, chat_id, text, status, created_at) VALUES (?, ?, ?, 'running', ?)",
+                           (admin_id, chat_id, text, now)).lastrowid
+        # نسخ المستلمين داخل القاعدة مباشرة بدون تحميلهم في الذاكرة
+        total = c.execute("INSERT OR IGNORE INTO broadcast_targets (job_id, user_id, status) SELECT ?, user_id, 'pending' FROM users",
+                          (job_id,)).rowcount
+        c.execute("UPDATE broadcast_jobs SET total = ? WHERE id = ?", (total, job_id))
+    msg = api_result(bot.send_message(chat_id, f"📢 البث #{job_id}: بدأ الإرسال إلى {total} مستخدم..."))
+    db_exec("UPDATE broadcast_jobs SET progress_msg_id = ? WHERE id = ?", (msg.message_id, job_id))
+    return job_id
+
+def start_broadcast(job_id):
+    t = threading.Thread(target=_run_broadcast, args=(job_id,), name=f"broadcast-{job_id}", daemon=True)
+    t.start()
+    return t
+
+def resume_broadcasts():
+    # استئناف أي بث توقف بسبب إعادة تشغيل البوت. التسليم "مرة على الأقل": النتائج تحفظ كل
+    # BROADCAST_FLUSH_EVERY، فالمستلمون الذين أرسل لهم ولم تحفظ حالتهم قبل التوقف يستلمون الرسالة مجدداً
+    for (job_id,) in db_all("SELECT id FROM broadcast_jobs WHERE status = 'running'"):
+        start_broadcast(job_id)
+
+def _send_broadcast_message(user_id, text):
+    return deliver(user_id, f"📣 رسالة من الأدمن:\n\n{text}")
+
+def deliver(user_id, text):
+    # إرسال ضمن حد المحادثة ثم حد المعدل العام للبوت مع احترام retry_after؛ يعيد sent أو failed
+    attempts = 0
+    while attempts < BROADCAST_MAX_ATTEMPTS:
+        _chat_limiter.acquire(user_id)
+        _broadcast_bucket.acquire()
+        try:
+            api_result(bot.send_message(user_id, text))
+            return "sent"
+        except API_ERRORS as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                _broadcast_bucket.pause(retry_after)
+                _chat_limiter.pause(user_id, retry_after)
+                continue
+            if e.error_code in (400, 403):
+                # المستخدم حظر البوت أو المحادثة غير موجودة — لا فائدة من الإعادة
+                return "failed"
+            attempts += 1
+        except Exception:
+            attempts += 1
+            time.sleep(1)
+    return "failed"
+
+def _broadcast_worker(text, tasks, results):
+    while True:
+        user_id = tasks.get()
+        if user_id is None:
             return
+        results.put((_send_broadcast_message(user_id, text), user_id))
 
-        # انتظار حظر/فك حظر
-        if get_setting(f"awaiting_ban_{uid}") and is_admin(uid):
-            parts = text.split()
-            if len(parts) >= 2:
-                cmd = parts[0].lower()
+def _run_broadcast(job_id):
+    try:
+        row = db_one("SELECT chat_id, progress_msg_id, text, total, sent, failed FROM broadcast_jobs WHERE id = ?", (job_id,))
+        if not row:
+            return
+        chat_id, progress_msg_id, text, total, sent, failed = row
+        tasks = queue.Queue(maxsize=BROADCAST_PAGE)
+        results = queue.Queue()
+        workers = [threading.Thread(target=_broadcast_worker, args=(text, tasks, results), daemon=True)
+                   for _ in range(BROADCAST_WORKERS)]
+        for w in workers:
+            w.start()
+
+        state = {"sent": sent, "failed": failed, "flushed": time.monotonic(), "progress": time.monotonic()}
+
+        def flush(force=False):
+            now = time.monotonic()
+            if not force and now - state["flushed"] < BROADCAST_FLUSH_EVERY:
+                return
+            state["flushed"] = now
+            done = []
+            while True:
                 try:
-                    target = int(parts[1])
-                except:
-                    bot.reply_to(m, "الآيدي يجب أن يكون رقماً.")
-                    set_setting(f"awaiting_ban_{uid}", "")
+                    done.append(results.get_nowait())
+                except queue.Empty:
+                    break
+            if done:
+                state["sent"] += sum(1 for st, _ in done if st == "sent")
+                state["failed"] += sum(1 for st, _ in done if st != "sent")
+                with transaction() as c:
+                    c.executemany("UPDATE broadcast_targets SET status = ? WHERE job_id = ? AND user_id = ?",
+                                  [(st, job_id, u) for st, u in done])
+                    c.execute("UPDATE broadcast_jobs SET sent = ?, failed = ? WHERE id = ?", (state["sent"], state["failed"], job_id))
+            if progress_msg_id and (force or now - state["progress"] >= BROADCAST_PROGRESS_EVERY):
+                # التحديث يشارك حد محادثة الأدمن مع الإشعارات؛ إن كانت مشغولة نؤجله للدورة التالية
+                if force:
+                    _chat_limiter.acquire(chat_id)
+                elif not _chat_limiter.try_acquire(chat_id):
                     return
-                if cmd == "ban":
-                    ban_user(target)
-                    bot.reply_to(m, f"✅ تم حظر المستخدم {target}.")
+                state["progress"] = now
+                try:
+                    bot.edit_message_text(f"📢 البث #{job_id}: {state['sent'] + state['failed']}/{total}\n"
+                                          f"ناجح: {state['sent']} — فشل: {state['failed']}",
+                                          chat_id, progress_msg_id)
+                except Exception:
+                    pass
+
+        # قراءة المستلمين المتبقين على دفعات (keyset) بدل fetchall
+        last_user = -1
+        while True:
+            rows = db_all("SELECT user_id FROM broadcast_targets WHERE job_id = ? AND status = 'pending' AND user_id > ? "
+                          "ORDER BY user_id LIMIT ?", (job_id, last_user, BROADCAST_PAGE))
+            if not rows:
+                break
+            for (u,) in rows:
+                while True:
                     try:
-                        bot.send_message(target, "🚫 تم حظرك من البوت.")
-                    except:
-                        pass
-                    log_admin(f"ban {target}")
-                elif cmd == "unban":
-                    unban_user(target)
-                    bot.reply_to(m, f"✅ تم فك الحظر عن {target}.")
-                    log_admin(f"unban {target}")
+                        tasks.put(u, timeout=BROADCAST_FLUSH_EVERY)
+                        break
+                    except queue.Full:
+                        flush()
+                flush()
+            last_user = rows[-1][0]
+        for _ in workers:
+            tasks.put(None)
+        for w in workers:
+            w.join()
+        flush(force=True)
+        db_exec("UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), job_id))
+        bot.send_message(chat_id, f"✅ انتهى البث #{job_id}. ناجح: {state['sent']} — فشل: {state['failed']}")
+    except Exception:
+        report_error("broadcast")
+    finally:
+        close_db()
+
+# ---------------------------
+# إشعارات الأدمن: فورية عند الحجم المنخفض، وملخصات دورية عند الضغط
+# ---------------------------
+ADMIN_NOTIFY_PER_MIN = float(os.getenv("ADMIN_NOTIFY_PER_MIN", "20"))  # رسائل فورية مسموحة في الدقيقة
+ADMIN_NOTIFY_BURST = 5           # دفعة فورية قبل بدء التجميع
+ADMIN_DIGEST_INTERVAL = float(os.getenv("ADMIN_DIGEST_INTERVAL", "30"))  # نافذة الملخص (ثوانٍ)
+ADMIN_DIGEST_TOP = 10            # أسطر جدول المنتجات في ملخص الطلبات
+ADMIN_DIGEST_BUTTONS = 8         # طلبات إيداع قابلة للتأكيد من أزرار الملخص
+
+def deposit_actions_keyboard(dep_ids):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    for dep_id in dep_ids:
+        kb.add(types.InlineKeyboardButton(f"✅ تأكيد #{dep_id}", callback_data=f"dep:ok:{dep_id}"),
+               types.InlineKeyboardButton(f"❌ رفض #{dep_id}", callback_data=f"dep:no:{dep_id}"))
+    return kb
+
+class AdminNotifier:
+    # الأحداث: ("order", order_id, who, product, price) و ("deposit", dep_id, user_id, credits, amount_syp)
+    # الإرسال يتم من خيط خلفي حتى لا ينتظر رد المستخدم رسالة الأدمن
+    def __init__(self, chat_id, per_min=ADMIN_NOTIFY_PER_MIN, burst=ADMIN_NOTIFY_BURST, interval=ADMIN_DIGEST_INTERVAL):
+        self.chat_id = chat_id
+        self.bucket = TokenBucket(per_min / 60.0, burst)
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.pending = []
+        self.digest_at = None
+        self.first_at = None
+        self.sent_immediate = 0
+        self.sent_digests = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="admin-notifier", daemon=True)
+                self.thread.start()
+
+    def order(self, order_id, who, product, price):
+        self._submit(("order", order_id, who, product, price))
+
+    def deposit(self, dep_id, user_id, credits, amount_syp):
+        self._submit(("deposit", dep_id, user_id, credits, amount_syp))
+
+    def _submit(self, event):
+        if self.thread is None:
+            self.start()
+        self.queue.put(event)
+
+    def flush(self):
+        # يرسل كل ما في الطابور والملخص المعلق فوراً (يستخدم عند الإيقاف)
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.queue.join()
+
+    def _run(self):
+        while True:
+            timeout = None if self.digest_at is None else max(0.0, self.digest_at - time.monotonic())
+            try:
+                event = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._send_digest()
+                continue
+            try:
+                if event is None:
+                    self._send_digest()
+                # ما دام هناك ملخص مفتوح تلتحق به الأحداث الجديدة حفاظاً على الترتيب
+                elif not self.pending and self.bucket.try_acquire():
+                    self.sent_immediate += 1
+                    self._send_one(event)
                 else:
-                    bot.reply_to(m, "استخدم: ban <id> أو unban <id>")
-            else:
-                bot.reply_to(m, "استخدم: ban <id> أو unban <id>")
-            set_setting(f"awaiting_ban_{uid}", "")
-            return
+                    if not self.pending:
+                        self.first_at = time.monotonic()
+                        self.digest_at = self.first_at + self.interval
+                    self.pending.append(event)
+            except Exception:
+                report_error("admin_notifier")
+            finally:
+                self.queue.task_done()
+
+    def _send(self, text, kb=None):
+        try:
+            api_result(bot.send_message(self.chat_id, text, reply_markup=kb))
+        except API_ERRORS as e:
+            print(f"admin notify failed: {e}")
+
+    def _send_one(self, event):
+        if event[0] == "order":
+            _, order_id, who, product, price = event
+            self._send(f"📥 طلب جديد #{order_id} من {who} — {product} — {fmt_currency(price)}")
+        else:
+            _, dep_id, user_id, credits, amount_syp = event
+            self._send(f"📥 طلب إيداع جديد #{dep_id}\nالمستخدم: {user_id}\n{credits} كريديت — {int(amount_syp)} ل.س",
+                       deposit_actions_keyboard([dep_id]))
 
-        # انتظار إضافة قسم
-        if get_setting(f"awaiting_new_category_{uid}") and is_admin(uid):
-            name = text
-            add_category(name)
-            bot.reply_to(m, f"✅ تم إضافة القسم: {name}")
-            set_setting(f"awaiting_new_category_{uid}", "")
-            log_admin(f"add_category {name}")
+    def _send_digest(self):
+        events, self.pending, self.digest_at = self.pending, [], None
+        if not events:
             return
+        self.sent_digests += 1
+        window = max(1, round(time.monotonic() - self.first_at))
+        orders = [e for e in events if e[0] == "order"]
+        deposits = [e for e in events if e[0] == "deposit"]
+        if orders:
+            by_product = {}
+            for _, _, _, product, price in orders:
+                count, total = by_product.get(product, (0, 0.0))
+                by_product[product] = (count + 1, total + float(price))
+            top = sorted(by_product.items(), key=lambda kv: -kv[1][1])[:ADMIN_DIGEST_TOP]
+            rows = "\n".join(f"{html.escape(name[:24]):<24} {count:>5} {fmt_currency(total)}" for name, (count, total) in top)
+            revenue = sum(float(e[4]) for e in orders)
+            self._send(f"🧾 {len(orders)} طلب جديد خلال آخر {window} ث — الإجمالي {fmt_currency(revenue)}\n"
+                       f"الطلبات #{orders[0][1]} … #{orders[-1][1]}\n<pre>{rows}</pre>")
+        if deposits:
+            lines = [f"#{dep_id} | user:{user_id} | {credits} كريديت | {int(amount_syp)} ل.س"
+                     for _, dep_id, user_id, credits, amount_syp in deposits]
+            total = sum(e[3] for e in deposits)
+            more = len(deposits) - ADMIN_DIGEST_BUTTONS
+            tail = f"\n… و {more} طلبات أخرى: /list_deposits pending" if more > 0 else ""
+            self._send(f"💵 {len(deposits)} طلب إيداع جديد خلال آخر {window} ث — {total} كريديت\n"
+                       + "\n".join(lines[:50]) + tail,
+                       deposit_actions_keyboard([e[1] for e in deposits[:ADMIN_DIGEST_BUTTONS]]))
+
+notifier = AdminNotifier(ADMIN_ID)
+metrics.gauge("storebot_notifier_queue", "Admin events queued or waiting for the next digest",
+              lambda: notifier.queue.qsize() + len(notifier.pending))
+metrics.gauge("storebot_admin_notifications_total", "Admin notifications sent", lambda: {
+    ("immediate",): notifier.sent_immediate, ("digest",): notifier.sent_digests}, ("mode",), kind="counter")
 
-        # انتظار إضافة منتج (صيغة: category_id | name | price | description)
-        if get_setting(f"awaiting_new_product_{uid}") and is_admin(uid):
-            parts = [p.strip() for p in text.split("|")]
-            if len(parts) >= 3:
-                try:
-                    cid = int(parts[0])
-                    name = parts[1]
-                    price = float(parts[2].replace(",", "."))
-                    desc = parts[3] if len(parts) >= 4 else ""
-                    # تحقق وجود القسم
-                    cur.execute("SELECT id FROM categories WHERE id = ?", (cid,))
-                    if not cur.fetchone():
-                        bot.reply_to(m, "القسم غير موجود. تحقق من ID القسم.")
-                    else:
-                        pid = add_product(cid, name, price, desc)
-                        bot.reply_to(m, f"✅ تم إضافة المنتج {name} بسعر {fmt_currency(price)}. id={pid}")
-                        log_admin(f"add_product {name} in cat {cid}")
-                except Exception as e:
-                    bot.reply_to(m, "خطأ في القيم. الصيغة: category_id | name | price | description")
-                    log_admin(f"add_product_error {e}")
-            else:
-                bot.reply_to(m, "الصيغة خاطئة. استخدم: category_id | اسم المنتج | السعر | الوصف (اختياري)")
-            set_setting(f"awaiting_new_product_{uid}", "")
-            return
 
-        # انتظار إضافة زر مخصص (صيغة: parent_type|parent_id|text|action|payload)
-        if get_setting(f"awaiting_new_button_{uid}") and is_admin(uid):
-            parts = [p.strip() for p in text.split("|")]
-            if len(parts) >= 4:
-                parent_type = parts[0]  # category/product/global
-                parent_id = int(parts[1])
-                text_btn = parts[2]
-                action = parts[3]  # open_url or buy
-                payload = parts[4] if len(parts) > 4 else ""
-                cur.execute("INSERT INTO buttons (parent_type, parent_id, text, action, payload) VALUES (?, ?, ?, ?, ?)",
-                            (parent_type, parent_id, text_btn, action, payload))
-                conn.commit()
-                bot.reply_to(m, "✅ تم إضافة الزر.")
-                log_admin(f"add_button {text_btn} to {parent_type}:{parent_id}")
-            else:
-                bot.reply_to(m, "الصيغة خاطئة. استخدم: parent_type|parent_id|text|action|payload")
-            set_setting(f"awaiting_new_button_{uid}", "")
-            return
+# ---------------------------
+# صندوق رسائل المستخدمين (outbox): إشعارات ترسل في الخلفية ضمن حد المعدل
+# ---------------------------
+class Outbox:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def send(self, chat_id, text):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+                    self.thread.start()
+        self.queue.put((chat_id, text))
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+
+    def _run(self):
+        while True:
+            chat_id, text = self.queue.get()
+            try:
+                if deliver(chat_id, text) == "sent":
+                    self.sent += 1
+                else:
+                    self.failed += 1
+            except Exception:
+                report_error("outbox")
+            finally:
+                self.queue.task_done()
 
-        # انتظار إضافة/خصم رصيد (صيغة: user_id | amount)
-        if get_setting(f"awaiting_balance_action_{uid}") and is_admin(uid):
-            parts = [p.strip() for p in text.split("|")]
-            if len(parts) >= 2:
-                try:
-                    target = int(parts[0])
-                    amount = float(parts[1].replace(",", "."))
-                    action = get_setting(f"awaiting_balance_action_{uid}_type")
-                    if action == "add":
-                        change_balance(target, amount)
-                        bot.reply_to(m, f"✅ تم إضافة {fmt_currency(amount)} للمستخدم {target}.")
-                        try:
-                            bot.send_message(target, f"💰 تم إضافة رصيد {fmt_currency(amount)} لحسابك.")
-                        except:
-                            pass
-                        log_admin(f"add_balance {target} {amount}")
-                    elif action == "deduct":
-                        change_balance(target, -amount)
-                        bot.reply_to(m, f"✅ تم خصم {fmt_currency(amount)} من المستخدم {target}.")
-                        try:
-                            bot.send_message(target, f"⚠️ تم خصم {fmt_currency(amount)} من رصيدك.")
-                        except:
-                            pass
-                        log_admin(f"deduct_balance {target} {amount}")
-                except Exception as e:
-                    bot.reply_to(m, "خطأ في البيانات. تأكد من الصيغة: user_id | amount")
-                    log_admin(f"balance_action_error {e}")
-            else:
-                bot.reply_to(m, "استخدام: user_id | amount")
-            set_setting(f"awaiting_balance_action_{uid}", "")
-            set_setting(f"awaiting_balance_action_{uid}_type", "")
+outbox = Outbox()
+metrics.gauge("storebot_outbox_queue", "User notifications waiting to be sent", lambda: outbox.queue.qsize())
+
+# ---------------------------
+# حالات المحادثة (state machine) في الذاكرة
+# ---------------------------
+STATE_TTL = 15 * 60    # ثوانٍ قبل انتهاء صلاحية حالة الانتظار
+STATE_PERSIST = True   # حفظ الحالات في user_state حتى تبقى بعد إعادة التشغيل
+
+class StateStore:
+    # قاموس user_id -> (state, data, expires_at) ؛ القراءة لا تلمس القاعدة أبداً
+    def __init__(self, ttl=STATE_TTL, persist=STATE_PERSIST):
+        self.ttl = ttl
+        self.persist = persist
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not self.persist:
             return
+        rows = db_all("SELECT user_id, state, data, expires_at FROM user_state WHERE expires_at > ?", (time.time(),))
+        with self.lock:
+            for user_id, state, data, expires_at in rows:
+                self.states[user_id] = (state, data, expires_at)
+
+    def get(self, user_id):
+        entry = self.states.get(user_id)
+        if entry is None:
+            return None
+        state, data, expires_at = entry
+        if expires_at < time.time():
+            self.clear(user_id)
+            return None
+        return state, data
+
+    def set(self, user_id, state, data=None, ttl=None):
+        expires_at = time.time() + (ttl or self.ttl)
+        with self.lock:
+            self.states[user_id] = (state, data, expires_at)
+        if self.persist:
+            writer.submit("INSERT OR REPLACE INTO user_state (user_id, state, data, expires_at) VALUES (?, ?, ?, ?)",
+                          (user_id, state, data, expires_at))
+
+    def clear(self, user_id):
+        with self.lock:
+            existed = self.states.pop(user_id, None) is not None
+        if existed and self.persist:
+            writer.submit("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+states = StateStore()
+states.load()
+metrics.gauge("storebot_conversation_states", "Users with a pending conversation state", lambda: len(states.states))
+
+# جدول الحالات: اسم الحالة -> (الدالة، للأدمن فقط)
+STATE_HANDLERS = {}
+
+def on_state(name, admin=False):
+    def deco(fn):
+        STATE_HANDLERS[name] = (fn, admin)
+        return fn
+    return deco
 
-        # انتظار تأكيد/ارسال مبلغ شحن من المستخدم (deposit)
-        # المستخدم يرسل المبلغ بالليرة، نتحول إلى credits بحسب syp_rate
-        if get_setting(f"awaiting_deposit_user_{uid}"):
+# ---------------------------
+# معالجة الرسائل النصية (حالات الأدمن/stateful flows)
+# ---------------------------
+# تعديل رسالة الترحيب
+@on_state("welcome", admin=True)
+def state_welcome(m, uid, text, data):
+    set_setting("welcome_msg", text)
+    states.clear(uid)
+    bot.reply_to(m, "✅ تم تحديث رسالة الترحيب.")
+    log_admin("update_welcome")
+
+# بث
+@on_state("broadcast", admin=True)
+def state_broadcast(m, uid, text, data):
+    states.clear(uid)
+    # البث يعمل في الخلفية مع تحديثات دورية لرسالة التقدم
+    job_id = create_broadcast_job(uid, m.chat.id, text)
+    start_broadcast(job_id)
+    log_admin(f"broadcast_started {job_id}")
+
+# حظر/فك حظر (صيغة: ban <id> أو unban <id>، أو الآيدي وحده إن جاء من زر حظر/فك حظر — data)
+@on_state("ban", admin=True)
+def state_ban(m, uid, text, data):
+    states.clear(uid)
+    parts = text.split()
+    if len(parts) == 1 and data:
+        parts = [data, parts[0]]
+    if len(parts) < 2:
+        bot.reply_to(m, "استخدم: ban <id> أو unban <id>")
+        return
+    cmd = parts[0].lower()
+    try:
+        target = int(parts[1])
+    except:
+        bot.reply_to(m, "الآيدي يجب أن يكون رقماً.")
+        return
+    if cmd == "ban":
+        ban_user(target)
+        bot.reply_to(m, f"✅ تم حظر المستخدم {target}.")
+        try:
+            bot.send_message(target, "🚫 تم حظرك من البوت.")
+        except:
+            pass
+        log_admin(f"ban {target}")
+    elif cmd == "unban":
+        unban_user(target)
+        bot.reply_to(m, f"✅ تم فك الحظر عن {target}.")
+        log_admin(f"unban {target}")
+    else:
+        bot.reply_to(m, "استخدم: ban <id> أو unban <id>")
+
+# إضافة قسم
+@on_state("new_category", admin=True)
+def state_new_category(m, uid, text, data):
+    states.clear(uid)
+    add_category(text)
+    bot.reply_to(m, f"✅ تم إضافة القسم: {text}")
+    log_admin(f"add_category {text}")
+
+# تعديل قسم (صيغة: category_id | الاسم الجديد)
+@on_state("edit_category", admin=True)
+def state_edit_category(m, uid, text, data):
+    states.clear(uid)
+    parts = [p.strip() for p in text.split("|", 1)]
+    try:
+        cid = int(parts[0])
+    except ValueError:
+        cid = None
+    if cid is None or len(parts) < 2 or not parts[1]:
+        bot.reply_to(m, "الصيغة خاطئة. استخدم: category_id | الاسم الجديد")
+        return
+    if cid not in catalog().category_names:
+        bot.reply_to(m, "القسم غير موجود. تحقق من ID القسم.")
+        return
+    edit_category(cid, parts[1])
+    bot.reply_to(m, f"✅ تم تعديل القسم {cid} إلى: {parts[1]}")
+    log_admin(f"edit_category {cid} {parts[1]}")
+
+# تعديل منتج (صيغة: product_id | name | price | description — الحقل الفارغ لا يتغير)
+@on_state("edit_product", admin=True)
+def state_edit_product(m, uid, text, data):
+    states.clear(uid)
+    parts = [p.strip() for p in text.split("|", 3)] + ["", "", ""]
+    try:
+        pid = int(parts[0])
+        price = float(parts[2].replace(",", ".")) if parts[2] else None
+    except ValueError:
+        bot.reply_to(m, "الصيغة خاطئة. استخدم: product_id | الاسم | السعر | الوصف")
+        return
+    if pid not in catalog().products:
+        bot.reply_to(m, "المنتج غير موجود.")
+        return
+    edit_product(pid, name=parts[1] or None, price=price, description=parts[3] or None)
+    bot.reply_to(m, f"✅ تم تعديل المنتج {pid}.")
+    log_admin(f"edit_product {pid}")
+
+# حذف قسم أو منتج (صيغة: cat <id> أو prod <id>)
+@on_state("delete", admin=True)
+def state_delete(m, uid, text, data):
+    states.clear(uid)
+    parts = text.split()
+    kind = parts[0].lower() if parts else ""
+    try:
+        target = int(parts[1])
+    except (IndexError, ValueError):
+        target = None
+    snap = catalog()
+    if kind == "cat" and target in snap.category_names:
+        delete_category(target)
+        bot.reply_to(m, f"🗑 تم حذف القسم {target} مع منتجاته.")
+        log_admin(f"delete_category {target}")
+    elif kind == "prod" and target in snap.products:
+        delete_product(target)
+        bot.reply_to(m, f"🗑 تم حذف المنتج {target}.")
+        log_admin(f"delete_product {target}")
+    else:
+        bot.reply_to(m, "لم يتم العثور على العنصر. استخدم: cat <id> أو prod <id>")
+
+# إضافة منتج (صيغة: category_id | name | price | description)
+@on_state("new_product", admin=True)
+def state_new_product(m, uid, text, data):
+    states.clear(uid)
+    parts = [p.strip() for p in text.split("|")]
+    if len(parts) < 3:
+        bot.reply_to(m, "الصيغة خاطئة. استخدم: category_id | اسم المنتج | السعر | الوصف (اختياري)")
+        return
+    try:
+        cid = int(parts[0])
+        name = parts[1]
+        price = float(parts[2].replace(",", "."))
+        desc = parts[3] if len(parts) >= 4 else ""
+        # تحقق وجود القسم
+        if cid not in catalog().category_names:
+            bot.reply_to(m, "القسم غير موجود. تحقق من ID القسم.")
+        else:
+            pid = add_product(cid, name, price, desc)
+            bot.reply_to(m, f"✅ تم إضافة المنتج {name} بسعر {fmt_currency(price)}. id={pid}")
+            log_admin(f"add_product {name} in cat {cid}")
+    except Exception as e:
+        bot.reply_to(m, "خطأ في القيم. الصيغة: category_id | name | price | description")
+        log_admin(f"add_product_error {e}")
+
+# إضافة زر مخصص (صيغة: parent_type|parent_id|text|action|payload)
+@on_state("new_button", admin=True)
+def state_new_button(m, uid, text, data):
+    states.clear(uid)
+    parts = [p.strip() for p in text.split("|")]
+    if len(parts) < 4:
+        bot.reply_to(m, "الصيغة خاطئة. استخدم: parent_type|parent_id|text|action|payload")
+        return
+    parent_type = parts[0]  # category/product/global
+    parent_id = int(parts[1])
+    text_btn = parts[2]
+    action = parts[3]  # open_url or buy
+    payload = parts[4] if len(parts) > 4 else ""
+    db_exec("INSERT INTO buttons (parent_type, parent_id, text, action, payload) VALUES (?, ?, ?, ?, ?)",
+            (parent_type, parent_id, text_btn, action, payload))
+    bot.reply_to(m, "✅ تم إضافة الزر.")
+    log_admin(f"add_button {text_btn} to {parent_type}:{parent_id}")
+
+# إضافة/خصم رصيد (صيغة: user_id | amount) — data = add أو deduct
+@on_state("balance_action", admin=True)
+def state_balance_action(m, uid, text, data):
+    states.clear(uid)
+    parts = [p.strip() for p in text.split("|")]
+    if len(parts) < 2:
+        bot.reply_to(m, "استخدام: user_id | amount")
+        return
+    try:
+        target = int(parts[0])
+        amount = float(parts[1].replace(",", "."))
+        if data == "add":
+            change_balance(target, amount, "admin", f"admin:{uid}")
+            bot.reply_to(m, f"✅ تم إضافة {fmt_currency(amount)} للمستخدم {target}.")
             try:
-                amount_syp = float(text.replace(",", "").strip())
-                rate = float(get_setting("syp_rate", "2500"))
-                credits = int(amount_syp / rate)
-                min_dep = int(get_setting("min_deposit", "1"))
-                if credits < min_dep:
-                    bot.reply_to(m, f"❌ الحد الأدنى للإيداع هو {min_dep} كريديت (توافق {fmt_currency(min_dep * rate)}).")
-                    set_setting(f"awaiting_deposit_user_{uid}", "")
-                    return
-                # سجل الطلب
-                cur.execute("INSERT INTO deposits (user_id, amount_syp, credits, status, created_at) VALUES (?, ?, ?, ?, ?)",
-                            (uid, amount_syp, credits, "pending", datetime.utcnow().isoformat()))
-                conn.commit()
-                dep_id = cur.lastrowid
-                bot.reply_to(m, f"✅ تم تسجيل طلب إيداع #{dep_id}: {credits} كريديت — {int(amount_syp)} ل.س. سيتم التحقق من الأدمن.")
-                # إعلام الأدمن
-                bot.send_message(ADMIN_ID, f"📥 طلب إيداع جديد #{dep_id}\nالمستخدم: {uid}\n{credits} كريديت — {int(amount_syp)} ل.س\nلتأكيد: /confirm_deposit {dep_id}\nأو للرفض: /reject_deposit {dep_id}")
-            except Exception as e:
-                bot.reply_to(m, "❌ الرجاء إدخال رقم صالح بالمبلغ بالليرة.")
-                log_admin(f"deposit_input_error {e}")
-            set_setting(f"awaiting_deposit_user_{uid}", "")
+                bot.send_message(target, f"💰 تم إضافة رصيد {fmt_currency(amount)} لحسابك.")
+            except:
+                pass
+            log_admin(f"add_balance {target} {amount}")
+        elif data == "deduct":
+            change_balance(target, -amount, "admin", f"admin:{uid}")
+            bot.reply_to(m, f"✅ تم خصم {fmt_currency(amount)} من المستخدم {target}.")
+            try:
+                bot.send_message(target, f"⚠️ تم خصم {fmt_currency(amount)} من رصيدك.")
+            except:
+                pass
+            log_admin(f"deduct_balance {target} {amount}")
+    except Exception as e:
+        bot.reply_to(m, "خطأ في البيانات. تأكد من الصيغة: user_id | amount")
+        log_admin(f"balance_action_error {e}")
+
+# عرض رصيد مستخدم (صيغة: user_id)
+@on_state("show_balance", admin=True)
+def state_show_balance(m, uid, text, data):
+    states.clear(uid)
+    try:
+        target = int(text)
+    except ValueError:
+        bot.reply_to(m, "الآيدي يجب أن يكون رقماً.")
+        return
+    r = db_one("SELECT balance_minor, banned FROM users WHERE user_id = ?", (target,))
+    if not r:
+        bot.reply_to(m, "المستخدم غير موجود.")
+        return
+    bot.reply_to(m, f"💳 رصيد المستخدم {target}: {fmt_currency(from_minor(r[0]))}" + (" — 🚫 محظور" if r[1] else ""))
+
+# مبلغ شحن من المستخدم (deposit)
+# المستخدم يرسل المبلغ بالليرة، نتحول إلى credits بحسب syp_rate
+@on_state("deposit")
+def state_deposit(m, uid, text, data):
+    states.clear(uid)
+    try:
+        amount_syp = float(text.replace(",", "").strip())
+        rate = float(get_setting("syp_rate", "2500"))
+        credits = int(amount_syp / rate)
+        min_dep = int(get_setting("min_deposit", "1"))
+        if credits < min_dep:
+            bot.reply_to(m, f"❌ الحد الأدنى للإيداع هو {min_dep} كريديت (توافق {fmt_currency(min_dep * rate)}).")
+            return
+        # سجل الطلب
+        dep_id = db_exec("INSERT INTO deposits (user_id, amount_syp, credits, status, created_at) VALUES (?, ?, ?, ?, ?)",
+                         (uid, amount_syp, credits, "pending", datetime.utcnow().isoformat())).lastrowid
+        bot.reply_to(m, f"✅ تم تسجيل طلب إيداع #{dep_id}: {credits} كريديت — {int(amount_syp)} ل.س. سيتم التحقق من الأدمن.")
+        # إعلام الأدمن مع أزرار تأكيد/رفض
+        notifier.deposit(dep_id, uid, credits, amount_syp)
+    except Exception as e:
+        bot.reply_to(m, "❌ الرجاء إدخال رقم صالح بالمبلغ بالليرة.")
+        log_admin(f"deposit_input_error {e}")
+
+# الأوامر (ما عدا /cancel) تذهب لمعالجاتها الخاصة المسجلة لاحقاً
+@bot.message_handler(func=lambda m: not (m.text or "").startswith("/") or (m.text or "").lower().startswith("/cancel"),
+                     content_types=['text'])
+def message_handler(m: types.Message):
+    try:
+        uid = m.from_user.id
+        text = (m.text or "").strip()
+
+        # إلغاء العملية الجارية
+        if text.lower() == "/cancel":
+            states.clear(uid)
+            bot.reply_to(m, "✅ تم الإلغاء.")
             return
 
+        # توجيه واحد حسب الحالة الحالية للمستخدم (بدون استعلامات SQL)
+        st = states.get(uid)
+        if st:
+            handler, admin_only = STATE_HANDLERS.get(st[0], (None, False))
+            if handler and (not admin_only or is_admin(uid)):
+                handler(m, uid, text, st[1])
+                return
+
         # أي رسالة أخرى: رد افتراضي
-        # إذا كانت رسالة من الأدمن تابعة لأمر مباشر نغطيه أعلاه، وإلا نعرض لوحة مناسبة
         if is_admin(uid):
             bot.send_message(uid, "لوحة الأدمن:", reply_markup=admin_main_keyboard())
         else:
             bot.send_message(uid, "استخدم الأزرار للتنقل أو اكتب /help.", reply_markup=user_main_keyboard())
     except Exception:
-        traceback.print_exc()
+        report_error("message_handler")
 
 # ---------------------------
 # أوامر نصية خاصة بالأدمن (سريعة)
 # ---------------------------
+# تأكيد/رفض الإيداع: تستخدمها الأوامر النصية وأزرار الإشعارات
+# تعيد (الحالة، user_id، credits) حيث الحالة: ok أو missing أو processed (سبق تأكيده أو رفضه)
+def confirm_deposit(dep_id):
+    with transaction() as c:
+        # شرط الحالة داخل UPDATE نفسه: ضغطتان متزامنتان لا تضيفان الرصيد مرتين، والمرفوض لا يؤكد لاحقاً
+        r = c.execute("UPDATE deposits SET status = 'confirmed' WHERE id = ? AND status = 'pending' "
+                      "RETURNING user_id, credits", (dep_id,)).fetchall()
+        if not r:
+            existing = c.execute("SELECT user_id, credits FROM deposits WHERE id = ?", (dep_id,)).fetchone()
+            return ("processed",) + tuple(existing) if existing else ("missing", None, None)
+        user_id, credits = r[0]
+        change_balance(user_id, credits, "deposit", f"deposit:{dep_id}")
+    outbox.send(user_id, f"✅ تم تأكيد إيداعك #{dep_id}. {credits} كريديت أضيفت لحسابك.")
+    log_admin(f"confirm_deposit {dep_id}")
+    return "ok", user_id, credits
+
+def reject_deposit(dep_id):
+    with transaction() as c:
+        r = c.execute("UPDATE deposits SET status = 'cancelled' WHERE id = ? AND status = 'pending' "
+                      "RETURNING user_id, credits", (dep_id,)).fetchall()
+        if not r:
+            existing = c.execute("SELECT user_id, credits FROM deposits WHERE id = ?", (dep_id,)).fetchone()
+            return ("processed",) + tuple(existing) if existing else ("missing", None, None)
+    log_admin(f"reject_deposit {dep_id}")
+    return ("ok",) + tuple(r[0])
+
+def parse_deposit_selector(args):
+    # all | user <uid> | <from>-<to> | id1,id2,... -> (شرط SQL، معاملات)؛ None إذا كانت الصيغة خاطئة
+    parts = args.replace(",", " ").split()
+    try:
+        if not parts:
+            return None
+        if parts[0].lower() == "all":
+            return "1 = 1", ()
+        if parts[0].lower() == "user" and len(parts) == 2:
+            return "user_id = ?", (int(parts[1]),)
+        if len(parts) == 1 and "-" in parts[0]:
+            a, b = (int(x) for x in parts[0].split("-", 1))
+            return "id BETWEEN ? AND ?", (min(a, b), max(a, b))
+        ids = tuple(int(x) for x in parts)
+        return f"id IN ({', '.join('?' * len(ids))})", ids
+    except ValueError:
+        return None
+
+def confirm_deposits(where, params=()):
+    # كل الطلبات المعلقة المطابقة في معاملة واحدة: تحديث الحالات + قيود الأرصدة دفعة واحدة
+    with transaction() as c:
+        rows = sorted(c.execute(f"UPDATE deposits SET status = 'confirmed' WHERE status = 'pending' AND {where} "
+                                "RETURNING id, user_id, credits", params).fetchall())
+        if rows:
+            post_entries(c, [(user_id, to_minor(credits), "deposit", f"deposit:{dep_id}")
+                             for dep_id, user_id, credits in rows])
+    for dep_id, user_id, credits in rows:
+        outbox.send(user_id, f"✅ تم تأكيد إيداعك #{dep_id}. {credits} كريديت أضيفت لحسابك.")
+    if rows:
+        log_admin(f"confirm_deposits {len(rows)} #{rows[0][0]}..#{rows[-1][0]}")
+    return rows
+
+def reject_deposits(where, params=()):
+    with transaction() as c:
+        rows = sorted(c.execute(f"UPDATE deposits SET status = 'cancelled' WHERE status = 'pending' AND {where} "
+                                "RETURNING id, user_id, credits", params).fetchall())
+    if rows:
+        log_admin(f"reject_deposits {len(rows)} #{rows[0][0]}..#{rows[-1][0]}")
+    return rows
+
+DEPOSIT_SELECTOR_HELP = "<id> | id1,id2,... | from-to | all | user <user_id>"
+
 @bot.message_handler(commands=["confirm_deposit"])
 def cmd_confirm_deposit(m: types.Message):
     if not is_admin(m.from_user.id):
         bot.reply_to(m, "أنت لست الأدمن.")
         return
-    parts = m.text.split()
-    if len(parts) < 2:
-        bot.reply_to(m, "استخدام: /confirm_deposit <deposit_id>")
-        return
+    parts = m.text.split(None, 1)
+    args = parts[1] if len(parts) > 1 else ""
     try:
-        dep_id = int(parts[1])
-        cur.execute("SELECT user_id, credits, status FROM deposits WHERE id = ?", (dep_id,))
-        r = cur.fetchone()
-        if not r:
-            bot.reply_to(m, "الطلب غير موجود.")
+        if args.strip().isdigit():
+            dep_id = int(args)
+            status, user_id, credits = confirm_deposit(dep_id)
+            if status == "missing":
+                bot.reply_to(m, "الطلب غير موجود.")
+            elif status == "processed":
+                bot.reply_to(m, f"الطلب #{dep_id} تمت معالجته مسبقاً.")
+            else:
+                bot.reply_to(m, f"✅ تم تأكيد الإيداع #{dep_id} وإضافة {credits} كريديت للمستخدم {user_id}.")
             return
-        user_id, credits, status = r
-        if status == "confirmed":
-            bot.reply_to(m, "الطلب مؤكد مسبقاً.")
+        selector = parse_deposit_selector(args)
+        if selector is None:
+            bot.reply_to(m, f"استخدام: /confirm_deposit {DEPOSIT_SELECTOR_HELP}")
             return
-        # أضف الرصيد للمستخدم
-        change_balance(user_id, credits)
-        cur.execute("UPDATE deposits SET status = 'confirmed' WHERE id = ?", (dep_id,))
-        conn.commit()
-        bot.reply_to(m, f"✅ تم تأكيد الإيداع #{dep_id} وإضافة {credits} كريديت للمستخدم {user_id}.")
-        try:
-            bot.send_message(user_id, f"✅ تم تأكيد إيداعك #{dep_id}. {credits} كريديت أضيفت لحسابك.")
-        except:
-            pass
-        log_admin(f"confirm_deposit {dep_id}")
-    except Exception as e:
-        traceback.print_exc()
+        rows = confirm_deposits(*selector)
+        if not rows:
+            bot.reply_to(m, "لا توجد طلبات معلقة مطابقة.")
+            return
+        users = len({r[1] for r in rows})
+        bot.reply_to(m, f"✅ تم تأكيد {len(rows)} طلب إيداع (#{rows[0][0]} … #{rows[-1][0]}) — "
+                        f"{sum(r[2] for r in rows)} كريديت لـ {users} مستخدم. الإشعارات ترسل في الخلفية.")
+    except Exception:
+        report_error("confirm_deposit")
         bot.reply_to(m, "حدث خطأ.")
 
 @bot.message_handler(commands=["reject_deposit"])
 def cmd_reject_deposit(m: types.Message):
     if not is_admin(m.from_user.id):
         return
-    parts = m.text.split()
-    if len(parts) < 2:
-        bot.reply_to(m, "استخدام: /reject_deposit <deposit_id>")
+    parts = m.text.split(None, 1)
+    args = parts[1] if len(parts) > 1 else ""
+    if args.strip().isdigit():
+        dep_id = int(args)
+        status, _, _ = reject_deposit(dep_id)
+        if status == "missing":
+            bot.reply_to(m, "الطلب غير موجود.")
+        elif status == "processed":
+            bot.reply_to(m, f"الطلب #{dep_id} تمت معالجته مسبقاً.")
+        else:
+            bot.reply_to(m, f"✅ تم رفض الطلب #{dep_id}.")
         return
-    dep_id = int(parts[1])
-    cur.execute("SELECT user_id FROM deposits WHERE id = ?", (dep_id,))
-    r = cur.fetchone()
-    if not r:
-        bot.reply_to(m, "الطلب غير موجود.")
+    selector = parse_deposit_selector(args)
+    if selector is None:
+        bot.reply_to(m, f"استخدام: /reject_deposit {DEPOSIT_SELECTOR_HELP}")
         return
-    cur.execute("UPDATE deposits SET status = 'cancelled' WHERE id = ?", (dep_id,))
-    conn.commit()
-    bot.reply_to(m, f"✅ تم رفض الطلب #{dep_id}.")
-    log_admin(f"reject_deposit {dep_id}")
+    rows = reject_deposits(*selector)
+    if not rows:
+        bot.reply_to(m, "لا توجد طلبات معلقة مطابقة.")
+        return
+    bot.reply_to(m, f"✅ تم رفض {len(rows)} طلب إيداع (#{rows[0][0]} … #{rows[-1][0]}).")
+
+@bot.message_handler(commands=["reconcile"])
+def cmd_reconcile(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    rows = reconcile()
+    if not rows:
+        bot.reply_to(m, "✅ كل الأرصدة المخزنة تطابق دفتر القيود.")
+        return
+    lines = [f"⚠️ {len(rows)} رصيد لا يطابق الدفتر (user | مخزن | دفتر):"]
+    lines += [f"{uid} | {fmt_currency(from_minor(cached))} | {fmt_currency(from_minor(ledger))}" for uid, cached, ledger in rows]
+    bot.reply_to(m, "\n".join(lines))
+    log_admin(f"reconcile mismatches={len(rows)}")
+
+@bot.message_handler(commands=["ledger"])
+def cmd_ledger(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    parts = m.text.split()
+    try:
+        target = int(parts[1])
+    except (IndexError, ValueError):
+        bot.reply_to(m, "استخدام: /ledger <user_id>")
+        return
+    lines = [f"📒 آخر قيود المستخدم {target} — الرصيد: {fmt_currency(get_balance(target))}"]
+    for entry_id, amount, kind, ref, created_at in ledger_entries(target):
+        lines.append(f"#{entry_id} {created_at[:16]} {kind} {'+' if amount > 0 else ''}{fmt_currency(from_minor(amount))} {ref or ''}")
+    bot.reply_to(m, "\n".join(lines))
+
+# أزرار الإشعارات والملخصات: dep:ok:<id> و dep:no:<id>
+@on_callback("dep:", admin=True, args=(str, int))
+def cb_deposit_action(c, uid, action, dep_id):
+    if action == "ok":
+        status, user_id, credits = confirm_deposit(dep_id)
+        done = f"✅ تم تأكيد #{dep_id} (+{credits} كريديت للمستخدم {user_id})"
+    else:
+        status, _, _ = reject_deposit(dep_id)
+        done = f"❌ تم رفض #{dep_id}"
+    if status == "missing":
+        bot.answer_callback_query(c.id, "الطلب غير موجود.")
+    elif status == "processed":
+        bot.answer_callback_query(c.id, f"الطلب #{dep_id} تمت معالجته مسبقاً.")
+    else:
+        bot.answer_callback_query(c.id, done)
+
+# ---------------------------
+# قوائم الأدمن (صفحات + فلاتر) وتصدير CSV
+# ---------------------------
+USERS_PAGE_SIZE = 25
+DEPOSITS_PAGE_SIZE = 25
+EXPORT_CHUNK = 1000          # صفوف تقرأ من المؤشر في كل دفعة أثناء التصدير
+DEPOSIT_STATUSES = ("pending", "confirmed", "cancelled")
+
+def parse_user_filter(arg):
+    # banned -> b ، vip -> v ، balance>X أو bal>X أو >X -> gX ، غير ذلك -> a (الكل)
+    arg = (arg or "").strip().lower().replace(" ", "")
+    if arg == "banned":
+        return "b"
+    if arg == "vip":
+        return "v"
+    for prefix in ("balance>", "bal>", ">"):
+        if arg.startswith(prefix):
+            try:
+                return f"g{float(arg[len(prefix):]):g}"
+            except ValueError:
+                break
+    return "a"
+
+def user_filter_sql(code):
+    if code == "b":
+        return "banned = 1", ()
+    if code == "v":
+        return "vip = 1", ()
+    if code.startswith("g"):
+        return "balance_minor > ?", (to_minor(code[1:]),)
+    return "1 = 1", ()
+
+USER_FILTER_LABELS = {"a": "الكل", "b": "المحظورون", "v": "VIP"}
+
+def users_page(code, after_user=None, limit=USERS_PAGE_SIZE):
+    # keyset على (created_at, user_id) تنازلياً؛ المؤشر هو آخر user_id في الصفحة السابقة
+    where, params = user_filter_sql(code)
+    sql = f"SELECT user_id, username, first_name, balance_minor, vip, banned FROM users WHERE {where} "
+    if after_user is not None:
+        sql += "AND (created_at, user_id) < (SELECT created_at, user_id FROM users WHERE user_id = ?) "
+        params = params + (after_user,)
+    rows = db_all(sql + "ORDER BY created_at DESC, user_id DESC LIMIT ?", params + (limit + 1,))
+    return rows[:limit], len(rows) > limit
+
+def users_view(code, rows, has_more):
+    label = USER_FILTER_LABELS.get(code) or f"رصيد > {code[1:]}"
+    lines = [f"قائمة المستخدمين ({label}):"]
+    for r in rows:
+        lines.append(f"ID:{r[0]} | @{r[1] or '----'} | {r[2] or ''} | رصيد:{fmt_currency(from_minor(r[3]))} | VIP:{r[4]} | محظور:{r[5]}")
+    if not rows:
+        lines.append("لا يوجد مستخدمون مطابقون.")
+    kb = types.InlineKeyboardMarkup()
+    nav = [types.InlineKeyboardButton("⏮ الأولى", callback_data=f"usr:{code}:")]
+    if has_more:
+        nav.append(types.InlineKeyboardButton("التالي ▶", callback_data=f"usr:{code}:{rows[-1][0]}"))
+    kb.add(*nav)
+    return "\n".join(lines), kb
+
+def deposits_page(status, before=None, limit=DEPOSITS_PAGE_SIZE):
+    sql = "SELECT id, user_id, credits, amount_syp, status, created_at FROM deposits WHERE "
+    params = ()
+    if status:
+        sql += "status = ? AND "
+        params += (status,)
+    if before is not None:
+        sql += "id < ? "
+        params += (before,)
+    else:
+        sql += "1 = 1 "
+    rows = db_all(sql + "ORDER BY id DESC LIMIT ?", params + (limit + 1,))
+    return rows[:limit], len(rows) > limit
+
+def deposits_view(status, rows, has_more):
+    lines = [f"قائمة طلبات الإيداع ({status or 'الكل'}):"]
+    for r in rows:
+        lines.append(f"#{r[0]} | user:{r[1]} | credits:{r[2]} | {int(r[3])} ل.س | status:{r[4]}")
+    kb = types.InlineKeyboardMarkup()
+    nav = [types.InlineKeyboardButton("⏮ الأولى", callback_data=f"dpl:{status}:")]
+    if has_more:
+        nav.append(types.InlineKeyboardButton("التالي ▶", callback_data=f"dpl:{status}:{rows[-1][0]}"))
+    kb.add(*nav)
+    return "\n".join(lines), kb
+
+def export_csv(chat_id, filename, header, sql, params=()):
+    # يكتب الصفوف على دفعات من المؤشر إلى ملف مؤقت (ينتقل للقرص عند الكبر) ثم يرفعه كمستند
+    count = 0
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as f:
+        text = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+        w = csv.writer(text)
+        w.writerow(header)
+        c = db().execute(sql, params)
+        while True:
+            chunk = c.fetchmany(EXPORT_CHUNK)
+            if not chunk:
+                break
+            w.writerows(chunk)
+            count += len(chunk)
+        text.flush()
+        text.detach()
+        f.seek(0)
+        # ننتظر الرفع قبل إغلاق الملف (في وضع async يرجع مستقبلاً)
+        api_result(bot.send_document(chat_id, f, visible_file_name=filename, caption=f"{count} صف"))
+    return count
 
 @bot.message_handler(commands=["list_deposits"])
 def cmd_list_deposits(m: types.Message):
     if not is_admin(m.from_user.id):
         return
-    cur.execute("SELECT id, user_id, credits, amount_syp, status, created_at FROM deposits ORDER BY id DESC")
-    rows = cur.fetchall()
+    # /list_deposits [pending|confirmed|cancelled]
+    parts = m.text.split()
+    status = parts[1].lower() if len(parts) > 1 and parts[1].lower() in DEPOSIT_STATUSES else ""
+    rows, has_more = deposits_page(status)
     if not rows:
         bot.reply_to(m, "لا توجد طلبات إيداع.")
         return
-    text = "قائمة طلبات الإيداع:\n"
-    for r in rows[:100]:
-        text += f"#{r[0]} | user:{r[1]} | credits:{r[2]} | {int(r[3])} ل.س | status:{r[4]}\n"
-    bot.reply_to(m, text)
+    text, kb = deposits_view(status, rows, has_more)
+    bot.reply_to(m, text, reply_markup=kb)
 
 @bot.message_handler(commands=["users"])
 def cmd_list_users(m: types.Message):
     if not is_admin(m.from_user.id):
         bot.reply_to(m, "خاصة بالأدمن فقط.")
         return
-    cur.execute("SELECT user_id, username, first_name, balance, vip, banned FROM users ORDER BY created_at DESC")
-    rows = cur.fetchall()
-    text = "قائمة المستخدمين:\n"
-    for r in rows[:200]:
-        text += f"ID:{r[0]} | @{r[1] or '----'} | {r[2] or ''} | رصيد:{r[3]} | VIP:{r[4]} | محظور:{r[5]}\n"
-    bot.reply_to(m, text[:4000])
+    # /users [banned|vip|balance>X]
+    args = m.text.split(None, 1)
+    code = parse_user_filter(args[1] if len(args) > 1 else "")
+    rows, has_more = users_page(code)
+    text, kb = users_view(code, rows, has_more)
+    bot.reply_to(m, text, reply_markup=kb)
+
+@bot.message_handler(commands=["export_users"])
+def cmd_export_users(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    args = m.text.split(None, 1)
+    where, params = user_filter_sql(parse_user_filter(args[1] if len(args) > 1 else ""))
+    export_csv(m.chat.id, "users.csv", ["user_id", "username", "first_name", "balance", "vip", "banned", "created_at"],
+               f"SELECT user_id, username, first_name, balance_minor / {float(MINOR_UNITS)}, vip, banned, created_at FROM users WHERE {where}", params)
+    log_admin("export_users")
+
+@bot.message_handler(commands=["export_deposits"])
+def cmd_export_deposits(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    parts = m.text.split()
+    status = parts[1].lower() if len(parts) > 1 and parts[1].lower() in DEPOSIT_STATUSES else ""
+    sql = "SELECT id, user_id, amount_syp, credits, status, created_at FROM deposits"
+    export_csv(m.chat.id, "deposits.csv", ["id", "user_id", "amount_syp", "credits", "status", "created_at"],
+               sql + (" WHERE status = ? ORDER BY id" if status else " ORDER BY id"), (status,) if status else ())
+    log_admin("export_deposits")
 
 @bot.message_handler(commands=["setrate"])
 def cmd_setrate(m: types.Message):
@@ -829,26 +3030,980 @@ def cmd_addproduct(m: types.Message):
         bot.reply_to(m, "خطأ في البيانات.")
 
 # ---------------------------
-# Utilities: settings keys listing (helper)
+# استيراد/تصدير المنتجات بالجملة (CSV أو JSON)
+# ---------------------------
+# الملف (حتى 20MB) ينزل إلى الذاكرة ثم يحلل ويتحقق منه صفاً صفاً، وتحسب الفروق مع الجدول وتطبق
+# بـ executemany في معاملة واحدة.
+# الصف الذي فيه id (أو اسم موجود في نفس القسم) تحديث، والحقول الغائبة تبقى كما هي — لذلك
+# ملف من عمودين "id,price" هو وضع تحديث الأسعار. الصيغة نفسها يخرجها /export_products.
+IMPORT_FIELDS = ("id", "category_id", "category", "name", "price", "description")
+IMPORT_MAX_BYTES = 20 * 1024 * 1024   # حد تنزيل الملفات في Bot API
+IMPORT_CHUNK = 64 * 1024              # حروف تقرأ في كل دفعة من ملف JSON
+IMPORT_PREVIEW = 8                    # أمثلة تعرض في المعاينة
+IMPORT_MAX_ERRORS = 15
+IMPORT_HELP = ("📥 استيراد المنتجات: أرسل ملف CSV أو JSON (مصفوفة أو JSON Lines) بالأعمدة:\n"
+               "id, category_id أو category (اسم القسم — ينشأ إن لم يوجد), name, price, description\n"
+               "• صف بدون id ينشئ منتجاً (أو يحدث منتجاً بنفس الاسم في القسم نفسه).\n"
+               "• الأعمدة الغائبة أو الفارغة لا تتغير؛ ملف id,price يحدث الأسعار فقط.\n"
+               "ستصلك معاينة بالفروق قبل التطبيق. (تعليق الملف /import_products apply يطبق مباشرة)")
+
+def iter_csv_rows(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+    for row in reader:
+        yield reader.line_num, row
+
+_JSON_GAP = re.compile(r"[\s,\[\]]*")
+
+def iter_json_rows(stream):
+    # مصفوفة JSON أو JSON Lines: كل كائن يفك على حدة بـ raw_decode بدل json.load للمصفوفة كلها
+    decoder = json.JSONDecoder()
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig")
+    buf, pos, n, eof = "", 0, 0, False
+    while True:
+        pos = _JSON_GAP.match(buf, pos).end()
+        if pos < len(buf):
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+                n += 1
+                yield n, obj
+                continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise ValueError(f"JSON غير صالح بعد العنصر {n}")
+        elif eof:
+            return
+        chunk = text.read(IMPORT_CHUNK)
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
+def clean_import_row(raw):
+    # يرجع dict بالحقول الموجودة فقط بعد التحويل، أو يرفع ValueError برسالة للأدمن
+    if not isinstance(raw, dict):
+        raise ValueError("الصف ليس كائناً")
+    row = {}
+    for key, value in raw.items():
+        key = str(key or "").strip().lower()
+        if key in IMPORT_FIELDS and value is not None and str(value).strip() != "":
+            row[key] = str(value).strip()
+    try:
+        for key in ("id", "category_id"):
+            if key in row:
+                row[key] = int(row[key])
+    except ValueError:
+        raise ValueError(f"{key} ليس رقماً صحيحاً")
+    if "price" in row:
+        try:
+            price = float(row["price"].replace(",", "."))
+        except ValueError:
+            raise ValueError("السعر ليس رقماً")
+        if not 0 <= price < 1e9:
+            raise ValueError("السعر خارج المجال")
+        row["price"] = round(price, 2)
+    if len(row.get("name", "")) > 200:
+        raise ValueError("الاسم أطول من 200 حرف")
+    if "id" not in row and not ("name" in row and "price" in row and ("category_id" in row or "category" in row)):
+        raise ValueError("منتج جديد يحتاج name و price و category_id أو category")
+    return row
+
+def read_import(stream, fmt):
+    # (صفوف صالحة [(line, row)], أخطاء [(line, msg)])
+    rows, errors = [], []
+    parse = iter_json_rows if fmt == "json" else iter_csv_rows
+    try:
+        for line, raw in parse(stream):
+            try:
+                rows.append((line, clean_import_row(raw)))
+            except ValueError as e:
+                errors.append((line, str(e)))
+    except (ValueError, csv.Error, UnicodeDecodeError) as e:
+        errors.append((0, f"تعذرت قراءة الملف: {e}"))
+    return rows, errors
+
+class ImportPlan:
+    def __init__(self):
+        self.inserts = []          # (category, name, price, description)؛ category رقم أو اسم قسم جديد
+        self.updates = []          # (pid, old, new) حيث old/new = (category_id, name, price, description)
+        self.unchanged = 0
+        self.new_categories = []
+        self.errors = []
+
+    def summary(self):
+        prices = sum(1 for _, old, new in self.updates if old[2] != new[2])
+        return (f"جديد: {len(self.inserts)} | تحديث: {len(self.updates)} (أسعار: {prices}) | "
+                f"بلا تغيير: {self.unchanged} | أقسام جديدة: {len(self.new_categories)} | أخطاء: {len(self.errors)}")
+
+def plan_import(c, rows, errors):
+    # يقارن صفوف الملف بالجدول كما هو داخل المعاملة الحالية
+    plan = ImportPlan()
+    plan.errors = list(errors)
+    categories = dict(c.execute("SELECT name, id FROM categories").fetchall())
+    category_ids = set(categories.values())
+    existing, by_name = {}, {}
+    for pid, cid, name, price, desc in c.execute("SELECT id, category_id, name, price, description FROM products"):
+        existing[pid] = (cid, name, float(price or 0), desc or "")
+        by_name[(cid, name)] = pid
+    seen = set()
+    for line, row in rows:
+        cid = row.get("category_id")
+        if cid is None and "category" in row:
+            cid = categories.get(row["category"], row["category"])
+            if isinstance(cid, str) and cid not in plan.new_categories:
+                plan.new_categories.append(cid)
+        if isinstance(cid, int) and cid not in category_ids:
+            plan.errors.append((line, f"القسم {cid} غير موجود"))
+            continue
+        pid = row.get("id")
+        if pid is None and isinstance(cid, int):
+            pid = by_name.get((cid, row["name"]))
+        key = pid if pid is not None else (cid, row["name"])
+        if key in seen:
+            plan.errors.append((line, "صف مكرر لنفس المنتج"))
+            continue
+        seen.add(key)
+        if pid is None:
+            plan.inserts.append((cid, row["name"], row["price"], row.get("description", "")))
+            continue
+        old = existing.get(pid)
+        if old is None:
+            plan.errors.append((line, f"المنتج {pid} غير موجود"))
+            continue
+        new = (old[0] if cid is None else cid, row.get("name", old[1]), row.get("price", old[2]),
+               row.get("description", old[3]))
+        if new == old:
+            plan.unchanged += 1
+        else:
+            plan.updates.append((pid, old, new))
+    return plan
+
+def apply_import(c, plan):
+    ids = {name: c.execute("INSERT INTO categories (name, pos) VALUES (?, ?)", (name, int(time.time()))).lastrowid
+           for name in plan.new_categories}
+    last_id = c.execute("SELECT COALESCE(MAX(id), 0) FROM products").fetchone()[0]
+    pos = int(time.time())
+    c.executemany("INSERT INTO products (category_id, name, price, description, pos) VALUES (?, ?, ?, ?, ?)",
+                  [(ids.get(cid, cid), name, price, desc, pos) for cid, name, price, desc in plan.inserts])
+    c.executemany("UPDATE products SET category_id = ?, name = ?, price = ?, description = ? WHERE id = ?",
+                  [(ids.get(new[0], new[0]),) + new[1:] + (pid,) for pid, _, new in plan.updates])
+    # الفهرس يحدث للمنتجات الجديدة وما تغير اسمه أو وصفه فقط (تغيير السعر لا يمسه)
+    reindex = [(pid, new[1], new[3]) for pid, old, new in plan.updates if (old[1], old[3]) != (new[1], new[3])]
+    reindex += c.execute("SELECT id, name, description FROM products WHERE id > ?", (last_id,)).fetchall()
+    index_products(c, reindex)
+
+def import_products(stream, fmt, apply=False):
+    # القراءة والتحقق خارج المعاملة؛ المقارنة والتطبيق داخلها حتى لا يتغير الجدول بينهما
+    rows, errors = read_import(stream, fmt)
+    with transaction() as c:
+        plan = plan_import(c, rows, errors)
+        if apply and not plan.errors:
+            apply_import(c, plan)
+    if apply and not plan.errors:
+        invalidate_catalog()
+    return plan
+
+def import_report(plan, filename, applied):
+    title = "✅ تم الاستيراد" if applied else "📥 معاينة الاستيراد"
+    lines = [f"{title} ({filename}):", plan.summary()]
+    for cid, name, price, _ in plan.inserts[:IMPORT_PREVIEW]:
+        lines.append(f"+ {name} — {fmt_currency(price)} (قسم {cid})")
+    for pid, old, new in plan.updates[:IMPORT_PREVIEW]:
+        changes = [f"{label}: {o} ← {n}" for label, o, n in (("القسم", old[0], new[0]), ("الاسم", old[1], new[1]))
+                   if o != n]
+        if old[2] != new[2]:
+            changes.append(f"السعر: {fmt_currency(old[2])} ← {fmt_currency(new[2])}")
+        if old[3] != new[3]:
+            changes.append("الوصف")
+        lines.append(f"~ #{pid} {old[1]}: " + "، ".join(changes))
+    for line, msg in sorted(plan.errors)[:IMPORT_MAX_ERRORS]:
+        lines.append(f"⚠️ سطر {line}: {msg}" if line else f"⚠️ {msg}")
+    if len(plan.errors) > IMPORT_MAX_ERRORS:
+        lines.append(f"… و {len(plan.errors) - IMPORT_MAX_ERRORS} أخطاء أخرى")
+    if plan.errors and not applied:
+        lines.append("صحح الأخطاء وأعد إرسال الملف؛ لا يطبق ملف فيه أخطاء.")
+    return html.escape("\n".join(lines)[:3500])
+
+def import_format(filename):
+    name = (filename or "").lower()
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith((".json", ".jsonl", ".ndjson")):
+        return "json"
+    return None
+
+@bot.message_handler(commands=["import_products"])
+def cmd_import_products(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    states.set(m.from_user.id, "import")
+    bot.reply_to(m, IMPORT_HELP + "\nلإلغاء ارسل /cancel")
+
+@on_callback("adm_import", admin=True)
+def cb_adm_import(c, uid):
+    ask_admin(c, uid, "import", IMPORT_HELP, toast="أرسل الملف الآن.")
+
+def _import_wanted(m):
+    if not is_admin(m.from_user.id):
+        return False
+    st = states.get(m.from_user.id)
+    return (st is not None and st[0] == "import") or (m.caption or "").startswith("/import_products")
+
+@bot.message_handler(content_types=["document"], func=_import_wanted)
+def handle_import_document(m: types.Message):
+    uid = m.from_user.id
+    try:
+        doc = m.document
+        fmt = import_format(doc.file_name)
+        if fmt is None:
+            bot.reply_to(m, "صيغة غير مدعومة — أرسل ملف .csv أو .json أو .jsonl")
+            return
+        if (doc.file_size or 0) > IMPORT_MAX_BYTES:
+            bot.reply_to(m, "الملف أكبر من 20MB.")
+            return
+        apply = (m.caption or "").split()[1:2] == ["apply"]
+        run_import(uid, m.chat.id, doc.file_id, doc.file_name, fmt, apply)
+    except Exception:
+        report_error("handle_import_document")
+        bot.reply_to(m, "تعذر الاستيراد.")
+
+def run_import(uid, chat_id, file_id, filename, fmt, apply):
+    # download_file يرجع الملف كاملاً؛ حجمه محدود مسبقاً بـ IMPORT_MAX_BYTES
+    data = bot.download_file(bot.get_file(file_id).file_path)
+    plan = import_products(io.BytesIO(data), fmt, apply)
+    applied = apply and not plan.errors
+    kb = None
+    if applied:
+        states.clear(uid)
+        log_admin(f"import_products {filename}: +{len(plan.inserts)} ~{len(plan.updates)}")
+    elif not plan.errors and (plan.inserts or plan.updates):
+        # المعاينة تحفظ معرف الملف؛ زر التطبيق يعيد القراءة والمقارنة داخل معاملة جديدة
+        states.set(uid, "import_ready", json.dumps([file_id, filename, fmt]))
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("✅ تطبيق", callback_data="imp:apply"),
+               types.InlineKeyboardButton("✖ إلغاء", callback_data="imp:cancel"))
+    bot.send_message(chat_id, import_report(plan, filename, applied), reply_markup=kb)
+
+@on_callback("imp:", admin=True, args=(str,))
+def cb_import_action(c, uid, action):
+    st = states.get(uid)
+    if action != "apply" or not st or st[0] != "import_ready":
+        states.clear(uid)
+        bot.answer_callback_query(c.id, "تم الإلغاء." if action == "cancel" else "انتهت صلاحية المعاينة.")
+        return
+    file_id, filename, fmt = json.loads(st[1])
+    bot.answer_callback_query(c.id, "جارٍ التطبيق…")
+    run_import(uid, uid, file_id, filename, fmt, True)
+
+def export_products(chat_id):
+    # نفس أعمدة الاستيراد: الملف المصدر يعدل ويعاد رفعه كما هو
+    return export_csv(chat_id, "products.csv", list(IMPORT_FIELDS),
+                      "SELECT p.id, p.category_id, c.name, p.name, p.price, p.description FROM products p "
+                      "LEFT JOIN categories c ON c.id = p.category_id ORDER BY p.category_id, p.pos, p.id")
+
+@bot.message_handler(commands=["export_products"])
+def cmd_export_products(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    export_products(m.chat.id)
+    log_admin("export_products")
+
+@on_callback("adm_export", admin=True)
+def cb_adm_export(c, uid):
+    bot.answer_callback_query(c.id, "جارٍ التصدير…")
+    export_products(uid)
+    log_admin("export_products")
+
+# /reprice: تحديث كل الأسعار (أو قسم واحد) بعبارة UPDATE واحدة
+REPRICE_HELP = ("استخدام: /reprice <x1.1 | %10 | +2 | -2 | rate 3000> [cat <id>] [dry]\n"
+                "• x: ضرب، %: نسبة مئوية، +/-: إضافة كريديت\n"
+                "• rate: سعر صرف جديد — الأسعار تتغير بنسبة القديم/الجديد ويحفظ السعر الجديد (لكل الأقسام، لا يقبل cat)\n"
+                "• dry: معاينة دون تطبيق")
+# حدود التعديل الواحد (مثل حد السعر في clean_import_row): تمنع NaN و inf والأخطاء المطبعية الكبيرة
+REPRICE_FACTOR_MIN = 0.01
+REPRICE_FACTOR_MAX = 100
+REPRICE_DELTA_MAX = 1e6
+REPRICE_RATE_MAX = 1e9
+
+def _reprice_number(text):
+    value = float(text.replace(",", "."))
+    if not math.isfinite(value):
+        raise ValueError
+    return value
+
+def parse_reprice(args):
+    # يرجع (factor, delta, rate, cat_id, dry) أو يرفع ValueError
+    words = args.lower().split()
+    dry = "dry" in words
+    words = [w for w in words if w != "dry"]
+    cat_id = None
+    if "cat" in words:
+        i = words.index("cat")
+        cat_id = int(words[i + 1])
+        del words[i:i + 2]
+    factor, delta, rate = 1.0, 0.0, None
+    if len(words) == 2 and words[0] == "rate":
+        # سعر الصرف عام: تغييره لقسم واحد يترك بقية الأقسام بالسعر القديم
+        if cat_id is not None:
+            raise ValueError
+        rate = _reprice_number(words[1])
+        old = float(get_setting("syp_rate", "2500"))
+        if not 0 < rate < REPRICE_RATE_MAX:
+            raise ValueError
+        factor = old / rate
+    elif len(words) == 1 and words[0][0] in "x*":
+        factor = _reprice_number(words[0][1:])
+    elif len(words) == 1 and words[0][0] == "%":
+        factor = 1 + _reprice_number(words[0][1:]) / 100
+    elif len(words) == 1 and words[0][0] in "+-":
+        delta = _reprice_number(words[0])
+    else:
+        raise ValueError
+    if not REPRICE_FACTOR_MIN <= factor <= REPRICE_FACTOR_MAX or abs(delta) > REPRICE_DELTA_MAX:
+        raise ValueError
+    return factor, delta, rate, cat_id, dry
+
+def reprice_products(factor, delta, cat_id=None, rate=None, dry=False):
+    where, params = ("category_id = ?", (cat_id,)) if cat_id is not None else ("1 = 1", ())
+    new_price = "MAX(0, ROUND(price * ? + ?, 2))"
+    with transaction() as c:
+        count = c.execute(f"SELECT COUNT(*) FROM products WHERE {where}", params).fetchone()[0]
+        sample = c.execute(f"SELECT id, name, price, {new_price} FROM products WHERE {where} ORDER BY id LIMIT ?",
+                           (factor, delta) + params + (IMPORT_PREVIEW,)).fetchall()
+        if not dry:
+            c.execute(f"UPDATE products SET price = {new_price} WHERE {where}", (factor, delta) + params)
+            if rate is not None:
+                # في نفس المعاملة: لو بقي السعر القديم بعد تعديل الأسعار لأعاد /reprice rate التالي تحويلها مرة ثانية
+                write_setting(c, "syp_rate", rate)
+    if not dry:
+        if rate is not None:
+            _settings_cache["syp_rate"] = str(rate)
+        invalidate_catalog()
+    return count, sample
+
+@bot.message_handler(commands=["reprice"])
+def cmd_reprice(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    args = m.text.split(None, 1)
+    try:
+        factor, delta, rate, cat_id, dry = parse_reprice(args[1] if len(args) > 1 else "")
+    except (ValueError, IndexError):
+        bot.reply_to(m, REPRICE_HELP)
+        return
+    count, sample = reprice_products(factor, delta, cat_id, rate, dry)
+    lines = [f"{'🔎 معاينة' if dry else '✅ تم'} تعديل أسعار {count} منتج"
+             + (f" — سعر الصرف الجديد {int(rate)} ل.س" if rate is not None and not dry else "")]
+    lines += [f"#{pid} {name}: {fmt_currency(old)} ← {fmt_currency(new)}" for pid, name, old, new in sample]
+    bot.reply_to(m, html.escape("\n".join(lines)))
+    if not dry:
+        log_admin(f"reprice x{factor:.4f} {delta:+} cat={cat_id} rate={rate} ({count})")
+
+# ---------------------------
+# أرشفة البيانات الباردة (orders / deposits / admin_log) في قواعد شهرية
+# ---------------------------
+# الصفوف الأقدم من ARCHIVE_DAYS تنقل على دفعات إلى ملف لكل شهر (ATTACH) ثم تحذف من القاعدة الحية،
+# فتبقى الجداول الساخنة وفهارسها ونسخها الاحتياطية صغيرة. النسخ INSERT OR IGNORE بالمعرف نفسه:
+# المعاملة بين قاعدتين (والرئيسية WAL) ليست ذرية بينهما، لكن إعادة التشغيل بعد أي انقطاع آمنة.
+# القراءة من الأرشيف فقط عند الطلب عبر /history (عرض UNION ALL مؤقت).
+ARCHIVE_DAYS = int(os.getenv("ARCHIVE_DAYS", "90"))   # 0 = بلا أرشفة
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR") or os.path.join(os.path.dirname(os.path.abspath(DB_FILE)), "archive")
+ARCHIVE_BATCH = 1000          # صفوف لكل معاملة نقل
+ARCHIVE_PAUSE = 0.05          # ثوانٍ بين الدفعات ليمر المعالجون بين أقفال الكتابة
+ARCHIVE_EVERY = 24 * 3600
+VACUUM_STEP_PAGES = 500       # صفحات تعاد في كل خطوة incremental_vacuum
+HISTORY_LIMIT = 30
+HISTORY_MONTHS = 8            # ملفات أرشيف ترفق في عرض /history (حد SQLite الافتراضي 10 قواعد)
+# الجدول -> شرط إضافي لما يجوز نقله (الإيداعات المعلقة تبقى حتى تؤكد أو ترفض)
+ARCHIVE_TABLES = {"orders": "", "deposits": "status != 'pending'", "admin_log": ""}
+_MONTH_RE = re.compile(r"\d{4}-\d{2}")
+
+def archive_path(month):
+    stem = os.path.splitext(os.path.basename(DB_FILE))[0]
+    return os.path.join(ARCHIVE_DIR, f"{stem}-{month}.db")
+
+def archive_months():
+    stem = os.path.splitext(os.path.basename(DB_FILE))[0] + "-"
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    return sorted(f[len(stem):-3] for f in os.listdir(ARCHIVE_DIR)
+                  if f.startswith(stem) and f.endswith(".db") and _MONTH_RE.fullmatch(f[len(stem):-3]))
+
+def next_month(month):
+    y, m = map(int, month.split("-"))
+    return f"{y + m // 12}-{m % 12 + 1:02d}"
+
+def _archive_table(c, table, alias):
+    # ينشئ الجدول وفهارسه في ملف الأرشيف من مخطط القاعدة الحية، ويضيف أي عمود أضافته ترحيلات لاحقة
+    sql = c.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+    c.execute(re.sub(rf"^CREATE TABLE \"?{table}\"?", f"CREATE TABLE IF NOT EXISTS {alias}.{table}", sql))
+    have = {r[1] for r in c.execute(f"PRAGMA {alias}.table_info({table})")}
+    columns = []
+    for _, name, kind, *_ in c.execute(f"PRAGMA main.table_info({table})").fetchall():
+        if name not in have:
+            c.execute(f"ALTER TABLE {alias}.{table} ADD COLUMN {name} {kind}")
+        columns.append(name)
+    for (index_sql,) in c.execute("SELECT sql FROM main.sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                                  (table,)).fetchall():
+        c.execute(re.sub(r"^CREATE (UNIQUE )?INDEX ", rf"CREATE \1INDEX IF NOT EXISTS {alias}.", index_sql))
+    return ", ".join(columns)
+
+def archive_old_rows(days=ARCHIVE_DAYS, batch=ARCHIVE_BATCH):
+    # يعيد {الجدول: عدد الصفوف المنقولة}
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    c = db()
+    moved = {}
+    for table, extra in ARCHIVE_TABLES.items():
+        cond = "created_at < ?" + (f" AND {extra}" if extra else "")
+        months = [r[0] for r in c.execute(f"SELECT DISTINCT substr(created_at, 1, 7) FROM {table} WHERE {cond}",
+                                          (cutoff,)).fetchall()]
+        for month in filter(_MONTH_RE.fullmatch, months):
+            os.makedirs(ARCHIVE_DIR, exist_ok=True)
+            c.execute("ATTACH DATABASE ? AS arc", (archive_path(month),))
+            try:
+                columns = _archive_table(c, table, "arc")
+                while True:
+                    with transaction():
+                        ids = [r[0] for r in c.execute(
+                            f"SELECT id FROM main.{table} WHERE created_at >= ? AND created_at < ? AND {cond} LIMIT ?",
+                            (month, next_month(month), cutoff, batch)).fetchall()]
+                        if not ids:
+                            break
+                        marks = ", ".join("?" * len(ids))
+                        c.execute(f"INSERT OR IGNORE INTO arc.{table} ({columns}) "
+                                  f"SELECT {columns} FROM main.{table} WHERE id IN ({marks})", ids)
+                        c.execute(f"DELETE FROM main.{table} WHERE id IN ({marks})", ids)
+                    moved[table] = moved.get(table, 0) + len(ids)
+                    time.sleep(ARCHIVE_PAUSE)
+            finally:
+                c.execute("DETACH DATABASE arc")
+    return moved
+
+def incremental_vacuum(pages=VACUUM_STEP_PAGES):
+    # كل خطوة معاملة كتابة قصيرة؛ executescript يشغل الـ pragma حتى نهايته (execute يحرر صفحة واحدة)
+    if not incremental_vacuum_enabled():
+        return 0
+    c = db()
+    free = start = c.execute("PRAGMA freelist_count").fetchone()[0]
+    while free:
+        c.executescript(f"PRAGMA incremental_vacuum({pages});")
+        before, free = free, c.execute("PRAGMA freelist_count").fetchone()[0]
+        if free >= before:
+            break      # لا تقدم (كتابات متزامنة تستهلك الصفحات نفسها أو تحررها)
+        time.sleep(ARCHIVE_PAUSE)
+    c.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    return max(0, start - free)
+
+def enable_incremental_vacuum():
+    # تحويل قاعدة قائمة لمرة واحدة: VACUUM كامل يقفل الكتابة طوال مدته
+    c = db()
+    if incremental_vacuum_enabled():
+        return False
+    c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    c.execute("VACUUM")
+    return True
+
+def archive_and_vacuum():
+    moved = archive_old_rows()
+    freed = incremental_vacuum() if moved else 0
+    if moved:
+        print(f"archived {moved}, freed {freed} pages")
+    return moved, freed
+
+# /history: الجدول الحي + ملفات الأرشيف عبر عرض مؤقت على اتصال مستقل (لا يلمس اتصالات المعالجات)
+HISTORY_TABLES = {
+    # الاسم -> (الجدول، عمود فلتر المستخدم)
+    "orders": ("orders", "user_id"),
+    "deposits": ("deposits", "user_id"),
+    "log": ("admin_log", None),
+}
+
+@contextmanager
+def history_view(table, months):
+    c = _connect()
+    try:
+        columns = [r[1] for r in c.execute(f"PRAGMA main.table_info({table})").fetchall()]
+        parts = [f"SELECT {', '.join(columns)} FROM main.{table}"]
+        for i, month in enumerate(months):
+            c.execute(f"ATTACH DATABASE ? AS a{i}", (archive_path(month),))
+            have = {r[1] for r in c.execute(f"PRAGMA a{i}.table_info({table})").fetchall()}
+            if have:
+                parts.append("SELECT " + ", ".join(col if col in have else f"NULL AS {col}" for col in columns)
+                             + f" FROM a{i}.{table}")
+        c.execute(f"CREATE TEMP VIEW {table}_history AS " + " UNION ALL ".join(parts))
+        yield c
+    finally:
+        c.close()
+
+def history_rows(kind, user_id=None, month=None, limit=HISTORY_LIMIT):
+    table, user_col = HISTORY_TABLES[kind]
+    months = archive_months()
+    months = [month] if month in months else [] if month else months[-HISTORY_MONTHS:]
+    where, params = ["1 = 1"], []
+    if user_id is not None and user_col:
+        where.append(f"{user_col} = ?")
+        params.append(user_id)
+    if month:
+        where.append("created_at >= ? AND created_at < ?")
+        params += [month, next_month(month)]
+    with history_view(table, months) as c:
+        return c.execute(f"SELECT * FROM {table}_history WHERE {' AND '.join(where)} ORDER BY id DESC LIMIT ?",
+                         params + [limit]).fetchall()
+
+@bot.message_handler(commands=["history"])
+def cmd_history(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    # /history <orders|deposits|log> [user_id] [YYYY-MM]
+    parts = m.text.split()[1:]
+    kind = parts.pop(0).lower() if parts else ""
+    month = next((p for p in parts if _MONTH_RE.fullmatch(p)), None)
+    user_id = next((int(p) for p in parts if p.isdigit()), None)
+    if kind not in HISTORY_TABLES:
+        bot.reply_to(m, "استخدام: /history <orders|deposits|log> [user_id] [YYYY-MM]\n"
+                        f"أشهر الأرشيف: {', '.join(archive_months()) or 'لا يوجد'}")
+        return
+    rows = history_rows(kind, user_id, month)
+    lines = [f"🗄 السجل ({kind}{' — ' + month if month else ''}):"]
+    for r in rows:
+        lines.append(" | ".join("" if v is None else str(v)[:60] for v in r))
+    if not rows:
+        lines.append("لا توجد نتائج.")
+    bot.reply_to(m, html.escape("\n".join(lines)[:3900]))
+
+@bot.message_handler(commands=["archive"])
+def cmd_archive(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    if not ARCHIVE_DAYS:
+        bot.reply_to(m, "الأرشفة معطلة (ARCHIVE_DAYS=0).")
+        return
+    # تشغيل فوري في الخلفية (نفس مهمة الأرشفة الدورية)
+    bot.reply_to(m, f"🗄 جارٍ نقل ما هو أقدم من {ARCHIVE_DAYS} يوماً إلى {ARCHIVE_DIR}…")
+
+    def job():
+        try:
+            moved, freed = archive_and_vacuum()
+            note = "" if incremental_vacuum_enabled() else " (incremental vacuum غير مفعل — /vacuum_setup)"
+            bot.send_message(m.chat.id, f"✅ الأرشفة: {moved or 'لا شيء للنقل'} — صفحات محررة: {freed}{note}")
+        except Exception:
+            report_error("archive")
+        finally:
+            close_db()
+
+    threading.Thread(target=job, name="archive-now", daemon=True).start()
+    log_admin("archive")
+
+@bot.message_handler(commands=["vacuum_setup"])
+def cmd_vacuum_setup(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    if incremental_vacuum_enabled():
+        bot.reply_to(m, "✅ incremental auto_vacuum مفعل مسبقاً.")
+        return
+    bot.reply_to(m, "🧹 جارٍ تشغيل VACUUM لتفعيل incremental auto_vacuum — الكتابة متوقفة حتى ينتهي…")
+
+    def job():
+        try:
+            started = time.time()
+            enable_incremental_vacuum()
+            bot.send_message(m.chat.id, f"✅ تم التفعيل خلال {time.time() - started:.1f} ث.")
+        except Exception:
+            report_error("vacuum_setup")
+            bot.send_message(m.chat.id, "تعذر التفعيل (القاعدة مشغولة؟) — أعد المحاولة في وقت أهدأ.")
+        finally:
+            close_db()
+
+    threading.Thread(target=job, name="vacuum-setup", daemon=True).start()
+    log_admin("vacuum_setup")
+
+# ---------------------------
+# النسخ الاحتياطي أثناء التشغيل (SQLite backup API)
 # ---------------------------
-def list_settings_keys():
-    cur.execute("SELECT key FROM settings")
-    return [r[0] for r in cur.fetchall()]
+# النسخ على خطوات صغيرة من الصفحات مع توقف قصير بين كل خطوة فلا يطول أي قفل على المشتريات،
+# ثم فحص integrity_check على النسخة (لا على القاعدة الحية) وضغطها gzip وتدوير القديم.
+# كل ذلك في خيط خلفي؛ نسخة واحدة في كل مرة.
+BACKUP_DIR = os.getenv("BACKUP_DIR") or os.path.join(os.path.dirname(os.path.abspath(DB_FILE)), "backups")
+BACKUP_EVERY = float(os.getenv("BACKUP_EVERY_HOURS", "24")) * 3600   # 0 = بلا نسخ مجدول
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))                     # آخر N نسخة تبقى دائماً
+BACKUP_KEEP_WEEKS = int(os.getenv("BACKUP_KEEP_WEEKS", "4"))         # + أحدث نسخة من كل أسبوع قبلها
+BACKUP_PAGES = 256            # صفحات لكل خطوة backup
+BACKUP_STEP_SLEEP = 0.01      # ثوانٍ بين الخطوات
+BACKUP_MAX_RESTARTS = 3       # كتابة على المصدر أثناء النسخ تعيده من البداية؛ بعدها خطوة واحدة (قراءة WAL لا تقفل الكتّاب)
+BACKUP_SEND_MAX = 50 * 1024 * 1024   # حد رفع الملفات في Bot API
+
+_backup_lock = threading.Lock()
+backup_state = {"last_ok": 0.0, "last_seconds": 0.0, "last_bytes": 0, "failures": 0}
+metrics.gauge("storebot_backup", "Last successful backup (unix time, seconds taken, compressed bytes) and failures",
+              lambda: {(k,): v for k, v in backup_state.items()}, ("field",))
+
+class _BackupRestarted(Exception):
+    pass
+
+def _copy_db(path, pages):
+    restarts = [0, None]   # عدد مرات الإعادة، آخر عدد متبقٍ
+
+    def progress(status, remaining, total):
+        if restarts[1] is not None and remaining > restarts[1]:
+            restarts[0] += 1
+            if restarts[0] > BACKUP_MAX_RESTARTS:
+                raise _BackupRestarted()
+        restarts[1] = remaining
+        time.sleep(BACKUP_STEP_SLEEP)
+
+    dst = sqlite3.connect(path)
+    try:
+        db().backup(dst, pages=pages, progress=progress)
+    finally:
+        dst.close()
+    return restarts[0]
+
+def integrity_check(path):
+    c = sqlite3.connect(path)
+    try:
+        rows = [r[0] for r in c.execute("PRAGMA integrity_check").fetchall()]
+    except sqlite3.DatabaseError as e:
+        rows = [str(e)]
+    finally:
+        c.close()
+    return rows == ["ok"], rows
+
+def rotate_backups(now=None):
+    # يبقي أحدث BACKUP_KEEP نسخة، وأحدث نسخة من كل أسبوع لـ BACKUP_KEEP_WEEKS أسابيع قبلها
+    files = sorted((f for f in os.listdir(BACKUP_DIR) if f.endswith(".db.gz")), reverse=True)
+    keep = set(files[:BACKUP_KEEP])
+    weeks = set()
+    oldest = (now or datetime.utcnow()) - timedelta(weeks=BACKUP_KEEP_WEEKS)
+    for f in files[BACKUP_KEEP:]:
+        try:
+            taken = datetime.strptime(f.rsplit("-", 2)[-2] + f.rsplit("-", 2)[-1][:6], "%Y%m%d%H%M%S")
+        except ValueError:
+            continue
+        week = taken.isocalendar()[:2]
+        if taken >= oldest and week not in weeks:
+            weeks.add(week)
+            keep.add(f)
+    removed = [f for f in files if f not in keep]
+    for f in removed:
+        os.remove(os.path.join(BACKUP_DIR, f))
+    return removed
+
+def run_backup():
+    # يعيد dict بالنتيجة، أو None إذا كانت نسخة أخرى قيد التنفيذ
+    if not _backup_lock.acquire(blocking=False):
+        return None
+    try:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(DB_FILE))[0]
+        name = f"{stem}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.db"
+        part = os.path.join(BACKUP_DIR, name + ".part")
+        for f in os.listdir(BACKUP_DIR):
+            if f.endswith(".part"):
+                os.remove(os.path.join(BACKUP_DIR, f))   # بقايا نسخة انقطعت
+        t0 = time.time()
+        try:
+            restarts = _copy_db(part, BACKUP_PAGES)
+        except _BackupRestarted:
+            restarts = BACKUP_MAX_RESTARTS + _copy_db(part, -1)
+        copied = time.time() - t0
+        ok, problems = integrity_check(part)
+        if not ok:
+            os.replace(part, os.path.join(BACKUP_DIR, name + ".corrupt"))
+            backup_state["failures"] += 1
+            return {"ok": False, "name": name, "problems": problems[:5]}
+        path = os.path.join(BACKUP_DIR, name + ".gz")
+        with open(part, "rb") as src, gzip.open(path + ".tmp", "wb", compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(path + ".tmp", path)
+        raw = os.path.getsize(part)
+        os.remove(part)
+        removed = rotate_backups()
+        size = os.path.getsize(path)
+        backup_state.update(last_ok=round(time.time()), last_seconds=round(time.time() - t0, 2), last_bytes=size)
+        return {"ok": True, "name": name + ".gz", "path": path, "raw": raw, "size": size, "copy_seconds": round(copied, 2),
+                "seconds": round(time.time() - t0, 2), "restarts": restarts, "removed": len(removed)}
+    except Exception:
+        backup_state["failures"] += 1
+        raise
+    finally:
+        _backup_lock.release()
+
+def backup_report(res):
+    if res["ok"]:
+        return (f"✅ نسخة احتياطية: {res['name']}\n"
+                f"الحجم: {res['raw'] // 1024} KB ← {res['size'] // 1024} KB مضغوط — "
+                f"{res['seconds']} ث (النسخ {res['copy_seconds']} ث، إعادات {res['restarts']})\n"
+                f"integrity_check: ok — حذف {res['removed']} نسخة قديمة")
+    return f"❌ فشل فحص النسخة {res['name']}:\n" + "\n".join(res["problems"])
+
+def last_backup_time():
+    # أحدث نسخة في BACKUP_DIR (تشمل /backup اليدوي)؛ 0 إن لم توجد
+    try:
+        return max((os.path.getmtime(os.path.join(BACKUP_DIR, f)) for f in os.listdir(BACKUP_DIR) if f.endswith(".db.gz")),
+                   default=0)
+    except OSError:
+        return 0
+
+def scheduled_backup():
+    res = run_backup()
+    if res and not res["ok"]:
+        bot.send_message(ADMIN_ID, html.escape(backup_report(res)))
+
+@bot.message_handler(commands=["backup"])
+def cmd_backup(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    # /backup [send] — send يرفع النسخة المضغوطة كمستند
+    send = m.text.split()[1:2] == ["send"]
+    bot.reply_to(m, "💾 جارٍ النسخ الاحتياطي في الخلفية…")
+
+    def job():
+        try:
+            res = run_backup()
+            if res is None:
+                bot.send_message(m.chat.id, "نسخة احتياطية أخرى قيد التنفيذ.")
+                return
+            bot.send_message(m.chat.id, html.escape(backup_report(res)))
+            if res["ok"] and send:
+                if res["size"] > BACKUP_SEND_MAX:
+                    bot.send_message(m.chat.id, f"النسخة أكبر من حد الرفع؛ موجودة في {res['path']}")
+                else:
+                    with open(res["path"], "rb") as f:
+                        # ننتظر الرفع قبل إغلاق الملف (في وضع async يرجع مستقبلاً)
+                        api_result(bot.send_document(m.chat.id, f, visible_file_name=res["name"]))
+        except Exception:
+            report_error("backup")
+            bot.send_message(m.chat.id, "❌ تعذر النسخ الاحتياطي.")
+        finally:
+            close_db()
+
+    threading.Thread(target=job, name="backup-now", daemon=True).start()
+    log_admin("backup" + (" send" if send else ""))
+
+# ---------------------------
+# وضع التشغيل غير المتزامن (asyncio)
+# ---------------------------
+ASYNC_DB_WORKERS = 8         # خيوط المنفذ المخصص لمنطق المعالجات وSQLite
+ASYNC_MAX_INFLIGHT = 2000    # أقصى عدد تحديثات قيد المعالجة قبل إيقاف الجلب مؤقتاً
+
+class AsyncRuntime:
+    # المعالجات نفسها تبقى كما هي وتعمل على منفذ خاص بقاعدة البيانات، أما طلبات
+    # تيليجرام (إرسال/تعديل/رد) فتحول إلى حلقة asyncio واحدة وتنتظر بالتوازي،
+    # فلا يبقى خيط محجوزاً طوال زمن طلب HTTP.
+    # تنبيه: send_document يرجع مستقبلاً قبل أن يقرأ الملف؛ من يرفع ملفاً مفتوحاً بـ with
+    # يجب أن ينتظر api_result(...) قبل إغلاقه وإلا يفشل الرفع بصمت.
+    API_METHODS = ("send_message", "edit_message_text", "answer_callback_query", "reply_to",
+                   "send_document", "answer_inline_query")
+
+    def __init__(self):
+        from telebot.async_telebot import AsyncTeleBot
+        self.api = AsyncTeleBot(BOT_TOKEN, parse_mode="HTML")
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_DB_WORKERS, thread_name_prefix="db")
+        self.loop = None
+        self.inflight = None
+        self.active = 0
+        self.tasks = set()
+
+    def _bridge(self, name):
+        method = getattr(self.api, name)
+
+        def call(*args, **kwargs):
+            fut = asyncio.run_coroutine_threadsafe(method(*args, **kwargs), self.loop)
+            fut.add_done_callback(self._log_failure)
+            return fut
+        return call
+
+    @staticmethod
+    def _log_failure(fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            print(f"Telegram API error: {fut.exception()!r}")
+
+    def install(self):
+        global API_ERRORS
+        from telebot import asyncio_helper
+        API_ERRORS = API_ERRORS + (asyncio_helper.ApiTelegramException,)
+        asyncio_helper._process_request = timed_async_request(asyncio_helper._process_request)
+        metrics.gauge("storebot_async_inflight", "Updates being handled in async mode", lambda: self.active)
+        for name in self.API_METHODS:
+            setattr(bot, name, self._bridge(name))
+        # المعالجات تعمل مباشرة على خيوط المنفذ بدل مجمع خيوط telebot
+        bot.threaded = False
+
+    async def handle(self, update):
+        try:
+            await self.loop.run_in_executor(self.executor, bot.process_new_updates, [update])
+        except Exception:
+            report_error("async_handle")
+        finally:
+            self.active -= 1
+            self.inflight.release()
+
+    async def poll(self):
+        offset = None
+        while True:
+            try:
+                updates = await self.api.get_updates(offset=offset, timeout=60)
+            except Exception:
+                report_error("async_poll")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                await self.inflight.acquire()
+                self.active += 1
+                task = asyncio.create_task(self.handle(update))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.inflight = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+        self.install()
+        try:
+            await self.poll()
+        finally:
+            await self.api.close_session()
+
+    def run(self):
+        asyncio.run(self.main())
+
+# ---------------------------
+# وضع webhook (خادم HTTP مدمج)
+# ---------------------------
+WEBHOOK_WORKERS = 8          # خيوط تنفيذ المعالجات
+WEBHOOK_MAX_QUEUE = 10000    # عند الامتلاء نرد 503 فيعيد تيليجرام المحاولة لاحقاً
+WEBHOOK_MAX_BODY = 1024 * 1024   # أكبر جسم طلب مقبول (413 لما زاد) — التحديثات أصغر بكثير
+
+class _WebhookHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256   # الافتراضي 5 يرفض الاتصالات عند الذروة
+
+class WebhookServer:
+    # الطلب يتحقق من السر ويضع الجسم الخام في الطابور ويرد 200 فوراً؛
+    # التحليل وتشغيل المعالجات يتم على خيوط العمال.
+    def __init__(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                 workers=WEBHOOK_WORKERS, max_queue=WEBHOOK_MAX_QUEUE):
+        # بدون سر يستطيع أي أحد يصل للمنفذ حقن تحديثات (حتى باسم الأدمن)
+        if not secret:
+            raise ValueError("WebhookServer requires a secret token")
+        self.path = path
+        self.secret = secret
+        self.updates = queue.Queue(maxsize=max_queue)
+        self.workers = workers
+        self.httpd = _WebhookHTTPServer((host, port), self._handler_class())
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    return self._reply(404)
+                token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+                if not hmac.compare_digest(token, server.secret):
+                    return self._reply(403)
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    return self._reply(400)
+                if length < 0 or length > WEBHOOK_MAX_BODY:
+                    self.close_connection = True
+                    return self._reply(413)
+                body = self.rfile.read(length)
+                try:
+                    server.updates.put_nowait(body)
+                except queue.Full:
+                    return self._reply(503)
+                self._reply(200)
+
+            def _reply(self, code):
+                self.send_response(code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _worker(self):
+        while True:
+            body = self.updates.get()
+            if body is None:
+                return
+            try:
+                update = types.Update.de_json(body.decode("utf-8"))
+                bot.process_new_updates([update])
+            except Exception:
+                report_error("webhook_worker")
+
+    def start(self):
+        # المعالجات تعمل مباشرة على خيوط العمال بدل مجمع خيوط telebot
+        bot.threaded = False
+        metrics.gauge("storebot_webhook_queue", "Webhook updates waiting for a worker", self.updates.qsize)
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"webhook-{i}", daemon=True).start()
+        threading.Thread(target=self.httpd.serve_forever, name="webhook-http", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        for _ in range(self.workers):
+            self.updates.put(None)
+
+def run_webhook():
+    secret = WEBHOOK_SECRET
+    if not secret:
+        if not WEBHOOK_URL:
+            # لا يمكن إبلاغ تيليجرام بسر مولد دون تسجيل الـ webhook بأنفسنا
+            raise SystemExit("RUN_MODE=webhook needs WEBHOOK_SECRET (or WEBHOOK_URL so one can be generated)")
+        secret = secrets.token_urlsafe(32)
+        print("WEBHOOK_SECRET not set; using a generated secret for this run")
+    server = WebhookServer(secret=secret)
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=secret)
+    print(f"Webhook listening on {WEBHOOK_HOST}:{server.port}{WEBHOOK_PATH}")
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    finally:
+        server.stop()
 
 # ---------------------------
 # بدء التشغيل (polling)
 # ---------------------------
 def safe_start():
+    global _metrics_server
     try:
         print("Bot starting...")
-        conn.commit()
-        bot.infinity_polling(timeout=60, long_polling_timeout=60)
+        if METRICS_PORT and _metrics_server is None:
+            _metrics_server = start_metrics_server()
+        resume_broadcasts()
+        run_periodic("ledger-compact", LEDGER_COMPACT_EVERY, compact_ledger)
+        if ARCHIVE_DAYS:
+            run_periodic("archive", ARCHIVE_EVERY, archive_and_vacuum)
+        if BACKUP_EVERY:
+            run_periodic("backup", BACKUP_EVERY, scheduled_backup, last_run=last_backup_time)
+        if RUN_MODE == "async":
+            AsyncRuntime().run()
+        elif RUN_MODE == "webhook":
+            run_webhook()
+        else:
+            bot.infinity_polling(timeout=60, long_polling_timeout=60)
     except KeyboardInterrupt:
         print("Stopping by user")
     except Exception:
-        traceback.print_exc()
+        report_error("safe_start")
         time.sleep(5)
         safe_start()
+    finally:
+        # لا نفقد الكتابات المؤجلة ولا ملخص الأدمن ولا إشعارات المستخدمين المعلقة عند الإيقاف
+        notifier.flush()
+        outbox.flush()
+        writer.flush()
 
 if __name__ == "__main__":
     safe_start()
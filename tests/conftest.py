@@ -0,0 +1,12 @@
+# tests/conftest.py
+# كل الاختبارات تعمل على قاعدة مؤقتة (DB_FILE) تضبط قبل أول استيراد لـ main
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ["DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="storebot-tests-"), "test.db")
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("ADMIN_ID", "1")
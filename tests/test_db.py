@@ -0,0 +1,39 @@
+import threading
+from types import SimpleNamespace
+
+import bench
+import main
+
+
+def test_each_thread_gets_its_own_connection():
+    conns = []
+
+    def grab():
+        conns.append(main.db())
+        main.close_db()
+
+    t = threading.Thread(target=grab)
+    t.start()
+    t.join()
+    assert conns[0] is not main.db()
+
+
+def test_wal_and_busy_timeout():
+    assert main.db_one("PRAGMA journal_mode")[0] == "wal"
+    assert main.db_one("PRAGMA busy_timeout")[0] == main.DB_BUSY_TIMEOUT
+
+
+def test_transaction_rolls_back_on_error():
+    main.change_balance(9001, 5)
+    try:
+        with main.transaction() as c:
+            main.post_entry(c, 9001, 100, "admin")
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert main.get_balance(9001) == 5
+
+
+def test_concurrent_helpers_keep_rows_apart():
+    # نفس فحص "python bench.py concurrency" بحجم أصغر
+    assert bench.bench_concurrency(SimpleNamespace(threads=8, ops=60, users=10)) == 0
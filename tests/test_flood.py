@@ -0,0 +1,26 @@
+from types import SimpleNamespace
+
+import main
+from telebot import types
+from telebot.handler_backends import CancelUpdate
+
+
+def test_burst_then_drop_then_mute():
+    fc = main.FloodControl(rate=0.001, burst=3)
+    assert [fc.check(7) for _ in range(3)] == ["ok"] * 3
+    verdicts = [fc.check(7) for _ in range(main.FLOOD_MUTE_AFTER)]
+    assert verdicts[:-1] == ["drop"] * (main.FLOOD_MUTE_AFTER - 1)
+    assert verdicts[-1] == "mute"
+    assert fc.check(7) == "muted"
+    assert 0 < fc.mute_remaining(7) <= main.FLOOD_MUTE_SECONDS
+    assert fc.mute_remaining(8) == 0
+
+
+def test_muted_callback_is_answered_silently(monkeypatch):
+    answers = []
+    monkeypatch.setattr(main.bot, "answer_callback_query", lambda cid, *a, **kw: answers.append((cid, a, kw)))
+    monkeypatch.setattr(main, "flood", SimpleNamespace(check=lambda uid: "muted"))
+    update = types.CallbackQuery(id="cb1", from_user=SimpleNamespace(id=4242), data="noop", chat_instance="x",
+                                 json_string="{}")
+    assert isinstance(main.FloodMiddleware().pre_process(update, {}), CancelUpdate)
+    assert answers == [("cb1", (), {})]
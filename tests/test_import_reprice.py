@@ -0,0 +1,65 @@
+import io
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("args, expected", [
+    ("x1.5", (1.5, 0.0, None, None, False)),
+    ("%10 cat 3", (1.1, 0.0, None, 3, False)),
+    ("-2 dry", (1.0, -2.0, None, None, True)),
+    ("+0,5", (1.0, 0.5, None, None, False)),
+])
+def test_parse_reprice(args, expected):
+    factor, delta, rate, cat_id, dry = main.parse_reprice(args)
+    assert (round(factor, 6), delta, rate, cat_id, dry) == expected
+
+
+def test_parse_reprice_rate_uses_current_rate():
+    old = float(main.get_setting("syp_rate", "2500"))
+    factor, _, rate, _, _ = main.parse_reprice("rate 5000")
+    assert rate == 5000 and factor == old / 5000
+
+
+@pytest.mark.parametrize("args", [
+    "", "x", "x0", "x-1", "x nan", "xnan", "%nan", "xinf", "x1e9", "+inf", "-inf", "+nan", "+1e7",
+    "rate 0", "rate nan", "rate inf", "rate 5000 cat 1", "x2 cat", "x2 cat a", "y2",
+])
+def test_parse_reprice_rejects(args):
+    with pytest.raises((ValueError, IndexError)):
+        main.parse_reprice(args)
+
+
+@pytest.mark.parametrize("price", ["nan", "inf", "-1", "1e9", "abc"])
+def test_clean_import_row_rejects_bad_prices(price):
+    with pytest.raises(ValueError):
+        main.clean_import_row({"name": "a", "price": price, "category_id": 1})
+
+
+def test_read_import_collects_row_errors():
+    data = "name,price,category_id\nok,1.5,1\nbad,x,1\nmissing,,\n".encode()
+    rows, errors = main.read_import(io.BytesIO(data), "csv")
+    assert [r["name"] for _, r in rows] == ["ok"]
+    assert [line for line, _ in errors] == [3, 4]
+
+
+def test_plan_import_diffs_against_the_catalog():
+    cid = main.add_category("import plan")
+    pid = main.add_product(cid, "kept", 2, "d")
+    changed = main.add_product(cid, "changed", 3, "")
+    rows = [
+        (2, {"id": pid, "name": "kept", "price": 2.0, "description": "d"}),
+        (3, {"id": changed, "price": 4.0}),
+        (4, {"category_id": cid, "name": "fresh", "price": 1.0}),
+        (5, {"category": "brand new", "name": "other", "price": 1.0}),
+        (6, {"id": changed, "price": 5.0}),
+        (7, {"id": 10 ** 9, "price": 1.0}),
+        (8, {"category_id": 10 ** 9, "name": "orphan", "price": 1.0}),
+    ]
+    plan = main.plan_import(main.db(), rows, [(1, "header")])
+    assert plan.unchanged == 1
+    assert [(p, new[2]) for p, _, new in plan.updates] == [(changed, 4.0)]
+    assert [ins[1] for ins in plan.inserts] == ["fresh", "other"]
+    assert plan.new_categories == ["brand new"]
+    assert [line for line, _ in plan.errors] == [1, 6, 7, 8]
@@ -0,0 +1,50 @@
+import pytest
+
+import main
+
+
+def balance_total():
+    return main.db_one("SELECT value FROM stats WHERE key = 'balance_total_minor'")[0]
+
+
+def test_to_minor_rounds_half_up():
+    assert main.to_minor(0.1) + main.to_minor(0.2) == main.to_minor(0.3) == 30
+    assert main.to_minor(2.005) == 201
+    assert main.from_minor(150) == 1.5
+
+
+def test_users_table_has_no_real_balance_copy():
+    columns = {r[1] for r in main.db_all("PRAGMA table_info(users)")}
+    assert "balance_minor" in columns and "balance" not in columns
+
+
+def test_purchase_writes_one_entry_with_its_order_ref():
+    cid = main.add_category("ledger")
+    pid = main.add_product(cid, "ledger item", 2.5, "")
+    main.change_balance(7001, 3)
+    order_id, _, _ = main.purchase(7001, pid)
+    assert main.get_balance(7001) == 0.5
+    assert main.ledger_entries(7001)[0][1:4] == (-250, "purchase", f"order:{order_id}")
+    # رصيد غير كافٍ: لا طلب ولا قيد
+    assert main.purchase(7001, pid)[0] is None
+    assert len(main.ledger_entries(7001)) == 2
+
+
+def test_total_counter_tracks_every_write_path():
+    before = balance_total()
+    main.change_balance(7002, 10)
+    main.set_balance(7002, 4)
+    with main.transaction() as c:
+        main.post_entries(c, [(7003, 500, "deposit", "deposit:x"), (7004, 125, "deposit", "deposit:y")])
+    assert balance_total() - before == 400 + 500 + 125
+    assert balance_total() == main.db_one("SELECT SUM(balance_minor) FROM users")[0]
+    assert main.reconcile() == []
+
+
+def test_compaction_keeps_balances():
+    main.change_balance(7005, 8)
+    main.change_balance(7005, -3)
+    assert main.compact_ledger(days=-1) >= 2
+    assert main.ledger_entries(7005) == []
+    assert main.get_balance(7005) == 5
+    assert main.reconcile() == []
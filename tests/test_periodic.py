@@ -0,0 +1,25 @@
+import threading
+import time
+
+import main
+
+
+def test_overdue_job_runs_at_start_and_records_the_run():
+    ran = threading.Event()
+    main.run_periodic("test-overdue", 3600, ran.set)
+    assert ran.wait(2)
+    main.writer.flush()
+    assert time.time() - main.last_periodic_run("test-overdue") < 60
+
+
+def test_recent_job_waits_for_the_rest_of_its_interval():
+    ran = threading.Event()
+    main.set_setting("periodic_last:test-recent", round(time.time()))
+    main.run_periodic("test-recent", 3600, ran.set)
+    assert not ran.wait(0.3)
+
+
+def test_last_run_hook_counts_as_a_run():
+    ran = threading.Event()
+    main.run_periodic("test-hook", 3600, ran.set, last_run=time.time)
+    assert not ran.wait(0.3)
@@ -0,0 +1,23 @@
+from types import SimpleNamespace
+
+import bench
+import main
+
+
+def test_migrations_reach_latest_version():
+    assert main.db_one("PRAGMA user_version")[0] == main.MIGRATIONS[-1][0]
+
+
+def test_migrate_is_idempotent():
+    main.migrate()
+    assert main.db_one("PRAGMA user_version")[0] == main.MIGRATIONS[-1][0]
+
+
+def test_hot_path_indexes_exist():
+    names = {r[0] for r in main.db_all("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"idx_orders_user", "idx_deposits_status", "idx_users_created"} <= names
+
+
+def test_no_query_scans_a_whole_table():
+    # نفس فحص "python bench.py plans": أي استعلام جديد بلا فهرس يفشل هنا
+    assert bench.bench_plans(SimpleNamespace()) == 0